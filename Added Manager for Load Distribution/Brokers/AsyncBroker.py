@@ -0,0 +1,334 @@
+# asyncio counterpart of LoggingQueue for AsyncBrokerWrapper.py
+# Same return codes as Broker.py. Requests waiting on the database or parked by
+# a long poll are coroutines, not threads, so thousands can be in flight.
+import asyncio
+import json
+from time import monotonic, perf_counter
+from typing import Dict, List, Set, Tuple
+import aiohttp
+import asyncpg
+from TailCache import TailCache
+from LoadStats import LoadStats, HEARTBEAT_MS, HEARTBEAT_TIMEOUT
+from LongPoll import MAX_WAIT_MS, NOTIFY_CHANNEL, NOTIFY_CHUNK
+from LiveTail import sse_event, messages_event, KEEPALIVE_MS, SUBSCRIBE_MAX_MESSAGES, SUBSCRIBE_MAX_BYTES
+from sqlalchemy import text
+
+# defaults for batch fetches on the consume path
+FETCH_MAX_MESSAGES = 500
+FETCH_MAX_BYTES = 1 << 20
+
+
+class AsyncAppendNotifier:
+    """AppendNotifier for coroutines: one event per partition, replaced on every append."""
+
+    def __init__(self) -> None:
+        self.events: Dict[Tuple[str, int], asyncio.Event] = {}
+        # set by enable_notify, publishes appends to other processes
+        self.publish = None
+
+    def enable_notify(self, publish) -> None:
+        # publish: coroutine function taking a list of (topic, partition_id)
+        self.publish = publish
+
+    def version(self, topic_name: str, partition_id: int) -> asyncio.Event:
+        # taken before checking for data, any later append sets it
+        key = (topic_name, int(partition_id))
+        if key not in self.events:
+            self.events[key] = asyncio.Event()
+        return self.events[key]
+
+    def wake(self, partitions) -> None:
+        for topic_name, partition_id in partitions:
+            event = self.events.pop((topic_name, int(partition_id)), None)
+            if event is not None:
+                event.set()
+
+    async def notify(self, partitions) -> None:
+        partitions = list(partitions)
+        self.wake(partitions)
+        if self.publish is not None:
+            try:
+                await self.publish(partitions)
+            except Exception as e:
+                print("Notify Error:", e)
+
+    async def wait(self, version: asyncio.Event, deadline: float) -> bool:
+        # True if the partition was appended to before monotonic() reached deadline
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        try:
+            await asyncio.wait_for(version.wait(), remaining)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+async def listen_notify(notifier: AsyncAppendNotifier, dsn: str, channel: str = NOTIFY_CHANNEL) -> None:
+    # relays NOTIFYs from other broker processes, reconnects forever
+    def relay(connection, pid, channel, payload):
+        notifier.wake(tuple(partition) for partition in json.loads(payload))
+
+    while True:
+        try:
+            connection = await asyncpg.connect(dsn)
+            try:
+                await connection.add_listener(channel, relay)
+                while not connection.is_closed():
+                    await asyncio.sleep(5)
+            finally:
+                await connection.close()
+        except Exception as e:
+            print("Listen Error:", e)
+        await asyncio.sleep(1)
+
+
+def publish_notify(db_engine, channel: str = NOTIFY_CHANNEL):
+    async def publish(partitions) -> None:
+        async with db_engine.begin() as conn:
+            for i in range(0, len(partitions), NOTIFY_CHUNK):
+                await conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                   {"channel": channel, "payload": json.dumps(partitions[i:i + NOTIFY_CHUNK])})
+    return publish
+
+
+class AsyncLoggingQueue:
+    def __init__(self, storage, cache: TailCache = None):
+        # async storage engine, see AsyncStorage.py
+        self.storage = storage
+        # newest messages per partition, None disables the cache
+        self.cache = cache
+        # (topic, partition) pairs known to exist, see LoggingQueue
+        self.catalog: Set[Tuple[str, int]] = set()
+        self.notifier = AsyncAppendNotifier()
+        self.stats = LoadStats()
+        # (topic, partition) -> (leader epoch, led here), from the write manager's heartbeat replies
+        self.leadership: Dict[Tuple[str, int], Tuple[int, bool]] = {}
+
+    async def load_catalog(self) -> None:
+        self.catalog.update((topic_name, int(partition_id))
+                            for topic_name, partition_id in await self.storage.list_topics())
+        print(f"Loaded {len(self.catalog)} partitions into the catalog.")
+
+    async def topic_exists(self, topic_name: str, partition_id: int) -> bool:
+        key = (topic_name, int(partition_id))
+        if key in self.catalog:
+            return True
+        if await self.storage.check_topic(topic_name, partition_id):
+            self.catalog.add(key)
+            return True
+        return False
+
+    async def ensure_topic(self, topic_name: str, partition_id: int) -> bool:
+        # creates the partition if needed, returns True if it was created here
+        if await self.topic_exists(topic_name, partition_id):
+            return False
+        await self.storage.create_topic(topic_name, partition_id)
+        self.catalog.add((topic_name, int(partition_id)))
+        print(f"Topic {topic_name} with partition {partition_id} created.")
+        return True
+
+    async def heartbeat(self, ip: str, port: int, broker_id, self_port) -> None:
+        data = {"broker_id": broker_id, "port": self_port}
+        send_url = f"http://{ip}:{port}/broker/receive_beat"
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HEARTBEAT_TIMEOUT)) as session:
+            while True:
+                data["load"] = await self.load_report()
+                try:
+                    async with session.post(send_url, json=data) as r:
+                        r.raise_for_status()
+                        self.update_leadership((await r.json()).get("leading", []))
+                except aiohttp.ClientResponseError as errh:
+                    print("Http Error:", errh)
+                except aiohttp.ClientConnectionError as errc:
+                    print("Error Connecting:", errc)
+                except asyncio.TimeoutError as errt:
+                    print("Timeout Error:", errt)
+                await asyncio.sleep(HEARTBEAT_MS / 1000)
+
+    def update_leadership(self, leading) -> None:
+        # see LoggingQueue.update_leadership
+        leadership = {(topic_name, int(partition_id)): (leader_epoch, True)
+                      for topic_name, partition_id, leader_epoch in leading}
+        for key, (leader_epoch, led) in self.leadership.items():
+            if key not in leadership:
+                leadership[key] = (leader_epoch, False)
+        self.leadership = leadership
+
+    def stale_epoch(self, topic_name: str, partition_id: int, leader_epoch: int) -> bool:
+        # see LoggingQueue.stale_epoch
+        known = self.leadership.get((topic_name, int(partition_id)))
+        if known is None:
+            return False
+        known_epoch, led = known
+        return leader_epoch < known_epoch if led else leader_epoch <= known_epoch
+
+    async def load_report(self) -> dict:
+        usage, disk_bytes = None, None
+        try:
+            usage, disk_bytes = await self.storage.usage()
+        except Exception as e:
+            print("Usage Error:", e)
+        return self.stats.snapshot(usage, disk_bytes)
+
+    async def enqueue(self, message: str, topic: str, partition_id: int) -> int:
+        # returns the offset assigned to the message, -1 on failure
+        started = perf_counter()
+        await self.ensure_topic(topic, partition_id)
+        offset = await self.storage.append(topic, partition_id, message)
+        if offset < 0:
+            print(f"Message could not be added to topic {topic} with partition {partition_id}.")
+            return -1
+        if self.cache is not None:
+            self.cache.put(topic, partition_id, offset, [message])
+        await self.notifier.notify([(topic, partition_id)])
+        self.stats.appended(topic, partition_id, 1, len(message))
+        self.stats.latency(perf_counter() - started)
+        return offset
+
+    async def enqueue_batch(self, messages: List[Tuple[str, int, str]]):
+        # messages: list of (topic, partition_id, message)
+        # returns [(topic, partition_id, base_offset, last_offset)] or -1
+        started = perf_counter()
+        for topic, partition_id in {(topic, partition_id) for topic, partition_id, _ in messages}:
+            await self.ensure_topic(topic, partition_id)
+
+        ranges = await self.storage.append_batch(messages)
+        if ranges == -1:
+            print(f"Batch of {len(messages)} messages could not be added.")
+            return -1
+        if self.cache is not None:
+            batches = {}
+            for topic, partition_id, message in messages:
+                batches.setdefault((topic, int(partition_id)), []).append(message)
+            for topic, partition_id, base_offset, _ in ranges:
+                self.cache.put(topic, partition_id, base_offset, batches[(topic, int(partition_id))])
+        await self.notifier.notify((topic, partition_id) for topic, partition_id, _, _ in ranges)
+        sizes = {}
+        for topic, partition_id, message in messages:
+            key = (topic, int(partition_id))
+            sizes[key] = sizes.get(key, 0) + len(message)
+        for topic, partition_id, base_offset, last_offset in ranges:
+            self.stats.appended(topic, partition_id, last_offset - base_offset + 1, sizes[(topic, int(partition_id))])
+        self.stats.latency(perf_counter() - started)
+        return ranges
+
+    async def dequeue(self, topic_name: str, partition_id: int, offset: int, max_wait_ms: int = 0):
+        # see LoggingQueue.dequeue
+        deadline = monotonic() + min(max_wait_ms, MAX_WAIT_MS) / 1000
+        while True:
+            version = self.notifier.version(topic_name, partition_id)
+            started = perf_counter()
+            message = await self.dequeue_once(topic_name, partition_id, offset)
+            self.stats.latency(perf_counter() - started)
+            if isinstance(message, str):
+                self.stats.fetched(topic_name, partition_id, 1)
+            if message != -2 or max_wait_ms <= 0:
+                return message
+            if not await self.notifier.wait(version, deadline):
+                return message
+
+    async def dequeue_once(self, topic_name: str, partition_id: int, offset: int):
+        if self.cache is not None:
+            cached = self.cache.get(topic_name, partition_id, offset)
+            if cached:
+                return cached[0]
+
+        if not await self.topic_exists(topic_name, partition_id):
+            return -1
+
+        message = await self.storage.read(topic_name, partition_id, offset)
+        if isinstance(message, str):
+            return message
+        if offset < await self.start_offset(topic_name, partition_id):
+            return -4
+        return -2
+
+    async def fetch(self, topic_name: str, partition_id: int, offset: int,
+                    max_messages: int = FETCH_MAX_MESSAGES, max_bytes: int = FETCH_MAX_BYTES, max_wait_ms: int = 0):
+        # see LoggingQueue.fetch
+        deadline = monotonic() + min(max_wait_ms, MAX_WAIT_MS) / 1000
+        while True:
+            version = self.notifier.version(topic_name, partition_id)
+            started = perf_counter()
+            status = await self.fetch_once(topic_name, partition_id, offset, max_messages, max_bytes)
+            self.stats.latency(perf_counter() - started)
+            if isinstance(status, tuple) and status[0]:
+                self.stats.fetched(topic_name, partition_id, len(status[0]))
+            if not isinstance(status, tuple) or status[0] or max_wait_ms <= 0:
+                return status
+            if not await self.notifier.wait(version, deadline):
+                return status
+
+    async def fetch_once(self, topic_name: str, partition_id: int, offset: int, max_messages: int, max_bytes: int):
+        messages = None
+        if self.cache is not None:
+            messages = self.cache.get(topic_name, partition_id, offset, max_messages, max_bytes)
+
+        if messages is None:
+            if not await self.topic_exists(topic_name, partition_id):
+                return -1
+            messages = await self.storage.read_range(topic_name, partition_id, offset, max_messages, max_bytes)
+            if not messages and offset < await self.start_offset(topic_name, partition_id):
+                return -4
+        high_watermark = await self.storage.high_watermark(topic_name, partition_id)
+        return messages, high_watermark
+
+    async def start_offset(self, topic_name: str, partition_id: int) -> int:
+        return await self.storage.start_offset(topic_name, partition_id)
+
+    async def high_watermark(self, topic_name: str, partition_id: int) -> int:
+        return await self.storage.high_watermark(topic_name, partition_id)
+
+    async def offset_for_time(self, topic_name: str, partition_id: int, timestamp_ms: int) -> int:
+        if not await self.topic_exists(topic_name, partition_id):
+            return -1
+        return await self.storage.offset_for_time(topic_name, partition_id, timestamp_ms)
+
+    async def tail(self, topic_name: str, partition_id: int, offset: int,
+                   max_messages: int = SUBSCRIBE_MAX_MESSAGES, max_bytes: int = SUBSCRIBE_MAX_BYTES):
+        # LiveTail.tail as an async generator
+        while True:
+            version = self.notifier.version(topic_name, partition_id)
+            status = await self.fetch(topic_name, partition_id, offset, max_messages, max_bytes)
+            if status == -1:
+                yield sse_event("error", {"partition_id": partition_id,
+                                          "message": f"Topic {topic_name} does not exist."})
+                return
+            if status == -4:
+                offset = await self.start_offset(topic_name, partition_id)
+                yield sse_event("reset", {"partition_id": partition_id, "offset": offset}, offset)
+                continue
+
+            messages, high_watermark = status
+            if messages:
+                yield messages_event(partition_id, offset, messages, high_watermark)
+                offset += len(messages)
+            elif not await self.notifier.wait(version, monotonic() + KEEPALIVE_MS / 1000):
+                yield ": keep-alive\n\n"
+
+    async def size(self, topic_name: str, partition_id: int, offset) -> int:
+        if not await self.topic_exists(topic_name, partition_id):
+            return -1
+        return await self.storage.size(topic_name, partition_id, offset)
+
+    async def enforce_retention(self, metadata, default_policy, interval_ms: int) -> None:
+        # RetentionEnforcer as a task
+        while True:
+            await asyncio.sleep(interval_ms / 1000)
+            try:
+                policies = await metadata.get_policies()
+                for topic_name, partition_id in await self.storage.list_topics():
+                    max_age_ms, max_bytes, max_messages = policies.get(topic_name, default_policy)
+                    if max_age_ms is None and max_bytes is None and max_messages is None:
+                        continue
+                    removed = await self.storage.trim(topic_name, partition_id, max_age_ms=max_age_ms,
+                                                      max_bytes=max_bytes, max_messages=max_messages)
+                    if removed > 0:
+                        # cache hits skip the start offset check
+                        if self.cache is not None:
+                            self.cache.evict(topic_name, partition_id)
+                        print(f"Retention removed {removed} messages from topic {topic_name} with partition {partition_id}.")
+            except Exception as e:
+                print("Retention Error:", e)
@@ -0,0 +1,426 @@
+# asyncio broker server, an alternative to BrokerWrapper.py
+# The endpoints, arguments and environment of BrokerWrapper.py, served by aiohttp
+# on one event loop with asyncpg database access (see AsyncBroker.py and
+# AsyncStorage.py), except: no /replica/append and no replicator, so it can
+# neither follow nor push the partitions of a replicated topic; a single process,
+# without --workers and --threads; no group commit (--group-commit, --linger-ms,
+# --max-group-size).
+# python AsyncBrokerWrapper.py -p 8082 -mIP 127.0.0.1 -mPort 8080
+import argparse
+import asyncio
+import os
+import socket
+from random import randint
+
+import aiohttp
+from aiohttp import web
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from AsyncBroker import AsyncLoggingQueue, listen_notify, publish_notify, FETCH_MAX_MESSAGES, FETCH_MAX_BYTES
+from AsyncStorage import get_async_storage, AsyncMetadata
+from Storage import STORAGE_ENGINES
+from SegmentLog import SEGMENT_BYTES
+from TailCache import TailCache, PARTITION_MAX_MESSAGES, CACHE_MAX_BYTES
+from Retention import RETENTION_CHECK_MS
+from Codec import CODECS, CompressedBatch, codec_of
+from LiveTail import SUBSCRIBE_MAX_MESSAGES, SUBSCRIBE_MAX_BYTES
+
+DATABASE_CONFIG = {
+    'user': 'postgres',
+    'password': 'postgres',
+    'host': os.getenv('DB_NAME'),
+    'port': 5432,
+    'dbname': os.getenv('DB_NAME')
+}
+db_dsn = f"postgresql://{DATABASE_CONFIG['user']}:{DATABASE_CONFIG['password']}@{DATABASE_CONFIG['host']}:{DATABASE_CONFIG['port']}/{DATABASE_CONFIG['dbname']}"
+db_url = db_dsn.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+# database connections shared by all requests, parked long polls hold none
+DB_POOL_SIZE = 20
+
+routes = web.RouteTableDef()
+
+
+@routes.get('/')
+async def hello_world(request):
+    return web.Response(text="<h1> Hello WOrld wow</h1>", content_type="text/html")
+
+
+@routes.post("/producer/produce")
+async def enqueue(request):
+    broker = request.app["broker"]
+    dict = await request.json()
+    topic = dict['topic_name']
+    try:
+        partition_id = int(dict['partition_id'])
+    except (TypeError, ValueError):
+        return web.json_response({"status": "Failure", "message": f"Invalid partition_id {dict['partition_id']}."})
+    message = dict['message']
+    codec = dict.get('codec', None)
+    if codec is not None:
+        if codec not in CODECS:
+            return web.json_response({"status": "Failure", "message": f"Unknown codec {codec}."})
+        message = CompressedBatch(message, codec)
+    # clients producing directly send the leader epoch of their metadata
+    if 'leader_epoch' in dict and broker.stale_epoch(topic, partition_id, dict['leader_epoch']):
+        return web.json_response(stale_epoch(topic, partition_id))
+    status = await broker.enqueue(message=message, topic=topic, partition_id=partition_id)
+    response = {}
+
+    if status >= 0:
+        response["status"] = "Success"
+        response["offset"] = status
+    else:
+        response["status"] = "Failure"
+
+    return web.json_response(response)
+
+
+@routes.post("/producer/produce_batch")
+async def enqueue_batch(request):
+    broker = request.app["broker"]
+    dict = await request.json()
+    response = {}
+    if any(entry.get('codec') not in CODECS + [None] for entry in dict['messages']):
+        response["status"] = "Failure"
+        response["message"] = "Unknown codec."
+        return web.json_response(response)
+    try:
+        messages = [(entry['topic_name'], int(entry['partition_id']),
+                     entry['message'] if entry.get('codec') is None else CompressedBatch(entry['message'], entry['codec']))
+                    for entry in dict['messages']]
+    except (TypeError, ValueError):
+        response["status"] = "Failure"
+        response["message"] = "Invalid partition_id."
+        return web.json_response(response)
+    if len(messages) == 0:
+        response["status"] = "Failure"
+        response["message"] = "Empty batch."
+        return web.json_response(response)
+
+    status = await broker.enqueue_batch(messages)
+    if status == -1:
+        response["status"] = "Failure"
+        response["message"] = "Batch could not be added."
+    else:
+        response["status"] = "Success"
+        response["offsets"] = [{"topic_name": topic, "partition_id": partition_id,
+                                "base_offset": base_offset, "last_offset": last_offset}
+                               for topic, partition_id, base_offset, last_offset in status]
+
+    return web.json_response(response)
+
+
+@routes.get("/consumer/consume")
+async def dequeue(request):
+    broker = request.app["broker"]
+    dict = await request.json()
+    topic = (dict['topic_name'])
+    consumer_id = str(dict['consumer_id'])
+    partition_id = (dict['partition_id'])
+    offset = (dict['offset'])
+    max_wait_ms = dict.get('max_wait_ms', 0)
+    if 'leader_epoch' in dict and broker.stale_epoch(topic, partition_id, dict['leader_epoch']):
+        return web.json_response(stale_epoch(topic, partition_id))
+    if 'max_messages' in dict or 'max_bytes' in dict:
+        return web.json_response(await fetch(
+            broker, topic, consumer_id, partition_id, offset,
+            dict.get('max_messages', FETCH_MAX_MESSAGES), dict.get('max_bytes', FETCH_MAX_BYTES), max_wait_ms))
+    status = await broker.dequeue(topic_name=topic, partition_id=partition_id, offset=offset,
+                                  max_wait_ms=max_wait_ms)
+    response = {}
+
+    if isinstance(status, str):
+        response["status"] = "Success"
+        response["message"] = status
+        if codec_of(status) is not None:
+            response["codec"] = codec_of(status)
+    else:
+        response["status"] = "Failure"
+        if status == -1:
+            response["message"] = f"Topic {topic} does not exist."
+        elif status == -2:
+            response["message"] = f"No more messages for {consumer_id}"
+        elif status == -4:
+            response["message"] = f"Offset {offset} was removed by retention."
+            response["log_start_offset"] = await broker.start_offset(topic, partition_id)
+
+    return web.json_response(response)
+
+
+def stale_epoch(topic, partition_id):
+    # the client's metadata is outdated, it fetches /cluster/metadata again
+    return {"status": "Failure", "message": f"Leader epoch of topic {topic}, partition {partition_id} is stale.",
+            "stale_epoch": True}
+
+
+async def fetch(broker, topic, consumer_id, partition_id, offset, max_messages, max_bytes, max_wait_ms):
+    # fetch mode of /consumer/consume, returns a contiguous run of messages
+    status = await broker.fetch(topic_name=topic, partition_id=partition_id, offset=offset,
+                                max_messages=max_messages, max_bytes=max_bytes, max_wait_ms=max_wait_ms)
+    response = {}
+
+    if status == -1:
+        response["status"] = "Failure"
+        response["message"] = f"Topic {topic} does not exist."
+        return response
+    if status == -4:
+        response["status"] = "Failure"
+        response["message"] = f"Offset {offset} was removed by retention."
+        response["log_start_offset"] = await broker.start_offset(topic, partition_id)
+        return response
+
+    messages, high_watermark = status
+    response["high_watermark"] = high_watermark
+    if len(messages) > 0:
+        response["status"] = "Success"
+        response["messages"] = messages
+        if any(codec_of(message) is not None for message in messages):
+            response["codecs"] = [codec_of(message) for message in messages]
+        response["offset"] = offset
+        response["next_offset"] = offset + len(messages)
+    else:
+        response["status"] = "Failure"
+        response["message"] = f"No more messages for {consumer_id}"
+
+    return response
+
+
+@routes.get("/consumer/subscribe")
+async def subscribe(request):
+    broker = request.app["broker"]
+    topic = request.query['topic_name']
+    partition_id = int(request.query['partition_id'])
+    if not await broker.topic_exists(topic, partition_id):
+        return web.json_response({"status": "Failure", "message": f"Topic {topic} does not exist."})
+    offset = request.headers.get('Last-Event-ID', request.query.get('offset'))
+    offset = int(offset) if offset is not None else await broker.high_watermark(topic, partition_id)
+    max_messages = int(request.query.get('max_messages', SUBSCRIBE_MAX_MESSAGES))
+    max_bytes = int(request.query.get('max_bytes', SUBSCRIBE_MAX_BYTES))
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                           "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+    try:
+        async for event in broker.tail(topic, partition_id, offset, max_messages, max_bytes):
+            # waits while the subscriber's connection is backed up
+            await response.write(event.encode())
+    except ConnectionResetError:
+        pass
+    return response
+
+
+@routes.get("/offsets/time")
+async def offset_for_time(request):
+    broker = request.app["broker"]
+    dict = await request.json()
+    topic = dict['topic_name']
+    partition_id = dict['partition_id']
+    timestamp = dict['timestamp']
+
+    status = await broker.offset_for_time(topic_name=topic, partition_id=partition_id, timestamp_ms=timestamp)
+    response = {}
+
+    if status >= 0:
+        response["status"] = "Success"
+        response["offset"] = status
+    else:
+        response["status"] = "Failure"
+        response["message"] = f"Topic {topic} does not exist."
+
+    return web.json_response(response)
+
+
+@routes.route("*", "/topics/retention")
+async def retention(request):
+    metadata = request.app["metadata"]
+    if request.method == "POST":
+        dict = await request.json()
+        topic = dict['topic_name']
+        status = await metadata.set_policy(topic, dict.get('max_age_ms'), dict.get('max_bytes'),
+                                           dict.get('max_messages'))
+        response = {}
+        if status == -1:
+            response["status"] = "Failure"
+            response["message"] = f"Retention policy for topic {topic} could not be set."
+        else:
+            response["status"] = "Success"
+        return web.json_response(response)
+
+    policies = await metadata.get_policies()
+    return web.json_response(
+        {"status": "Success",
+         "policies": {topic: {"max_age_ms": max_age_ms, "max_bytes": max_bytes, "max_messages": max_messages}
+                      for topic, (max_age_ms, max_bytes, max_messages) in policies.items()}})
+
+
+@routes.get("/stats/cache")
+async def cache_stats(request):
+    broker = request.app["broker"]
+    if broker.cache is None:
+        return web.json_response({"status": "Failure", "message": "Tail cache is disabled."})
+    return web.json_response({"status": "Success", "cache": broker.cache.stats()})
+
+
+@routes.get("/stats/group_commit")
+async def group_commit_stats(request):
+    # concurrent appends already share the connection pool, there is no writer thread to report on
+    return web.json_response({"status": "Failure", "message": "Group commit is disabled."})
+
+
+@routes.get("/size")
+async def size(request):
+    broker = request.app["broker"]
+    dict = await request.json()
+    topic = (dict['topic_name'])
+    partition_id = (dict['partition_id'])
+    offset = (dict['offset'])
+
+    status = await broker.size(topic_name=topic, partition_id=partition_id, offset=offset)
+    response = {}
+
+    if status >= 0:
+        response["status"] = "Success"
+        response["size"] = status
+    else:
+        response["status"] = "Failure"
+        if status == -1:
+            response["message"] = f"Topic {topic} does not exist."
+        elif status == -2:
+            response["message"] = f"No message in topic {topic}."
+
+    return web.json_response(response)
+
+
+async def register(session, mIP, mPort, p):
+    send_url = f"http://{mIP}:{mPort}/broker/register"
+    data = {
+        "port": p
+    }
+    try:
+        async with session.post(send_url, json=data) as r:
+            r.raise_for_status()
+            response = await r.json()
+        if response["status"] == "Success":
+            print("Registered successfully")
+            return response["broker_id"]
+        else:
+            print(f"Failed, {response['message']}")
+            return -1
+    except aiohttp.ClientResponseError as errh:
+        print("Http Error:", errh)
+        return -1
+    except aiohttp.ClientConnectionError as errc:
+        print("Error Connecting:", errc)
+        return -1
+
+
+def cmdline_args():
+    # the options of BrokerWrapper.py, except --workers, --threads and those of the
+    # thread based group commit, plus --db-pool-size
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", help="port number",
+                        type=int, default=5000)
+    parser.add_argument("-mIP", "--managerIP",
+                        help="write manager IP address", type=str, default="write_manager")
+    parser.add_argument("-mPort", "--managerPort",
+                        help="write manager port number", type=int, default=5000)
+    parser.add_argument("--storage", help="storage engine for messages", choices=STORAGE_ENGINES,
+                        type=str, default=os.getenv('STORAGE_ENGINE', 'postgres'))
+    parser.add_argument("--log-dir", help="segment directory for the segment storage engine",
+                        type=str, default=os.getenv('LOG_DIR', 'broker_log'))
+    parser.add_argument("--segment-bytes", help="roll segments once they reach this size",
+                        type=int, default=SEGMENT_BYTES)
+    parser.add_argument("--segment-fsync", help="fsync segment files on every append",
+                        action="store_true")
+    parser.add_argument("--cache-messages", help="messages cached per partition, 0 disables the tail cache",
+                        type=int, default=PARTITION_MAX_MESSAGES)
+    parser.add_argument("--cache-bytes", help="memory limit of the tail cache",
+                        type=int, default=CACHE_MAX_BYTES)
+    parser.add_argument("--retention-ms", help="default maximum message age, unlimited if not set",
+                        type=int, default=None)
+    parser.add_argument("--retention-bytes", help="default maximum bytes per partition, unlimited if not set",
+                        type=int, default=None)
+    parser.add_argument("--retention-messages", help="default maximum messages per partition, unlimited if not set",
+                        type=int, default=None)
+    parser.add_argument("--retention-check-ms", help="interval between retention passes",
+                        type=int, default=RETENTION_CHECK_MS)
+    parser.add_argument("--listen-notify", help="wake long polls on appends by other broker processes "
+                        "sharing the database (Postgres LISTEN/NOTIFY)", action="store_true")
+    parser.add_argument("--db-pool-size", help="database connections shared by all requests",
+                        type=int, default=int(os.getenv('DB_POOL_SIZE', DB_POOL_SIZE)))
+    return parser.parse_args()
+
+
+@web.middleware
+async def count_requests(request, handler):
+    # requests in flight for the load report, streams count until they end
+    stats = request.app["broker"].stats
+    stats.request_started()
+    try:
+        return await handler(request)
+    finally:
+        stats.request_finished()
+
+
+async def start(app):
+    # startup of BrokerWrapper.py: schema, catalog, registration, background tasks
+    args = app["args"]
+    db_engine = create_async_engine(db_url, pool_size=args.db_pool_size, max_overflow=0)
+    app["db_engine"] = db_engine
+    if args.storage == "segment":
+        storage = get_async_storage(args.storage, db_engine, log_dir=args.log_dir,
+                                    segment_bytes=args.segment_bytes, fsync=args.segment_fsync)
+    else:
+        storage = get_async_storage(args.storage, db_engine)
+    cache = TailCache(args.cache_messages, args.cache_bytes) if args.cache_messages > 0 else None
+    broker = AsyncLoggingQueue(storage, cache=cache)
+    metadata = AsyncMetadata(db_engine)
+    app["broker"] = broker
+    app["metadata"] = metadata
+    print(f"Using the {args.storage} storage engine.")
+
+    await storage.prepare()
+    await metadata.prepare()
+    await broker.load_catalog()
+
+    broker_id = await metadata.get_id()
+    if broker_id == -1:
+        hostname = socket.gethostname()
+        ip_address = socket.gethostbyname(hostname)
+        print(f"IP Address: {ip_address}, Port: {args.port}")
+
+        # keep on trying to connect to manager
+        async with aiohttp.ClientSession() as session:
+            while True:
+                response = await register(session, args.managerIP, args.managerPort, args.port)
+                if response != -1:
+                    broker_id = response
+                    await metadata.create_id(broker_id)
+                    break
+                await asyncio.sleep(randint(1, 3)/100)
+
+    tasks = [asyncio.create_task(broker.heartbeat(args.managerIP, args.managerPort, broker_id, args.port)),
+             asyncio.create_task(broker.enforce_retention(
+                 metadata, (args.retention_ms, args.retention_bytes, args.retention_messages),
+                 args.retention_check_ms))]
+    if args.listen_notify:
+        broker.notifier.enable_notify(publish_notify(db_engine))
+        tasks.append(asyncio.create_task(listen_notify(broker.notifier, db_dsn)))
+    app["tasks"] = tasks
+
+
+async def stop(app):
+    for task in app["tasks"]:
+        task.cancel()
+    await app["db_engine"].dispose()
+
+
+if __name__ == '__main__':
+    args = cmdline_args()
+    app = web.Application(middlewares=[count_requests])
+    app["args"] = args
+    app.add_routes(routes)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    web.run_app(app, host='0.0.0.0', port=args.port)
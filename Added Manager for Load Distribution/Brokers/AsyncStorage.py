@@ -0,0 +1,376 @@
+# Non-blocking storage engines for the asyncio broker server (AsyncBrokerWrapper.py)
+# Same engines and return values as Storage.py, but every method is a coroutine.
+# Statements are built from the BrokerModels tables, so a database can be
+# served by either server. The segment engine does local file I/O only and
+# runs in worker threads.
+import asyncio
+from datetime import timedelta
+from time import monotonic
+from typing import List, Tuple
+from sqlalchemy import select, insert, update, delete, func, text, cast, DateTime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from BrokerModels import (db, ID, TopicName, TopicMessage, PartitionMessage, RetentionPolicy, TimeIndex,
+                          INSERT_CHUNK, PARTITION_KEYS)
+from Storage import TIME_INDEX_INTERVAL_MS
+from Codec import CODECS, CompressedBatch, codec_of, codec_id, from_codec_id
+
+topics = TopicName.__table__
+time_index = TimeIndex.__table__
+
+
+class AsyncDatabaseStorage:
+    """Stores topics and messages in "TopicMessage" rows, like DatabaseStorage."""
+
+    table = TopicMessage.__table__
+    table_bytes_sql = TopicMessage.TABLE_BYTES_SQL
+
+    def __init__(self, engine, time_index_interval_ms: int = TIME_INDEX_INTERVAL_MS) -> None:
+        # engine: sqlalchemy AsyncEngine (postgresql+asyncpg)
+        self.engine = engine
+        self.time_index_interval = time_index_interval_ms / 1000
+        self.indexed_at = {}
+
+    async def prepare(self) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(text(TopicMessage.OFFSET_DDL))
+            await conn.execute(text(TopicName.HIGH_WATERMARK_DDL))
+            await conn.execute(text(TopicName.START_OFFSET_DDL))
+            await conn.execute(text(TopicMessage.CODEC_DDL))
+            await conn.execute(text(TopicMessage.TIMESTAMP_DDL))
+            await conn.execute(text(TopicName.PARTITION_KEY_DDL))
+            await conn.run_sync(db.metadata.create_all)
+
+    def in_partition(self, topic_name: str, partition_id: int, partition_key: int):
+        return (self.table.c.topic_name == topic_name, self.table.c.partition_id == partition_id)
+
+    def row(self, topic_name: str, partition_id: int, partition_key: int, offset: int, message: str) -> dict:
+        return {"topic_name": topic_name, "partition_id": partition_id, "offset": offset,
+                "codec": codec_of(message), "message": message}
+
+    def message(self, row) -> str:
+        return row.message if row.codec is None else CompressedBatch(row.message, row.codec)
+
+    async def partition_key(self, conn, topic_name: str, partition_id: int) -> int:
+        key = (topic_name, int(partition_id))
+        if key not in PARTITION_KEYS:
+            partition_key = (await conn.execute(select(topics.c.partition_key).where(
+                topics.c.topic_name == topic_name, topics.c.partition_id == partition_id))).scalar()
+            if partition_key is None:
+                return None
+            PARTITION_KEYS[key] = partition_key
+        return PARTITION_KEYS[key]
+
+    async def check_topic(self, topic_name: str, partition_id: int) -> bool:
+        async with self.engine.connect() as conn:
+            return await self.partition_key(conn, topic_name, partition_id) is not None
+
+    async def create_topic(self, topic_name: str, partition_id: int):
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(pg_insert(topics).values(
+                    topic_name=topic_name, partition_id=partition_id, next_offset=0, start_offset=0
+                ).on_conflict_do_nothing())
+        except Exception as e:
+            print(e)
+            return -1
+
+    async def list_topics(self) -> List[Tuple[str, int]]:
+        async with self.engine.connect() as conn:
+            return [(row.topic_name, row.partition_id)
+                    for row in await conn.execute(select(topics.c.topic_name, topics.c.partition_id))]
+
+    async def reserve(self, conn, topic_name: str, partition_id: int, count: int) -> Tuple[int, int]:
+        # (partition_key, first reserved offset), see TopicName.reserveKeyedOffsets
+        row = (await conn.execute(
+            update(topics)
+            .where(topics.c.topic_name == topic_name, topics.c.partition_id == partition_id)
+            .values(next_offset=topics.c.next_offset + count)
+            .returning(topics.c.partition_key, topics.c.next_offset))).first()
+        return row.partition_key, row.next_offset - count
+
+    async def append(self, topic_name: str, partition_id: int, message: str) -> int:
+        try:
+            async with self.engine.begin() as conn:
+                partition_key, offset = await self.reserve(conn, topic_name, partition_id, 1)
+                await conn.execute(insert(self.table).values(
+                    self.row(topic_name, partition_id, partition_key, offset, message)))
+        except Exception as e:
+            print(e)
+            return -1
+        await self.index_time(topic_name, partition_id, offset)
+        return offset
+
+    async def append_batch(self, messages: List[Tuple[str, int, str]]):
+        partitions = {}
+        for topic_name, partition_id, message in messages:
+            partitions.setdefault((topic_name, int(partition_id)), []).append(message)
+
+        rows = []
+        ranges = []
+        try:
+            async with self.engine.begin() as conn:
+                # partitions are locked in a fixed order so concurrent batches cannot deadlock
+                for (topic_name, partition_id) in sorted(partitions):
+                    batch = partitions[(topic_name, partition_id)]
+                    partition_key, base_offset = await self.reserve(conn, topic_name, partition_id, len(batch))
+                    rows.extend(self.row(topic_name, partition_id, partition_key, base_offset + i, message)
+                                for i, message in enumerate(batch))
+                    ranges.append((topic_name, partition_id, base_offset, base_offset + len(batch) - 1))
+                for i in range(0, len(rows), INSERT_CHUNK):
+                    await conn.execute(insert(self.table).values(rows[i:i + INSERT_CHUNK]))
+        except Exception as e:
+            print(e)
+            return -1
+        for topic_name, partition_id, _, last_offset in ranges:
+            await self.index_time(topic_name, partition_id, last_offset)
+        return ranges
+
+    async def index_time(self, topic_name: str, partition_id: int, offset: int) -> None:
+        # see DatabaseStorage.index_time
+        key = (topic_name, int(partition_id))
+        now = monotonic()
+        if key in self.indexed_at and now - self.indexed_at[key] < self.time_index_interval:
+            return
+        self.indexed_at[key] = now
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(insert(time_index).values(
+                    topic_name=topic_name, partition_id=partition_id, offset=offset))
+        except Exception as e:
+            print(e)
+
+    async def offset_for_time(self, topic_name: str, partition_id: int, timestamp_ms: int) -> int:
+        # see DatabaseStorage.offset_for_time
+        timestamp = cast(func.to_timestamp(timestamp_ms / 1000), DateTime)
+        async with self.engine.connect() as conn:
+            topic = (await conn.execute(select(topics).where(
+                topics.c.topic_name == topic_name, topics.c.partition_id == partition_id))).first()
+            floor = (await conn.execute(select(func.max(time_index.c.offset)).where(
+                time_index.c.topic_name == topic_name, time_index.c.partition_id == partition_id,
+                time_index.c.timestamp < timestamp))).scalar()
+            from_offset = topic.start_offset if floor is None else max(floor, topic.start_offset)
+            offset = (await conn.execute(select(self.table.c.offset).where(
+                *self.in_partition(topic_name, partition_id, topic.partition_key),
+                self.table.c.offset >= from_offset,
+                self.table.c.timestamp >= timestamp).order_by(self.table.c.offset).limit(1))).scalar()
+        return topic.next_offset if offset is None else offset
+
+    async def read(self, topic_name: str, partition_id: int, offset: int):
+        async with self.engine.connect() as conn:
+            partition_key = await self.partition_key(conn, topic_name, partition_id)
+            row = (await conn.execute(select(self.table.c.codec, self.table.c.message).where(
+                *self.in_partition(topic_name, partition_id, partition_key),
+                self.table.c.offset == offset))).first()
+        if row is None:
+            return -1
+        return self.message(row)
+
+    async def read_range(self, topic_name: str, partition_id: int, offset: int, max_messages: int, max_bytes: int) -> List[str]:
+        async with self.engine.connect() as conn:
+            partition_key = await self.partition_key(conn, topic_name, partition_id)
+            rows = (await conn.execute(
+                select(self.table.c.offset, self.table.c.codec, self.table.c.message).where(
+                    *self.in_partition(topic_name, partition_id, partition_key),
+                    self.table.c.offset >= offset,
+                    self.table.c.offset < offset + max_messages).order_by(self.table.c.offset))).all()
+        messages = []
+        total_bytes = 0
+        if rows and rows[0].offset != offset:
+            # offset was removed by retention
+            return messages
+        for row in rows:
+            total_bytes += len(row.message)
+            if messages and total_bytes > max_bytes:
+                break
+            messages.append(self.message(row))
+        return messages
+
+    async def high_watermark(self, topic_name: str, partition_id: int) -> int:
+        async with self.engine.connect() as conn:
+            return (await conn.execute(select(topics.c.next_offset).where(
+                topics.c.topic_name == topic_name, topics.c.partition_id == partition_id))).scalar()
+
+    async def start_offset(self, topic_name: str, partition_id: int) -> int:
+        async with self.engine.connect() as conn:
+            return (await conn.execute(select(topics.c.start_offset).where(
+                topics.c.topic_name == topic_name, topics.c.partition_id == partition_id))).scalar()
+
+    async def size(self, topic_name: str, partition_id: int, offset: int) -> int:
+        return await self.high_watermark(topic_name, partition_id) - offset
+
+    async def usage(self):
+        # see DatabaseStorage.usage
+        async with self.engine.connect() as conn:
+            counts = (await conn.execute(select(
+                topics.c.topic_name, topics.c.partition_id, topics.c.next_offset - topics.c.start_offset,
+                topics.c.next_offset))).all()
+            table_bytes = (await conn.execute(text(self.table_bytes_sql))).scalar()
+            database_bytes = (await conn.execute(text(TopicName.DATABASE_BYTES_SQL))).scalar()
+        total = sum(messages for _, _, messages, _ in counts)
+        usage = {(topic_name, partition_id): (messages, table_bytes * messages // total if total else 0, high_watermark)
+                 for topic_name, partition_id, messages, high_watermark in counts}
+        return usage, database_bytes
+
+    async def trim(self, topic_name: str, partition_id: int, max_age_ms=None, max_bytes=None, max_messages=None) -> int:
+        # retentionOffset and trimPartition of BrokerModels in one transaction
+        try:
+            async with self.engine.begin() as conn:
+                topic = (await conn.execute(select(topics).where(
+                    topics.c.topic_name == topic_name, topics.c.partition_id == partition_id))).first()
+                in_partition = self.in_partition(topic_name, partition_id, topic.partition_key)
+                keep_from = topic.start_offset
+                if max_messages is not None:
+                    keep_from = max(keep_from, topic.next_offset - max_messages)
+                if max_age_ms is not None:
+                    first_kept = (await conn.execute(select(func.min(self.table.c.offset)).where(
+                        *in_partition,
+                        self.table.c.timestamp >= func.now() - timedelta(milliseconds=max_age_ms)))).scalar()
+                    keep_from = max(keep_from, topic.next_offset if first_kept is None else first_kept)
+                if max_bytes is not None:
+                    tail = select(
+                        self.table.c.offset.label("offset"),
+                        func.sum(func.octet_length(self.table.c.message)).over(
+                            order_by=self.table.c.offset.desc()).label("tail_bytes")).where(*in_partition).subquery()
+                    last_dropped = (await conn.execute(
+                        select(func.max(tail.c.offset)).where(tail.c.tail_bytes > max_bytes))).scalar()
+                    if last_dropped is not None:
+                        keep_from = max(keep_from, last_dropped + 1)
+                if keep_from <= topic.start_offset:
+                    return 0
+                removed = (await conn.execute(delete(self.table).where(
+                    *in_partition, self.table.c.offset < keep_from))).rowcount
+                await conn.execute(update(topics).where(
+                    topics.c.topic_name == topic_name, topics.c.partition_id == partition_id
+                ).values(start_offset=keep_from))
+                await conn.execute(delete(time_index).where(
+                    time_index.c.topic_name == topic_name, time_index.c.partition_id == partition_id,
+                    time_index.c.offset < keep_from))
+        except Exception as e:
+            print(e)
+            return -1
+        return removed
+
+
+class AsyncPartitionedDatabaseStorage(AsyncDatabaseStorage):
+    """Like AsyncDatabaseStorage, with one child table of "TopicMessage" per topic partition."""
+
+    async def prepare(self) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(text(TopicMessage.OFFSET_DDL))
+            await conn.execute(text(TopicName.HIGH_WATERMARK_DDL))
+            await conn.execute(text(TopicName.START_OFFSET_DDL))
+            await conn.execute(text(TopicMessage.CODEC_DDL))
+            await conn.execute(text(TopicMessage.TIMESTAMP_DDL))
+            await conn.execute(text(TopicName.PARTITION_KEY_DDL))
+            kind = (await conn.execute(text(
+                '''SELECT relkind FROM pg_class WHERE relname = 'TopicMessage' AND relnamespace = 'public'::regnamespace'''))).scalar()
+            if kind is not None and kind != 'p':
+                raise RuntimeError('"TopicMessage" already exists as a plain table, it cannot be used in partitioned mode')
+            await conn.execute(text(TopicMessage.PARTITIONED_DDL))
+            await conn.run_sync(db.metadata.create_all)
+        for topic_name, partition_id in await self.list_topics():
+            async with self.engine.begin() as conn:
+                await conn.execute(text(TopicMessage.partitionDDL(topic_name, partition_id)))
+
+    async def create_topic(self, topic_name: str, partition_id: int):
+        # the child table first, so appends never see a partition without one
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(text(TopicMessage.partitionDDL(topic_name, partition_id)))
+        except Exception as e:
+            print(e)
+            return -1
+        return await super().create_topic(topic_name, partition_id)
+
+
+class AsyncCompactDatabaseStorage(AsyncDatabaseStorage):
+    """Like AsyncDatabaseStorage, with messages in the compact "PartitionMessage" table."""
+
+    table = PartitionMessage.__table__
+    table_bytes_sql = PartitionMessage.TABLE_BYTES_SQL
+
+    async def prepare(self) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(text(TopicMessage.OFFSET_DDL))
+            await conn.execute(text(TopicName.HIGH_WATERMARK_DDL))
+            await conn.execute(text(TopicName.START_OFFSET_DDL))
+            await conn.execute(text(TopicMessage.CODEC_DDL))
+            await conn.execute(text(TopicMessage.TIMESTAMP_DDL))
+            await conn.execute(text(TopicName.PARTITION_KEY_DDL))
+            await conn.execute(text(PartitionMessage.COMPACT_DDL))
+            await conn.run_sync(db.metadata.create_all)
+            if (await conn.execute(text('''SELECT EXISTS (SELECT 1 FROM "TopicMessage")'''))).scalar():
+                moved = (await conn.execute(text(PartitionMessage.MIGRATE_SQL), {"codecs": CODECS})).rowcount
+                await conn.execute(text('''TRUNCATE "TopicMessage"'''))
+                print(f"Moved {moved} messages from TopicMessage to PartitionMessage.")
+
+    def in_partition(self, topic_name: str, partition_id: int, partition_key: int):
+        return (self.table.c.partition_key == partition_key,)
+
+    def row(self, topic_name: str, partition_id: int, partition_key: int, offset: int, message: str) -> dict:
+        return {"offset": offset, "partition_key": partition_key,
+                "codec": codec_id(message), "message": message.encode()}
+
+    def message(self, row) -> str:
+        return from_codec_id(bytes(row.message).decode(), row.codec)
+
+
+class AsyncSegmentStorage:
+    """Runs the methods of a SegmentStorage in worker threads."""
+
+    def __init__(self, storage) -> None:
+        self.storage = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+
+class AsyncMetadata:
+    """Broker id and retention policies, kept in the database whatever the storage engine."""
+
+    def __init__(self, engine) -> None:
+        self.engine = engine
+
+    async def prepare(self) -> None:
+        # db.create_all(), after the storage engine created its tables
+        async with self.engine.begin() as conn:
+            await conn.run_sync(db.metadata.create_all)
+
+    async def get_id(self) -> int:
+        async with self.engine.connect() as conn:
+            broker_id = (await conn.execute(select(ID.__table__.c.broker_id))).scalar()
+        return -1 if broker_id is None else broker_id
+
+    async def create_id(self, broker_id: int) -> None:
+        async with self.engine.begin() as conn:
+            await conn.execute(insert(ID.__table__).values(broker_id=broker_id))
+
+    async def set_policy(self, topic_name: str, max_age_ms, max_bytes, max_messages):
+        values = {"max_age_ms": max_age_ms, "max_bytes": max_bytes, "max_messages": max_messages}
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(pg_insert(RetentionPolicy.__table__).values(topic_name=topic_name, **values)
+                                   .on_conflict_do_update(index_elements=["topic_name"], set_=values))
+        except Exception as e:
+            print(e)
+            return -1
+
+    async def get_policies(self) -> dict:
+        async with self.engine.connect() as conn:
+            return {row.topic_name: (row.max_age_ms, row.max_bytes, row.max_messages)
+                    for row in await conn.execute(select(RetentionPolicy.__table__))}
+
+
+def get_async_storage(engine: str, db_engine, **kwargs):
+    if engine == "postgres-partitioned":
+        return AsyncPartitionedDatabaseStorage(db_engine)
+    if engine == "postgres-compact":
+        return AsyncCompactDatabaseStorage(db_engine)
+    if engine == "segment":
+        from SegmentLog import SegmentStorage
+        return AsyncSegmentStorage(SegmentStorage(**kwargs))
+    return AsyncDatabaseStorage(db_engine)
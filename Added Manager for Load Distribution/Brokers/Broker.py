@@ -4,35 +4,126 @@ import threading
 import uuid
 from typing import Dict, List, Tuple, Set
 from concurrent.futures import ThreadPoolExecutor
-from BrokerModels import db, TopicName, TopicMessage
+from BrokerModels import db
+from Storage import DatabaseStorage
+from TailCache import TailCache
+from GroupCommit import GroupCommitter
+from LongPoll import AppendNotifier, MAX_WAIT_MS
 import requests
-from time import sleep
+from time import sleep, monotonic, perf_counter
+from contextlib import nullcontext
+from LoadStats import LoadStats, HEARTBEAT_MS, HEARTBEAT_TIMEOUT
 # TODO: define enum for success and failure codes
 
+# defaults for batch fetches on the consume path
+FETCH_MAX_MESSAGES = 500
+FETCH_MAX_BYTES = 1 << 20
+
 
 class LoggingQueue:
-    def __init__(self):
-        pass
+    def __init__(self, storage=None, cache: TailCache = None):
+        # storage engine, see Storage.py
+        self.storage = storage if storage is not None else DatabaseStorage()
+        # newest messages per partition, None disables the cache
+        self.cache = cache
+        # (topic, partition) pairs known to exist, topics are never deleted so a
+        # hit is always correct and a miss falls back to the storage engine
+        self.catalog: Set[Tuple[str, int]] = set()
+        self.catalog_lock = threading.Lock()
+        # set by enable_group_commit, None appends every message on its own
+        self.group_commit = None
+        # wakes consume requests parked on an empty partition
+        self.notifier = AppendNotifier()
+        self.notifier.on_truncate = self.evict
+        # load reported with every heartbeat
+        self.stats = LoadStats()
+        # (topic, partition) -> (leader epoch, led here), from the write manager's heartbeat replies
+        self.leadership: Dict[Tuple[str, int], Tuple[int, bool]] = {}
+
+    def enable_group_commit(self, linger_ms: float, max_group_size: int, context=None) -> None:
+        self.group_commit = GroupCommitter(self.append_batch, linger_ms=linger_ms,
+                                           max_group_size=max_group_size, context=context)
+
+    def load_catalog(self) -> None:
+        # called once at startup
+        with self.catalog_lock:
+            self.catalog.update((topic_name, int(partition_id))
+                                for topic_name, partition_id in self.storage.list_topics())
+        print(f"Loaded {len(self.catalog)} partitions into the catalog.")
+
+    def topic_exists(self, topic_name: str, partition_id: int) -> bool:
+        key = (topic_name, int(partition_id))
+        if key in self.catalog:
+            return True
+        # created by another process since startup
+        if self.storage.check_topic(topic_name=topic_name, partition_id=partition_id):
+            with self.catalog_lock:
+                self.catalog.add(key)
+            return True
+        return False
 
-    def heartbeat(self, ip: str, port: int, broker_id, self_port) -> None:
+    def ensure_topic(self, topic_name: str, partition_id: int) -> bool:
+        # creates the partition if needed, returns True if it was created here
+        if self.topic_exists(topic_name, partition_id):
+            return False
+        self.storage.create_topic(topic_name=topic_name, partition_id=partition_id)
+        with self.catalog_lock:
+            self.catalog.add((topic_name, int(partition_id)))
+        return True
+
+    def heartbeat(self, ip: str, port: int, broker_id, self_port, context=None) -> None:
         data = {"broker_id": broker_id, "port": self_port}
         send_url = f"http://{ip}:{port}/broker/receive_beat"
+        # one kept-alive connection for all beats
+        session = requests.Session()
 
         while True:
+            data["load"] = self.load_report(context)
             try:
-                r = requests.post(send_url, json=data)
+                r = session.post(send_url, json=data, timeout=HEARTBEAT_TIMEOUT)
                 # print("sending beat")
                 r.raise_for_status()
+                self.update_leadership(r.json().get("leading", []))
             except requests.exceptions.HTTPError as errh:
                 print("Http Error:", errh)
             except requests.exceptions.ConnectionError as errc:
                 print("Error Connecting:", errc)
-            sleep(1)
+            except requests.exceptions.Timeout as errt:
+                print("Timeout Error:", errt)
+            sleep(HEARTBEAT_MS / 1000)
+
+    def update_leadership(self, leading) -> None:
+        # leading: [topic, partition_id, leader epoch] of the partitions this broker leads
+        leadership = {(topic_name, int(partition_id)): (leader_epoch, True)
+                      for topic_name, partition_id, leader_epoch in leading}
+        for key, (leader_epoch, led) in self.leadership.items():
+            if key not in leadership:
+                # led by another broker now, or still here until a newer epoch shows up
+                leadership[key] = (leader_epoch, False)
+        self.leadership = leadership
+
+    def stale_epoch(self, topic_name: str, partition_id: int, leader_epoch: int) -> bool:
+        # True if a client routed here with leader_epoch has outdated metadata: the partition
+        # has a newer leader epoch, or is no longer led by this broker
+        known = self.leadership.get((topic_name, int(partition_id)))
+        if known is None:
+            # never led here as far as this process knows, e.g. created since the last heartbeat
+            return False
+        known_epoch, led = known
+        return leader_epoch < known_epoch if led else leader_epoch <= known_epoch
+
+    def load_report(self, context=None) -> dict:
+        # this process' load since the previous report, with the partitions' sizes
+        usage, disk_bytes = None, None
+        try:
+            with (context if context is not None else nullcontext)():
+                usage, disk_bytes = self.storage.usage()
+        except Exception as e:
+            print("Usage Error:", e)
+        return self.stats.snapshot(usage, disk_bytes)
 
     def create_topic(self, topic_name: str, partition_id) -> None:
-        if not TopicName.CheckTopic(topic_name=topic_name, partition_id=partition_id):
-            TopicName.CreateTopic(topic_name=topic_name,
-                                  partition_id=partition_id)
+        if self.ensure_topic(topic_name, partition_id):
             print(f"Topic {topic_name} with partition {partition_id} created.")
             return 1
         else:
@@ -41,49 +132,216 @@ class LoggingQueue:
             return -1
 
     def list_topics(self) -> List[Tuple[str, str]]:
-        topic_part_list = TopicName.ListTopics()
+        topic_part_list = self.storage.list_topics()
         return topic_part_list
 
     def enqueue(self, message: str, topic: str, partition_id: int) -> int:
+        started = perf_counter()
         # check if (topic, partition_id) exists else create it
-        if not TopicName.CheckTopic(topic_name=topic, partition_id=partition_id):
-            TopicName.CreateTopic(topic_name=topic, partition_id=partition_id)
+        if self.ensure_topic(topic, partition_id):
             print(f"Topic {topic} with partition {partition_id} created.")
 
-        status = TopicMessage.addMessage(
-            topic_name=topic, partition_id=partition_id, message=message)
-        if status == 1:
+        # returns the offset assigned to the message
+        if self.group_commit is not None:
+            # the writer thread fills the cache in commit order
+            offset = self.group_commit.submit(topic, partition_id, message)
+        else:
+            offset = self.storage.append(
+                topic_name=topic, partition_id=partition_id, message=message)
+            if offset >= 0 and self.cache is not None:
+                self.cache.put(topic, partition_id, offset, [message])
+            if offset >= 0:
+                self.notifier.notify([(topic, partition_id)])
+                self.stats.appended(topic, partition_id, 1, len(message))
+        if offset >= 0:
+            self.stats.latency(perf_counter() - started)
             print(
-                f"Message '{message}' added to topic {topic} with partition {partition_id}.")
-            return 1
+                f"Message '{message}' added to topic {topic} with partition {partition_id} at offset {offset}.")
+            return offset
         else:
             print(
                 f"Message '{message}' could not be added to topic {topic} with partition {partition_id}.")
             return -1
 
-    def dequeue(self, topic_name: str, partition_id: int, offset: int, *args, **kwargs) -> str:
+    def enqueue_batch(self, messages: List[Tuple[str, int, str]]):
+        # messages: list of (topic, partition_id, message)
+        # returns [(topic, partition_id, base_offset, last_offset)] or -1
+        started = perf_counter()
+        for topic, partition_id in {(topic, partition_id) for topic, partition_id, _ in messages}:
+            if self.ensure_topic(topic, partition_id):
+                print(f"Topic {topic} with partition {partition_id} created.")
+
+        ranges = self.append_batch(messages)
+        if ranges == -1:
+            print(f"Batch of {len(messages)} messages could not be added.")
+            return -1
+        self.stats.latency(perf_counter() - started)
+        print(f"Batch of {len(messages)} messages added to {len(ranges)} partitions.")
+        return ranges
+
+    def append_batch(self, messages: List[Tuple[str, int, str]]):
+        # appends to partitions that already exist, shared by enqueue_batch and group commit
+        ranges = self.storage.append_batch(messages)
+        if ranges != -1 and self.cache is not None:
+            batches = {}
+            for topic, partition_id, message in messages:
+                batches.setdefault((topic, int(partition_id)), []).append(message)
+            for topic, partition_id, base_offset, _ in ranges:
+                self.cache.put(topic, partition_id, base_offset, batches[(topic, int(partition_id))])
+        if ranges != -1:
+            self.notifier.notify((topic, partition_id) for topic, partition_id, _, _ in ranges)
+            sizes = {}
+            for topic, partition_id, message in messages:
+                key = (topic, int(partition_id))
+                sizes[key] = sizes.get(key, 0) + len(message)
+            for topic, partition_id, base_offset, last_offset in ranges:
+                self.stats.appended(topic, partition_id, last_offset - base_offset + 1, sizes[(topic, int(partition_id))])
+        return ranges
+
+    def replicate(self, topic_name: str, partition_id: int, offset: int, messages: List[str], reset: bool = False) -> int:
+        # appends messages pushed by the partition's leader at exactly offset, see Replication.py
+        # returns the new high watermark, -2 if the log does not end at offset, -1 on failure
+        # reset: the leader no longer has the messages before offset, start over from there
+        self.ensure_topic(topic_name, partition_id)
+        high_watermark = self.high_watermark(topic_name, partition_id)
+        if offset < high_watermark or (reset and offset != high_watermark):
+            # past the leader's log, written by a former leader
+            high_watermark = self.truncate(topic_name, partition_id, offset)
+            if high_watermark != offset:
+                return -1 if high_watermark == -1 else -2
+        elif offset > high_watermark:
+            return -2
+        if not messages:
+            return high_watermark
+        ranges = self.append_batch([(topic_name, partition_id, message) for message in messages])
+        if ranges == -1:
+            return -1
+        return ranges[0][3] + 1
+
+    def truncate(self, topic_name: str, partition_id: int, offset: int) -> int:
+        # drops offset and everything after it (the segment engine may cut further back),
+        # returns the new high watermark or -1
+        high_watermark = self.storage.truncate(topic_name, partition_id, offset)
+        self.evict([(topic_name, partition_id)])
+        # the other workers' caches may hold the messages that were cut
+        self.notifier.truncated([(topic_name, partition_id)])
+        if high_watermark >= 0:
+            print(f"Truncated topic {topic_name} with partition {partition_id} to offset {high_watermark}.")
+        return high_watermark
+
+    def trimmed(self, partitions: List[Tuple[str, int]]) -> None:
+        # called after retention moved the start of partitions forward, cache hits skip
+        # the start offset check so no process may keep serving the removed messages
+        self.evict(partitions)
+        self.notifier.truncated(partitions)
+
+    def evict(self, partitions: List[Tuple[str, int]]) -> None:
+        # forgets cached messages of partitions that were cut back or trimmed
+        if self.cache is not None:
+            for topic_name, partition_id in partitions:
+                self.cache.evict(topic_name, partition_id)
+
+    def dequeue(self, topic_name: str, partition_id: int, offset: int, max_wait_ms: int = 0, *args, **kwargs) -> str:
+        # with max_wait_ms, an empty partition (-2) is retried whenever it is appended
+        # to until the wait runs out
+        deadline = monotonic() + min(max_wait_ms, MAX_WAIT_MS) / 1000
+        while True:
+            version = self.notifier.version(topic_name, partition_id)
+            started = perf_counter()
+            message = self.dequeue_once(topic_name, partition_id, offset)
+            self.stats.latency(perf_counter() - started)
+            if isinstance(message, str):
+                self.stats.fetched(topic_name, partition_id, 1)
+            if message != -2 or max_wait_ms <= 0:
+                return message
+            if not self.notifier.wait(topic_name, partition_id, version, deadline):
+                return message
+
+    def dequeue_once(self, topic_name: str, partition_id: int, offset: int) -> str:
+        # a cache hit implies the partition exists
+        if self.cache is not None:
+            cached = self.cache.get(topic_name, partition_id, offset)
+            if cached:
+                return cached[0]
 
-        if not TopicName.CheckTopic(topic_name=topic_name, partition_id=partition_id):
+        if not self.topic_exists(topic_name, partition_id):
             print(
                 f"Topic {topic_name} with partition {partition_id} does not exist.")
             return -1
 
-        message = TopicMessage.retrieveMessage(topic_name=topic_name, partition_id=partition_id,
-                                               offset=offset)
+        message = self.storage.read(topic_name=topic_name, partition_id=partition_id,
+                                    offset=offset)
         if (isinstance(message, str)):
             print(
                 f"Message '{message}' from topic {topic_name}, partition {partition_id}.")
             return message
+        elif offset < self.start_offset(topic_name, partition_id):
+            print(f"Offset {offset} was removed by retention.")
+            return -4
         elif message == -1:
             print(f"No message in queue!!!")
             return -2
 
+    def fetch(self, topic_name: str, partition_id: int, offset: int,
+              max_messages: int = FETCH_MAX_MESSAGES, max_bytes: int = FETCH_MAX_BYTES, max_wait_ms: int = 0):
+        # returns (messages, high_watermark), -1 if the partition does not exist,
+        # -4 if offset was removed by retention
+        # with max_wait_ms, an empty result is retried like in dequeue
+        deadline = monotonic() + min(max_wait_ms, MAX_WAIT_MS) / 1000
+        while True:
+            version = self.notifier.version(topic_name, partition_id)
+            started = perf_counter()
+            status = self.fetch_once(topic_name, partition_id, offset, max_messages, max_bytes)
+            self.stats.latency(perf_counter() - started)
+            if isinstance(status, tuple) and status[0]:
+                self.stats.fetched(topic_name, partition_id, len(status[0]))
+            if not isinstance(status, tuple) or status[0] or max_wait_ms <= 0:
+                return status
+            if not self.notifier.wait(topic_name, partition_id, version, deadline):
+                return status
+
+    def fetch_once(self, topic_name: str, partition_id: int, offset: int, max_messages: int, max_bytes: int):
+        messages = None
+        if self.cache is not None:
+            messages = self.cache.get(topic_name, partition_id, offset, max_messages, max_bytes)
+
+        if messages is None:
+            if not self.topic_exists(topic_name, partition_id):
+                print(
+                    f"Topic {topic_name} with partition {partition_id} does not exist.")
+                return -1
+            messages = self.storage.read_range(topic_name=topic_name, partition_id=partition_id,
+                                               offset=offset, max_messages=max_messages, max_bytes=max_bytes)
+            if not messages and offset < self.start_offset(topic_name, partition_id):
+                return -4
+        high_watermark = self.storage.high_watermark(topic_name, partition_id)
+        print(
+            f"Fetched {len(messages)} messages from topic {topic_name}, partition {partition_id} at offset {offset}.")
+        return messages, high_watermark
+
+    def start_offset(self, topic_name: str, partition_id: int) -> int:
+        # first offset still stored, earlier ones were removed by retention
+        return self.storage.start_offset(topic_name, partition_id)
+
+    def high_watermark(self, topic_name: str, partition_id: int) -> int:
+        # offset the next message appended to the partition gets
+        return self.storage.high_watermark(topic_name, partition_id)
+
+    def offset_for_time(self, topic_name: str, partition_id: int, timestamp_ms: int) -> int:
+        # first offset appended at or after timestamp_ms (the high watermark if none was),
+        # -1 if the partition does not exist
+        if not self.topic_exists(topic_name, partition_id):
+            print(
+                f"Topic {topic_name} with partition {partition_id} does not exist.")
+            return -1
+        return self.storage.offset_for_time(topic_name, partition_id, timestamp_ms)
+
     def size(self, topic_name: str, partition_id: str, offset) -> int:
-        if not TopicName.CheckTopic(topic_name=topic_name, partition_id=partition_id):
+        if not self.topic_exists(topic_name, partition_id):
             print(
                 f"Topic {topic_name} with partition {partition_id} does not exist.")
             return -1
-        return TopicMessage.getSizeforTopic(topic_name=topic_name, partition_id=partition_id, offset=offset)
+        return self.storage.size(topic_name=topic_name, partition_id=partition_id, offset=offset)
 
     def set_details(self, broker_id, ip, port):
         self.DetailsDB.addBrokerDetails(broker_id=broker_id, ip=ip, port=port)
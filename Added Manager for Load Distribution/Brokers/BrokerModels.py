@@ -1,7 +1,16 @@
 from flask_sqlalchemy import SQLAlchemy
+from datetime import timedelta
+import hashlib
+from Codec import CODECS, CompressedBatch, codec_of, codec_id, from_codec_id
 
 db = SQLAlchemy()
 
+# rows per multi-row INSERT, keeps the statement below the bind parameter limit
+INSERT_CHUNK = 1000
+
+# (topic_name, partition_id) -> partition_key, keys never change once assigned
+PARTITION_KEYS = {}
+
 class ID(db.Model):
     broker_id = db.Column(db.Integer, primary_key=True)
 
@@ -28,10 +37,43 @@ class TopicName(db.Model):
     __tablename__ = 'TopicName'
     topic_name = db.Column(db.String(), primary_key=True)
     partition_id = db.Column(db.Integer, primary_key=True)
+    next_offset = db.Column(db.BigInteger, nullable=False, default=0)   # high watermark
+    start_offset = db.Column(db.BigInteger, nullable=False, default=0)  # first offset not removed by retention
+    partition_key = db.Column(db.Integer, db.Identity(), nullable=False, unique=True)   # row key of PartitionMessage
+
+    # brokers created before partition keys existed, existing rows get numbered
+    PARTITION_KEY_DDL = '''
+        ALTER TABLE IF EXISTS "TopicName"
+        ADD COLUMN IF NOT EXISTS partition_key INTEGER GENERATED BY DEFAULT AS IDENTITY UNIQUE'''
+
+    # brokers created before high watermarks existed, every partition continues after
+    # its last stored offset (needs "TopicMessage" migrated by TopicMessage.OFFSET_DDL)
+    HIGH_WATERMARK_DDL = '''
+        DO $$
+        BEGIN
+            IF to_regclass('"TopicName"') IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'TopicName' AND column_name = 'next_offset') THEN
+                ALTER TABLE "TopicName" ADD COLUMN next_offset BIGINT NOT NULL DEFAULT 0;
+                IF to_regclass('"TopicMessage"') IS NOT NULL THEN
+                    UPDATE "TopicName" AS t SET next_offset = m.next_offset
+                    FROM (SELECT topic_name, partition_id, max("offset") + 1 AS next_offset
+                          FROM "TopicMessage" GROUP BY topic_name, partition_id) AS m
+                    WHERE t.topic_name = m.topic_name AND t.partition_id = m.partition_id;
+                END IF;
+            END IF;
+        END $$'''
+
+    # brokers created before retention existed never removed a message
+    START_OFFSET_DDL = '''
+        ALTER TABLE IF EXISTS "TopicName"
+        ADD COLUMN IF NOT EXISTS start_offset BIGINT NOT NULL DEFAULT 0'''
 
     def __init__(self, topic_name, partition_id):
         self.topic_name = topic_name
         self.partition_id = partition_id
+        self.next_offset = 0
+        self.start_offset = 0
 
     def __repr__(self):
         return f"{self.topic_name} {self.partition_id}"
@@ -56,6 +98,91 @@ class TopicName(db.Model):
             topic_name=topic_name, partition_id=partition_id).first()
         return True if topic else False
 
+    @staticmethod
+    def reserveOffsets(topic_name, partition_id, count):
+        # moves the high watermark forward inside the caller's transaction and
+        # returns the first reserved offset, the row lock taken by the UPDATE
+        # serialises appends to the partition until the caller commits
+        next_offset = db.session.execute(
+            TopicName.__table__.update()
+            .where(TopicName.topic_name == topic_name, TopicName.partition_id == partition_id)
+            .values(next_offset=TopicName.next_offset + count)
+            .returning(TopicName.next_offset)).scalar()
+        return next_offset - count
+
+    @staticmethod
+    def reserveKeyedOffsets(topic_name, partition_id, count):
+        # like reserveOffsets, also returns the partition key: (partition_key, first reserved offset)
+        row = db.session.execute(
+            TopicName.__table__.update()
+            .where(TopicName.topic_name == topic_name, TopicName.partition_id == partition_id)
+            .values(next_offset=TopicName.next_offset + count)
+            .returning(TopicName.partition_key, TopicName.next_offset)).first()
+        return row.partition_key, row.next_offset - count
+
+    @staticmethod
+    def getPartitionKey(topic_name, partition_id):
+        # None if the partition does not exist
+        key = (topic_name, int(partition_id))
+        if key not in PARTITION_KEYS:
+            partition_key = db.session.query(TopicName.partition_key).filter_by(
+                topic_name=topic_name, partition_id=partition_id).scalar()
+            if partition_key is None:
+                return None
+            PARTITION_KEYS[key] = partition_key
+        return PARTITION_KEYS[key]
+
+    @staticmethod
+    def addHighWatermark():
+        db.session.execute(db.text(TopicName.HIGH_WATERMARK_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def addStartOffset():
+        db.session.execute(db.text(TopicName.START_OFFSET_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def addPartitionKey():
+        db.session.execute(db.text(TopicName.PARTITION_KEY_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def getStartOffset(topic_name, partition_id):
+        return db.session.query(TopicName.start_offset).filter_by(
+            topic_name=topic_name, partition_id=partition_id).scalar()
+
+    @staticmethod
+    def resetHighWatermark(topic_name, partition_id, offset):
+        # the next append gets offset, inside the caller's transaction; the start
+        # offset moves too if offset is outside the stored range
+        db.session.execute(
+            TopicName.__table__.update()
+            .where(TopicName.topic_name == topic_name, TopicName.partition_id == partition_id)
+            .values(next_offset=offset,
+                    start_offset=db.case((db.and_(TopicName.start_offset <= offset, TopicName.next_offset >= offset),
+                                          TopicName.start_offset), else_=offset)))
+
+    @staticmethod
+    def messageCounts():
+        # [(topic_name, partition_id, messages still stored, high watermark)] for every partition, in one query
+        return [(topic.topic_name, topic.partition_id, topic.next_offset - topic.start_offset, topic.next_offset)
+                for topic in db.session.query(TopicName.topic_name, TopicName.partition_id,
+                                              TopicName.next_offset, TopicName.start_offset)]
+
+    # size of the whole database on disk
+    DATABASE_BYTES_SQL = '''SELECT pg_database_size(current_database())'''
+
+    @staticmethod
+    def databaseBytes():
+        return db.session.execute(db.text(TopicName.DATABASE_BYTES_SQL)).scalar()
+
+    @staticmethod
+    def getHighWatermark(topic_name, partition_id):
+        # offset the next message will get, also the number of messages ever appended
+        return db.session.query(TopicName.next_offset).filter_by(
+            topic_name=topic_name, partition_id=partition_id).scalar()
+
 
 class TopicMessage(db.Model):
     __tablename__ = 'TopicMessage'
@@ -63,45 +190,591 @@ class TopicMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     topic_name = db.Column(db.String())
     partition_id = db.Column(db.Integer)
+    offset = db.Column(db.BigInteger, nullable=False)   # dense, 0-indexed per partition
+    timestamp = db.Column(db.DateTime, nullable=False, server_default=db.func.now())   # append time
+    codec = db.Column(db.String(), nullable=True)   # set if message is a compressed batch
     message = db.Column(db.String())
 
-    def __init__(self, topic_name, partition_id, message):
+    __table_args__ = (
+        db.Index('ix_TopicMessage_partition_offset',
+                 'topic_name', 'partition_id', 'offset', unique=True),
+    )
+
+    # brokers created before offsets existed, existing rows are numbered in insertion order
+    OFFSET_DDL = '''
+        DO $$
+        BEGIN
+            IF to_regclass('"TopicMessage"') IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_schema = current_schema() AND table_name = 'TopicMessage' AND column_name = 'offset') THEN
+                ALTER TABLE "TopicMessage" ADD COLUMN "offset" BIGINT;
+                UPDATE "TopicMessage" AS m SET "offset" = n.row_offset
+                FROM (SELECT id, row_number() OVER (PARTITION BY topic_name, partition_id ORDER BY id) - 1 AS row_offset
+                      FROM "TopicMessage") AS n
+                WHERE m.id = n.id;
+                ALTER TABLE "TopicMessage" ALTER COLUMN "offset" SET NOT NULL;
+                CREATE UNIQUE INDEX IF NOT EXISTS "ix_TopicMessage_partition_offset"
+                    ON "TopicMessage" (topic_name, partition_id, "offset");
+            END IF;
+        END $$'''
+
+    # brokers created before compression, their messages are all uncompressed
+    CODEC_DDL = '''
+        ALTER TABLE IF EXISTS "TopicMessage"
+        ADD COLUMN IF NOT EXISTS codec VARCHAR'''
+
+    # brokers created before append times were kept, existing rows get the time of the upgrade
+    TIMESTAMP_DDL = '''
+        ALTER TABLE IF EXISTS "TopicMessage"
+        ADD COLUMN IF NOT EXISTS timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()'''
+
+    # partitioned storage mode: "TopicMessage" is a parent table partitioned by
+    # (topic_name, partition_id), every topic partition gets its own child table
+    PARTITIONED_DDL = '''
+        CREATE TABLE IF NOT EXISTS "TopicMessage" (
+            id SERIAL,
+            topic_name VARCHAR NOT NULL,
+            partition_id INTEGER NOT NULL,
+            "offset" BIGINT NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            codec VARCHAR,
+            message VARCHAR,
+            PRIMARY KEY (topic_name, partition_id, "offset")
+        ) PARTITION BY RANGE (topic_name, partition_id)'''
+
+    # bytes on disk including indexes, summed over the child tables when partitioned
+    TABLE_BYTES_SQL = '''
+        SELECT COALESCE(sum(pg_total_relation_size(relid)), pg_total_relation_size('"TopicMessage"'))
+        FROM pg_partition_tree('"TopicMessage"')'''
+
+    def __init__(self, topic_name, partition_id, offset, message):
         self.topic_name = topic_name
         self.partition_id = partition_id
+        self.offset = offset
+        self.codec = codec_of(message)
         self.message = message
 
     @staticmethod
     def addMessage(message, topic_name, partition_id):
-        if not TopicName.CheckTopic(topic_name=topic_name, partition_id=partition_id):
-            print(f"Topic {topic_name} with partition {partition_id} does not exist.")
+        # returns the offset assigned to the message, -1 on failure
+        # the caller makes sure the partition exists
+        try:
+            offset = TopicName.reserveOffsets(topic_name, partition_id, 1)
+            db.session.add(TopicMessage(topic_name, partition_id, offset, message))
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
             return -1
+        return offset
+
+    @staticmethod
+    def addMessages(messages):
+        # messages: list of (topic_name, partition_id, message), all partitions must exist
+        # persisted with multi-row INSERTs in a single transaction
+        # returns [(topic_name, partition_id, base_offset, last_offset)], -1 on failure
+        partitions = {}
+        for topic_name, partition_id, message in messages:
+            partitions.setdefault((topic_name, int(partition_id)), []).append(message)
 
-        topic = TopicMessage(topic_name, partition_id, message)
+        rows = []
+        ranges = []
         try:
-            db.session.add(topic)
+            # partitions are locked in a fixed order so concurrent batches cannot deadlock
+            for (topic_name, partition_id) in sorted(partitions):
+                batch = partitions[(topic_name, partition_id)]
+                base_offset = TopicName.reserveOffsets(topic_name, partition_id, len(batch))
+                rows.extend({"topic_name": topic_name, "partition_id": partition_id,
+                             "offset": base_offset + i, "codec": codec_of(message), "message": message}
+                            for i, message in enumerate(batch))
+                ranges.append((topic_name, partition_id, base_offset, base_offset + len(batch) - 1))
+            for i in range(0, len(rows), INSERT_CHUNK):
+                db.session.execute(TopicMessage.__table__.insert().values(rows[i:i + INSERT_CHUNK]))
             db.session.commit()
         except Exception as e:
             print(e)
             db.session.rollback()
             return -1
-        return 1
+        return ranges
 
     @staticmethod
     def retrieveMessage(topic_name, partition_id, offset):
-        left_messages = TopicMessage.getSizeforTopic(
-            topic_name, partition_id, offset)
-        if (left_messages <= 0):
-            return -1
         data = TopicMessage.query.filter_by(
-            topic_name=topic_name, partition_id=partition_id).order_by(TopicMessage.id).offset(offset).first()
+            topic_name=topic_name, partition_id=partition_id, offset=offset).first()
+        if data is None:
+            return -1
         assert data.message is not None, "Message is None"
+        if data.codec is not None:
+            return CompressedBatch(data.message, data.codec)
         return data.message
 
+    @staticmethod
+    def retrieveMessages(topic_name, partition_id, offset, max_messages, max_bytes):
+        # contiguous run starting at offset, one range scan over the unique index
+        # at least one message is returned even if it alone exceeds max_bytes
+        rows = db.session.query(TopicMessage.offset, TopicMessage.codec, TopicMessage.message).filter(
+            TopicMessage.topic_name == topic_name,
+            TopicMessage.partition_id == partition_id,
+            TopicMessage.offset >= offset,
+            TopicMessage.offset < offset + max_messages).order_by(TopicMessage.offset).all()
+        messages = []
+        total_bytes = 0
+        if rows and rows[0].offset != offset:
+            # offset was removed by retention
+            return messages
+        for _, codec, message in rows:
+            total_bytes += len(message)
+            if messages and total_bytes > max_bytes:
+                break
+            messages.append(message if codec is None else CompressedBatch(message, codec))
+        return messages
+
+    @staticmethod
+    def firstOffsetAtTime(topic_name, partition_id, from_offset, timestamp_ms):
+        # first offset from from_offset on appended at or after timestamp_ms, None if there is none
+        return db.session.query(TopicMessage.offset).filter(
+            TopicMessage.topic_name == topic_name, TopicMessage.partition_id == partition_id,
+            TopicMessage.offset >= from_offset,
+            TopicMessage.timestamp >= TimeIndex.toTimestamp(timestamp_ms)).order_by(TopicMessage.offset).limit(1).scalar()
+
+    @staticmethod
+    def tableBytes():
+        return db.session.execute(db.text(TopicMessage.TABLE_BYTES_SQL)).scalar()
+
     @staticmethod
     def getSizeforTopic(topic_name, partition_id, offset):
-        print(type(partition_id))
-        # offset is 0-indexed
-        return TopicMessage.query.filter_by(topic_name=topic_name, partition_id=partition_id).count() - offset
+        # offset is 0-indexed, answered from the maintained high watermark
+        return TopicName.getHighWatermark(topic_name, partition_id) - offset
+
+    @staticmethod
+    def addOffset():
+        db.session.execute(db.text(TopicMessage.OFFSET_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def addCodec():
+        db.session.execute(db.text(TopicMessage.CODEC_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def addTimestamp():
+        db.session.execute(db.text(TopicMessage.TIMESTAMP_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def createPartitionedTable():
+        # must run before db.create_all(), which would create a plain table
+        kind = db.session.execute(db.text(
+            '''SELECT relkind FROM pg_class WHERE relname = 'TopicMessage' AND relnamespace = 'public'::regnamespace''')).scalar()
+        if kind is not None and kind != 'p':
+            raise RuntimeError('"TopicMessage" already exists as a plain table, it cannot be used in partitioned mode')
+        db.session.execute(db.text(TopicMessage.PARTITIONED_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def partitionTable(topic_name, partition_id):
+        # child table name, hashed so any topic name gives a valid identifier
+        digest = hashlib.md5(f"{topic_name}\0{partition_id}".encode()).hexdigest()[:16]
+        return f"TopicMessage_{digest}"
+
+    @staticmethod
+    def partitionDDL(topic_name, partition_id):
+        # partition bounds cannot be bind parameters, the topic name is quoted as a literal
+        topic_literal = "'" + topic_name.replace("'", "''") + "'"
+        partition_id = int(partition_id)
+        return f'''CREATE TABLE IF NOT EXISTS "{TopicMessage.partitionTable(topic_name, partition_id)}"
+                    PARTITION OF "TopicMessage"
+                    FOR VALUES FROM ({topic_literal}, {partition_id}) TO ({topic_literal}, {partition_id + 1})'''
+
+    @staticmethod
+    def createPartition(topic_name, partition_id):
+        try:
+            db.session.execute(db.text(TopicMessage.partitionDDL(topic_name, partition_id)))
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+
+    @staticmethod
+    def truncatePartition(topic_name, partition_id, keep_from):
+        # partitioned mode: drops every message of the partition at once if none at or
+        # after keep_from exists, returns rows removed
+        try:
+            # holding the TopicName row lock keeps appends out until the TRUNCATE commits
+            topic = TopicName.query.filter_by(
+                topic_name=topic_name, partition_id=partition_id).with_for_update().first()
+            if topic.next_offset > keep_from:
+                # appended to since keep_from was computed
+                db.session.rollback()
+                return TopicMessage.trimPartition(topic_name, partition_id, keep_from)
+            removed = topic.next_offset - topic.start_offset
+            db.session.execute(db.text(f'''TRUNCATE "{TopicMessage.partitionTable(topic_name, partition_id)}"'''))
+            topic.start_offset = topic.next_offset
+            TimeIndex.trimIndex(topic_name, partition_id, topic.next_offset)
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return removed
+
+    @staticmethod
+    def retentionOffset(topic_name, partition_id, max_age_ms=None, max_bytes=None, max_messages=None):
+        # first offset of the partition that the retention policy keeps
+        topic = TopicName.query.filter_by(topic_name=topic_name, partition_id=partition_id).first()
+        in_partition = (TopicMessage.topic_name == topic_name, TopicMessage.partition_id == partition_id)
+        keep_from = topic.start_offset
+        if max_messages is not None:
+            keep_from = max(keep_from, topic.next_offset - max_messages)
+        if max_age_ms is not None:
+            first_kept = db.session.query(db.func.min(TopicMessage.offset)).filter(
+                *in_partition, TopicMessage.timestamp >= db.func.now() - timedelta(milliseconds=max_age_ms)).scalar()
+            keep_from = max(keep_from, topic.next_offset if first_kept is None else first_kept)
+        if max_bytes is not None:
+            # running total of payload bytes from the newest message backwards
+            tail = db.session.query(
+                TopicMessage.offset.label("offset"),
+                db.func.sum(db.func.octet_length(TopicMessage.message)).over(
+                    order_by=TopicMessage.offset.desc()).label("tail_bytes")).filter(*in_partition).subquery()
+            last_dropped = db.session.query(db.func.max(tail.c.offset)).filter(tail.c.tail_bytes > max_bytes).scalar()
+            if last_dropped is not None:
+                keep_from = max(keep_from, last_dropped + 1)
+        return keep_from
+
+    @staticmethod
+    def trimPartition(topic_name, partition_id, keep_from):
+        # removes every message below keep_from with a single ranged DELETE, offsets of
+        # the remaining messages are unchanged, returns the number of rows removed
+        try:
+            removed = TopicMessage.query.filter(
+                TopicMessage.topic_name == topic_name, TopicMessage.partition_id == partition_id,
+                TopicMessage.offset < keep_from).delete(synchronize_session=False)
+            TopicName.query.filter_by(topic_name=topic_name, partition_id=partition_id).update(
+                {"start_offset": keep_from}, synchronize_session=False)
+            TimeIndex.trimIndex(topic_name, partition_id, keep_from)
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return removed
+
+    @staticmethod
+    def removeFrom(topic_name, partition_id, offset):
+        # drops the message at offset and every later one so that the next append
+        # gets offset, used to cut a replica back to its leader's log; returns rows removed
+        try:
+            TopicName.resetHighWatermark(topic_name, partition_id, offset)
+            removed = TopicMessage.query.filter(
+                TopicMessage.topic_name == topic_name, TopicMessage.partition_id == partition_id,
+                TopicMessage.offset >= offset).delete(synchronize_session=False)
+            TimeIndex.truncateIndex(topic_name, partition_id, offset)
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return removed
 
     def __repr__(self):
-        return f"{self.id} {self.topic_name} {self.producer_id} {self.message}"
\ No newline at end of file
+        return f"{self.id} {self.topic_name} {self.producer_id} {self.message}"
+
+
+# Table : PartitionMessage (compact storage mode)
+# Same log as TopicMessage in a smaller row: the partition is referenced by its
+# integer key instead of the topic string, there is no surrogate id, the codec
+# is a small integer (Codec.codec_id) and the payload is raw UTF-8 bytes.
+# Fixed-width columns come first so no alignment padding is needed between them.
+class PartitionMessage(db.Model):
+    __tablename__ = 'PartitionMessage'
+
+    offset = db.Column(db.BigInteger, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, server_default=db.func.now())   # append time
+    partition_key = db.Column(db.Integer, nullable=False)
+    codec = db.Column(db.SmallInteger, nullable=False, server_default='0')
+    message = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.PrimaryKeyConstraint('partition_key', 'offset'),
+    )
+
+    # rows are only ever appended and removed in bulk by retention: pages are
+    # filled completely, and vacuum is driven by inserts (to keep the visibility
+    # map current for index-only scans) rather than by dead row ratios
+    COMPACT_DDL = '''
+        CREATE TABLE IF NOT EXISTS "PartitionMessage" (
+            "offset" BIGINT NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now(),
+            partition_key INTEGER NOT NULL,
+            codec SMALLINT NOT NULL DEFAULT 0,
+            message BYTEA NOT NULL,
+            PRIMARY KEY (partition_key, "offset") WITH (fillfactor = 100)
+        ) WITH (
+            fillfactor = 100,
+            autovacuum_vacuum_scale_factor = 0,
+            autovacuum_vacuum_threshold = 100000,
+            autovacuum_vacuum_insert_scale_factor = 0,
+            autovacuum_vacuum_insert_threshold = 100000
+        )'''
+
+    # copies the live rows of "TopicMessage", codec names become codec ids
+    MIGRATE_SQL = '''
+        INSERT INTO "PartitionMessage" ("offset", timestamp, partition_key, codec, message)
+        SELECT m."offset", m.timestamp, t.partition_key,
+               COALESCE(array_position(CAST(:codecs AS VARCHAR[]), m.codec), 0),
+               convert_to(m.message, 'UTF8')
+        FROM "TopicMessage" m
+        JOIN "TopicName" t ON t.topic_name = m.topic_name AND t.partition_id = m.partition_id
+        WHERE m."offset" >= t.start_offset
+        ON CONFLICT DO NOTHING'''
+
+    TABLE_BYTES_SQL = '''SELECT pg_total_relation_size('"PartitionMessage"')'''
+
+    @staticmethod
+    def tableBytes():
+        return db.session.execute(db.text(PartitionMessage.TABLE_BYTES_SQL)).scalar()
+
+    @staticmethod
+    def createCompactTable():
+        # must run before db.create_all(), which would create the table without the storage parameters
+        db.session.execute(db.text(PartitionMessage.COMPACT_DDL))
+        db.session.commit()
+
+    @staticmethod
+    def migrateRows():
+        # moves every message still in "TopicMessage" over in one transaction, returns rows moved
+        # messages already removed by retention are not copied
+        if db.session.execute(db.text('''SELECT to_regclass('"TopicMessage"')''')).scalar() is None:
+            return 0
+        if not db.session.execute(db.text('''SELECT EXISTS (SELECT 1 FROM "TopicMessage")''')).scalar():
+            return 0
+        try:
+            moved = db.session.execute(db.text(PartitionMessage.MIGRATE_SQL), {"codecs": CODECS}).rowcount
+            db.session.execute(db.text('''TRUNCATE "TopicMessage"'''))
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return moved
+
+    @staticmethod
+    def addMessage(message, topic_name, partition_id):
+        # returns the offset assigned to the message, -1 on failure
+        try:
+            partition_key, offset = TopicName.reserveKeyedOffsets(topic_name, partition_id, 1)
+            db.session.execute(PartitionMessage.__table__.insert().values(
+                offset=offset, partition_key=partition_key, codec=codec_id(message), message=message.encode()))
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return offset
+
+    @staticmethod
+    def addMessages(messages):
+        # same contract as TopicMessage.addMessages
+        partitions = {}
+        for topic_name, partition_id, message in messages:
+            partitions.setdefault((topic_name, int(partition_id)), []).append(message)
+
+        rows = []
+        ranges = []
+        try:
+            for (topic_name, partition_id) in sorted(partitions):
+                batch = partitions[(topic_name, partition_id)]
+                partition_key, base_offset = TopicName.reserveKeyedOffsets(topic_name, partition_id, len(batch))
+                rows.extend({"offset": base_offset + i, "partition_key": partition_key,
+                             "codec": codec_id(message), "message": message.encode()}
+                            for i, message in enumerate(batch))
+                ranges.append((topic_name, partition_id, base_offset, base_offset + len(batch) - 1))
+            for i in range(0, len(rows), INSERT_CHUNK):
+                db.session.execute(PartitionMessage.__table__.insert().values(rows[i:i + INSERT_CHUNK]))
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return ranges
+
+    @staticmethod
+    def retrieveMessage(topic_name, partition_id, offset):
+        partition_key = TopicName.getPartitionKey(topic_name, partition_id)
+        data = db.session.query(PartitionMessage.codec, PartitionMessage.message).filter(
+            PartitionMessage.partition_key == partition_key, PartitionMessage.offset == offset).first()
+        if data is None:
+            return -1
+        return from_codec_id(bytes(data.message).decode(), data.codec)
+
+    @staticmethod
+    def retrieveMessages(topic_name, partition_id, offset, max_messages, max_bytes):
+        # same contract as TopicMessage.retrieveMessages
+        partition_key = TopicName.getPartitionKey(topic_name, partition_id)
+        rows = db.session.query(PartitionMessage.offset, PartitionMessage.codec, PartitionMessage.message).filter(
+            PartitionMessage.partition_key == partition_key,
+            PartitionMessage.offset >= offset,
+            PartitionMessage.offset < offset + max_messages).order_by(PartitionMessage.offset).all()
+        messages = []
+        total_bytes = 0
+        if rows and rows[0].offset != offset:
+            # offset was removed by retention
+            return messages
+        for _, codec, message in rows:
+            total_bytes += len(message)
+            if messages and total_bytes > max_bytes:
+                break
+            messages.append(from_codec_id(bytes(message).decode(), codec))
+        return messages
+
+    @staticmethod
+    def firstOffsetAtTime(topic_name, partition_id, from_offset, timestamp_ms):
+        # same contract as TopicMessage.firstOffsetAtTime
+        return db.session.query(PartitionMessage.offset).filter(
+            PartitionMessage.partition_key == TopicName.getPartitionKey(topic_name, partition_id),
+            PartitionMessage.offset >= from_offset,
+            PartitionMessage.timestamp >= TimeIndex.toTimestamp(timestamp_ms)).order_by(PartitionMessage.offset).limit(1).scalar()
+
+    @staticmethod
+    def retentionOffset(topic_name, partition_id, max_age_ms=None, max_bytes=None, max_messages=None):
+        # same contract as TopicMessage.retentionOffset
+        topic = TopicName.query.filter_by(topic_name=topic_name, partition_id=partition_id).first()
+        in_partition = PartitionMessage.partition_key == topic.partition_key
+        keep_from = topic.start_offset
+        if max_messages is not None:
+            keep_from = max(keep_from, topic.next_offset - max_messages)
+        if max_age_ms is not None:
+            first_kept = db.session.query(db.func.min(PartitionMessage.offset)).filter(
+                in_partition, PartitionMessage.timestamp >= db.func.now() - timedelta(milliseconds=max_age_ms)).scalar()
+            keep_from = max(keep_from, topic.next_offset if first_kept is None else first_kept)
+        if max_bytes is not None:
+            tail = db.session.query(
+                PartitionMessage.offset.label("offset"),
+                db.func.sum(db.func.octet_length(PartitionMessage.message)).over(
+                    order_by=PartitionMessage.offset.desc()).label("tail_bytes")).filter(in_partition).subquery()
+            last_dropped = db.session.query(db.func.max(tail.c.offset)).filter(tail.c.tail_bytes > max_bytes).scalar()
+            if last_dropped is not None:
+                keep_from = max(keep_from, last_dropped + 1)
+        return keep_from
+
+    @staticmethod
+    def trimPartition(topic_name, partition_id, keep_from):
+        # same contract as TopicMessage.trimPartition
+        try:
+            removed = PartitionMessage.query.filter(
+                PartitionMessage.partition_key == TopicName.getPartitionKey(topic_name, partition_id),
+                PartitionMessage.offset < keep_from).delete(synchronize_session=False)
+            TopicName.query.filter_by(topic_name=topic_name, partition_id=partition_id).update(
+                {"start_offset": keep_from}, synchronize_session=False)
+            TimeIndex.trimIndex(topic_name, partition_id, keep_from)
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return removed
+
+    @staticmethod
+    def removeFrom(topic_name, partition_id, offset):
+        # same contract as TopicMessage.removeFrom
+        try:
+            TopicName.resetHighWatermark(topic_name, partition_id, offset)
+            removed = PartitionMessage.query.filter(
+                PartitionMessage.partition_key == TopicName.getPartitionKey(topic_name, partition_id),
+                PartitionMessage.offset >= offset).delete(synchronize_session=False)
+            TimeIndex.truncateIndex(topic_name, partition_id, offset)
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+        return removed
+
+    def __repr__(self):
+        return f"{self.partition_key} {self.offset} {self.message}"
+
+
+# Table : TimeIndex (sparse time -> offset index, a few entries per partition and second)
+# An entry (offset, timestamp) is written after the message at offset was committed,
+# so every message up to offset was appended at or before timestamp. A lookup
+# starts from the newest entry older than the requested time and scans messages
+# forward from there.
+class TimeIndex(db.Model):
+    __tablename__ = 'TimeIndex'
+    topic_name = db.Column(db.String(), primary_key=True)
+    partition_id = db.Column(db.Integer, primary_key=True)
+    offset = db.Column(db.BigInteger, primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    def __init__(self, topic_name, partition_id, offset):
+        self.topic_name = topic_name
+        self.partition_id = partition_id
+        self.offset = offset
+
+    @staticmethod
+    def toTimestamp(timestamp_ms):
+        # ms since the epoch -> the database's local time, as stored by now()
+        return db.cast(db.func.to_timestamp(timestamp_ms / 1000), db.DateTime)
+
+    @staticmethod
+    def addEntry(topic_name, partition_id, offset):
+        try:
+            db.session.add(TimeIndex(topic_name, partition_id, offset))
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+
+    @staticmethod
+    def floorOffset(topic_name, partition_id, timestamp_ms):
+        # newest indexed offset from before timestamp_ms, None if there is none
+        return db.session.query(db.func.max(TimeIndex.offset)).filter(
+            TimeIndex.topic_name == topic_name, TimeIndex.partition_id == partition_id,
+            TimeIndex.timestamp < TimeIndex.toTimestamp(timestamp_ms)).scalar()
+
+    @staticmethod
+    def trimIndex(topic_name, partition_id, keep_from):
+        # runs inside the caller's retention transaction
+        TimeIndex.query.filter(
+            TimeIndex.topic_name == topic_name, TimeIndex.partition_id == partition_id,
+            TimeIndex.offset < keep_from).delete(synchronize_session=False)
+
+    @staticmethod
+    def truncateIndex(topic_name, partition_id, offset):
+        # drops entries at offset and after it, inside the caller's transaction
+        TimeIndex.query.filter(
+            TimeIndex.topic_name == topic_name, TimeIndex.partition_id == partition_id,
+            TimeIndex.offset >= offset).delete(synchronize_session=False)
+
+
+# Table : RetentionPolicy (per topic, overrides the broker defaults)
+# a None limit is not enforced
+class RetentionPolicy(db.Model):
+    __tablename__ = 'RetentionPolicy'
+    topic_name = db.Column(db.String(), primary_key=True)
+    max_age_ms = db.Column(db.BigInteger, nullable=True)
+    max_bytes = db.Column(db.BigInteger, nullable=True)
+    max_messages = db.Column(db.BigInteger, nullable=True)
+
+    def __init__(self, topic_name, max_age_ms, max_bytes, max_messages):
+        self.topic_name = topic_name
+        self.max_age_ms = max_age_ms
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+
+    @staticmethod
+    def setPolicy(topic_name, max_age_ms, max_bytes, max_messages):
+        try:
+            db.session.merge(RetentionPolicy(topic_name, max_age_ms, max_bytes, max_messages))
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            return -1
+
+    @staticmethod
+    def getPolicies():
+        return {policy.topic_name: (policy.max_age_ms, policy.max_bytes, policy.max_messages)
+                for policy in RetentionPolicy.query.all()}
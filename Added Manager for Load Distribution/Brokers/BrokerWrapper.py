@@ -1,7 +1,17 @@
-from flask import Flask, request
-from Broker import LoggingQueue
+from flask import Flask, request, Response, stream_with_context, g
+from Broker import LoggingQueue, FETCH_MAX_MESSAGES, FETCH_MAX_BYTES
 from flask_migrate import Migrate
-from BrokerModels import db, ID
+from BrokerModels import db, ID, RetentionPolicy
+from Storage import get_storage, STORAGE_ENGINES
+from SegmentLog import SEGMENT_BYTES
+from TailCache import TailCache, PARTITION_MAX_MESSAGES, CACHE_MAX_BYTES
+from GroupCommit import LINGER_MS, MAX_GROUP_SIZE
+from Retention import RetentionEnforcer, RETENTION_CHECK_MS
+from Codec import CODECS, CompressedBatch, codec_of
+from LongPoll import PostgresListener, publish_notify
+from Prefork import serve, WORKERS, THREADS
+from LiveTail import tail, SUBSCRIBE_MAX_MESSAGES, SUBSCRIBE_MAX_BYTES
+from Replication import Replicator, EpochFence
 
 from concurrent.futures import ThreadPoolExecutor
 import socket
@@ -30,11 +40,27 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db.init_app(app)
 migrate = Migrate(app, db)
 
+# replaced in __main__ once the storage engine is configured
 broker = LoggingQueue()
 
 # TODO : Add database schemas
 
 broker_id = None
+# leader epochs seen by this process as a follower
+fence = EpochFence()
+
+
+@app.before_request
+def request_started():
+    g.counted = True
+    broker.stats.request_started()
+
+
+@app.teardown_request
+def request_finished(exception=None):
+    # streamed responses are torn down once the stream ends
+    if g.pop('counted', False):
+        broker.stats.request_finished()
 
 
 @app.route('/')
@@ -49,21 +75,68 @@ def enqueue():
     print("produce")
     dict = request.get_json()
     topic = dict['topic_name']
-    partition_id = dict['partition_id']
+    # ints everywhere, "0" and 0 would otherwise be different partitions in a commit group
+    try:
+        partition_id = int(dict['partition_id'])
+    except (TypeError, ValueError):
+        return {"status": "Failure", "message": f"Invalid partition_id {dict['partition_id']}."}
     message = dict['message']
+    codec = dict.get('codec', None)
+    if codec is not None:
+        if codec not in CODECS:
+            return {"status": "Failure", "message": f"Unknown codec {codec}."}
+        message = CompressedBatch(message, codec)
+    # clients producing directly send the leader epoch of their metadata
+    if 'leader_epoch' in dict and broker.stale_epoch(topic, partition_id, dict['leader_epoch']):
+        return stale_epoch(topic, partition_id)
     # import ipdb; ipdb.set_trace()
     status = broker.enqueue(message=message, topic=topic,
                             partition_id=partition_id)
     response = {}
 
-    if status == 1:
+    if status >= 0:
         response["status"] = "Success"
+        response["offset"] = status
     else:
         response["status"] = "Failure"
 
     return response
 
 
+@app.route("/producer/produce_batch", methods=["POST"])
+def enqueue_batch():
+    dict = request.get_json()
+    response = {}
+    if any(entry.get('codec') not in CODECS + [None] for entry in dict['messages']):
+        response["status"] = "Failure"
+        response["message"] = "Unknown codec."
+        return response
+    try:
+        messages = [(entry['topic_name'], int(entry['partition_id']),
+                     entry['message'] if entry.get('codec') is None else CompressedBatch(entry['message'], entry['codec']))
+                    for entry in dict['messages']]
+    except (TypeError, ValueError):
+        response["status"] = "Failure"
+        response["message"] = "Invalid partition_id."
+        return response
+    if len(messages) == 0:
+        response["status"] = "Failure"
+        response["message"] = "Empty batch."
+        return response
+
+    status = broker.enqueue_batch(messages)
+    if status == -1:
+        response["status"] = "Failure"
+        response["message"] = "Batch could not be added."
+    else:
+        response["status"] = "Success"
+        response["offsets"] = [{"topic_name": topic, "partition_id": partition_id,
+                                "base_offset": base_offset, "last_offset": last_offset}
+                               for topic, partition_id, base_offset, last_offset in status]
+
+    return response
+
+
 @app.route("/consumer/consume", methods=["GET"])
 def dequeue():
     dict = request.get_json()
@@ -71,14 +144,23 @@ def dequeue():
     consumer_id = str(dict['consumer_id'])
     partition_id = (dict['partition_id'])
     offset = (dict['offset'])
+    # long poll: wait up to max_wait_ms for a message instead of failing right away
+    max_wait_ms = dict.get('max_wait_ms', 0)
+    if 'leader_epoch' in dict and broker.stale_epoch(topic, partition_id, dict['leader_epoch']):
+        return stale_epoch(topic, partition_id)
+    if 'max_messages' in dict or 'max_bytes' in dict:
+        return fetch(topic, consumer_id, partition_id, offset,
+                     dict.get('max_messages', FETCH_MAX_MESSAGES), dict.get('max_bytes', FETCH_MAX_BYTES), max_wait_ms)
     # if topic exists send consumer id
     status = broker.dequeue(
-        topic_name=topic, partition_id=partition_id, offset=offset)
+        topic_name=topic, partition_id=partition_id, offset=offset, max_wait_ms=max_wait_ms)
     response = {}
 
     if isinstance(status, str):
         response["status"] = "Success"
         response["message"] = status
+        if codec_of(status) is not None:
+            response["codec"] = codec_of(status)
     else:
         response["status"] = "Failure"
         if status == -1:
@@ -87,10 +169,157 @@ def dequeue():
             response["message"] = f"Consumer {consumer_id} is not registered for topic {topic}."
         elif status == -2:
             response["message"] = f"No more messages for {consumer_id}"
+        elif status == -4:
+            response["message"] = f"Offset {offset} was removed by retention."
+            response["log_start_offset"] = broker.start_offset(topic, partition_id)
+
+    return response
+
+
+def stale_epoch(topic, partition_id):
+    # the client's metadata is outdated, it fetches /cluster/metadata again
+    return {"status": "Failure", "message": f"Leader epoch of topic {topic}, partition {partition_id} is stale.",
+            "stale_epoch": True}
+
+
+def fetch(topic, consumer_id, partition_id, offset, max_messages, max_bytes, max_wait_ms):
+    # fetch mode of /consumer/consume, returns a contiguous run of messages
+    status = broker.fetch(topic_name=topic, partition_id=partition_id, offset=offset,
+                          max_messages=max_messages, max_bytes=max_bytes, max_wait_ms=max_wait_ms)
+    response = {}
+
+    if status == -1:
+        response["status"] = "Failure"
+        response["message"] = f"Topic {topic} does not exist."
+        return response
+    if status == -4:
+        response["status"] = "Failure"
+        response["message"] = f"Offset {offset} was removed by retention."
+        response["log_start_offset"] = broker.start_offset(topic, partition_id)
+        return response
+
+    messages, high_watermark = status
+    response["high_watermark"] = high_watermark
+    if len(messages) > 0:
+        response["status"] = "Success"
+        response["messages"] = messages
+        if any(codec_of(message) is not None for message in messages):
+            response["codecs"] = [codec_of(message) for message in messages]
+        response["offset"] = offset
+        response["next_offset"] = offset + len(messages)
+    else:
+        response["status"] = "Failure"
+        response["message"] = f"No more messages for {consumer_id}"
+
+    return response
+
+
+@app.route("/consumer/subscribe", methods=["GET"])
+def subscribe():
+    # live tail of a partition as server-sent events, see LiveTail.py
+    # arguments come from the query string so browsers' EventSource can subscribe
+    topic = request.args['topic_name']
+    partition_id = int(request.args['partition_id'])
+    if not broker.topic_exists(topic, partition_id):
+        return {"status": "Failure", "message": f"Topic {topic} does not exist."}
+    # resume after the last event received, else from offset, else only new messages
+    offset = request.headers.get('Last-Event-ID', request.args.get('offset'))
+    offset = int(offset) if offset is not None else broker.high_watermark(topic, partition_id)
+    max_messages = int(request.args.get('max_messages', SUBSCRIBE_MAX_MESSAGES))
+    max_bytes = int(request.args.get('max_bytes', SUBSCRIBE_MAX_BYTES))
+
+    events = tail(broker, topic, partition_id, offset, max_messages, max_bytes, release=db.session.remove)
+    return Response(stream_with_context(events), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/replica/append", methods=["POST"])
+def replica_append():
+    # messages pushed by the partition's leader, see Replication.py
+    dict = request.get_json()
+    topic = dict['topic_name']
+    partition_id = dict['partition_id']
+    offset = dict['offset']
+    codecs = dict.get('codecs') or [None] * len(dict['messages'])
+    messages = [message if codec is None else CompressedBatch(message, codec)
+                for message, codec in zip(dict['messages'], codecs)]
+    response = {}
+    if not fence.accept(topic, partition_id, dict['leader_epoch']):
+        response["status"] = "Failure"
+        response["message"] = f"Leader epoch {dict['leader_epoch']} of topic {topic} is stale."
+        return response
+
+    status = broker.replicate(topic, partition_id, offset, messages, reset=dict.get('reset', False))
+    if status >= 0:
+        response["status"] = "Success"
+        response["high_watermark"] = status
+    else:
+        response["status"] = "Failure"
+        if status == -2:
+            response["message"] = f"Log of topic {topic} does not end at offset {offset}."
+            response["high_watermark"] = broker.high_watermark(topic, partition_id)
+        else:
+            response["message"] = f"Messages could not be added to topic {topic}."
+
+    return response
+
+
+@app.route("/offsets/time", methods=["GET"])
+def offset_for_time():
+    # resolves an append time (ms since the epoch) to the first offset appended at or after it
+    dict = request.get_json()
+    topic = dict['topic_name']
+    partition_id = dict['partition_id']
+    timestamp = dict['timestamp']
+
+    status = broker.offset_for_time(topic_name=topic, partition_id=partition_id, timestamp_ms=timestamp)
+    response = {}
+
+    if status >= 0:
+        response["status"] = "Success"
+        response["offset"] = status
+    else:
+        response["status"] = "Failure"
+        response["message"] = f"Topic {topic} does not exist."
 
     return response
 
 
+@app.route("/topics/retention", methods=["POST", "GET"])
+def retention():
+    if request.method == "POST":
+        dict = request.get_json()
+        topic = dict['topic_name']
+        status = RetentionPolicy.setPolicy(topic, dict.get('max_age_ms'), dict.get('max_bytes'),
+                                           dict.get('max_messages'))
+        response = {}
+        if status == -1:
+            response["status"] = "Failure"
+            response["message"] = f"Retention policy for topic {topic} could not be set."
+        else:
+            response["status"] = "Success"
+        return response
+
+    policies = RetentionPolicy.getPolicies()
+    return {"status": "Success",
+            "policies": {topic: {"max_age_ms": max_age_ms, "max_bytes": max_bytes, "max_messages": max_messages}
+                         for topic, (max_age_ms, max_bytes, max_messages) in policies.items()}}
+
+
+@app.route("/stats/cache", methods=["GET"])
+def cache_stats():
+    if broker.cache is None:
+        return {"status": "Failure", "message": "Tail cache is disabled."}
+    return {"status": "Success", "cache": broker.cache.stats()}
+
+
+@app.route("/stats/group_commit", methods=["GET"])
+def group_commit_stats():
+    if broker.group_commit is None:
+        return {"status": "Failure", "message": "Group commit is disabled."}
+    return {"status": "Success", "group_commit": broker.group_commit.stats()}
+
+
 @app.route("/size", methods=["GET"])
 def size():
     dict = request.get_json()
@@ -153,19 +382,84 @@ def cmdline_args():
                         help="write manager IP address", type=str, default="write_manager")
     parser.add_argument("-mPort", "--managerPort",
                         help="write manager port number", type=int, default=5000)
+    parser.add_argument("--storage", help="storage engine for messages", choices=STORAGE_ENGINES,
+                        type=str, default=os.getenv('STORAGE_ENGINE', 'postgres'))
+    parser.add_argument("--log-dir", help="segment directory for the segment storage engine",
+                        type=str, default=os.getenv('LOG_DIR', 'broker_log'))
+    parser.add_argument("--segment-bytes", help="roll segments once they reach this size",
+                        type=int, default=SEGMENT_BYTES)
+    parser.add_argument("--segment-fsync", help="fsync segment files on every append",
+                        action="store_true")
+    parser.add_argument("--cache-messages", help="messages cached per partition, 0 disables the tail cache",
+                        type=int, default=PARTITION_MAX_MESSAGES)
+    parser.add_argument("--cache-bytes", help="memory limit of the tail cache",
+                        type=int, default=CACHE_MAX_BYTES)
+    parser.add_argument("--retention-ms", help="default maximum message age, unlimited if not set",
+                        type=int, default=None)
+    parser.add_argument("--retention-bytes", help="default maximum bytes per partition, unlimited if not set",
+                        type=int, default=None)
+    parser.add_argument("--retention-messages", help="default maximum messages per partition, unlimited if not set",
+                        type=int, default=None)
+    parser.add_argument("--retention-check-ms", help="interval between retention passes",
+                        type=int, default=RETENTION_CHECK_MS)
+    parser.add_argument("--group-commit", help="commit concurrent produce requests together",
+                        action="store_true")
+    parser.add_argument("--linger-ms", help="how long a group commit waits for more messages",
+                        type=float, default=LINGER_MS)
+    parser.add_argument("--max-group-size", help="maximum number of messages per group commit",
+                        type=int, default=MAX_GROUP_SIZE)
+    parser.add_argument("--listen-notify", help="wake long polls on appends by other broker processes "
+                        "sharing the database (Postgres LISTEN/NOTIFY)", action="store_true")
+    parser.add_argument("--workers", help="worker processes sharing the port, 1 runs the development server",
+                        type=int, default=int(os.getenv('WORKERS', WORKERS)))
+    parser.add_argument("--threads", help="request threads per worker process",
+                        type=int, default=int(os.getenv('THREADS', THREADS)))
     # parser.add_argument("-mIP", "--managerIP",
     #                     help="read manager IP address", type=str, default="read_manager")
     # parser.add_argument("-mPort", "--managerPort",
     #                     help="read manager port number", type=int, default=8081)
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.storage == "segment" and args.workers > 1:
+        # segment files have a single writer
+        parser.error("the segment storage engine needs --workers 1")
+    return args
+
+
+def start_worker():
+    # runs in every process that serves requests, threads do not survive the fork
+    if args.group_commit:
+        broker.enable_group_commit(args.linger_ms, args.max_group_size, context=app.app_context)
+    if args.listen_notify or args.workers > 1:
+        # appends made by the other workers have to wake this worker's long polls
+        broker.notifier.enable_notify(publish_notify(db))
+        PostgresListener(broker.notifier, db_url)
+    # every process serving requests reports its own load, the write manager adds them up
+    heartbeat = Thread(target=broker.heartbeat, args=(args.managerIP, args.managerPort, broker_id, args.port),
+                       kwargs={"context": app.app_context}, daemon=True)
+    heartbeat.start()
 
 
 if __name__ == '__main__':
     args = cmdline_args()
 
+    if args.storage == "segment":
+        storage = get_storage(args.storage, log_dir=args.log_dir,
+                              segment_bytes=args.segment_bytes, fsync=args.segment_fsync)
+    else:
+        storage = get_storage(args.storage)
+    cache = TailCache(args.cache_messages, args.cache_bytes) if args.cache_messages > 0 else None
+    broker = LoggingQueue(storage=storage, cache=cache)
+    # retention runs once, in the master process with several workers
+    retention = RetentionEnforcer(storage, (args.retention_ms, args.retention_bytes, args.retention_messages),
+                                  interval_ms=args.retention_check_ms, context=app.app_context,
+                                  on_trim=broker.trimmed)
+    print(f"Using the {args.storage} storage engine.")
+
     # global broker
     with app.app_context():
+        storage.prepare()
         db.create_all()  # create db object.
+        broker.load_catalog()
         broker_id = ID.getID()
         if (broker_id == -1):
             hostname = socket.gethostname()
@@ -185,10 +479,14 @@ if __name__ == '__main__':
 
     # with ThreadPoolExecutor(max_workers=1) as executor:
     #     executor.submit(broker.heartbeat, args.managerIP, args.managerPort, broker_id)
-    executor = Thread(target=broker.heartbeat,args=(args.managerIP, args.managerPort, broker_id,args.port))
-    executor.daemon = True
-    executor.start()
-    app.run(host='0.0.0.0',port=args.port)
+    # replication runs once per broker, in the master with several workers
+    if args.workers > 1:
+        # the master appends nothing itself, the workers' appends wake the pushers;
+        # its retention tells the workers which partitions to drop from their caches
+        broker.notifier.enable_notify(publish_notify(db))
+        PostgresListener(broker.notifier, db_url)
+    Replicator(broker, args.managerIP, args.managerPort, broker_id, context=app.app_context)
+    serve(app, db, port=args.port, workers=args.workers, threads=args.threads, post_fork=start_worker)
 
     # TODO remove reloader = false if needed
     # app.run(debug=True, port=args.port, use_reloader=False)
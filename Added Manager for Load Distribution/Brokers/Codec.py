@@ -0,0 +1,32 @@
+# Compressed message batches
+# Producers may compress a batch of messages into one entry (base64 of the
+# compressed JSON list). Brokers never decompress it, they store the payload
+# as one message and record which codec was used so consumers can decode it.
+from typing import Optional
+
+# stdlib codecs a batch may be compressed with, the position is the on-disk id
+CODECS = ["zlib", "lzma", "bz2"]
+
+
+class CompressedBatch(str):
+    """Base64 payload of a compressed batch, tagged with its codec."""
+
+    def __new__(cls, payload: str, codec: str):
+        batch = super().__new__(cls, payload)
+        batch.codec = codec
+        return batch
+
+
+def codec_of(message: str) -> Optional[str]:
+    # None for a plain message
+    return getattr(message, "codec", None)
+
+
+def codec_id(message: str) -> int:
+    # compact on-disk form, 0 for a plain message and n for CODECS[n - 1]
+    codec = codec_of(message)
+    return 0 if codec is None else CODECS.index(codec) + 1
+
+
+def from_codec_id(payload: str, codec_id: int) -> str:
+    return payload if codec_id == 0 else CompressedBatch(payload, CODECS[codec_id - 1])
@@ -0,0 +1,95 @@
+# Group commit for concurrent produce requests
+# Request threads hand their message to a single writer thread and block. The
+# writer collects whatever arrives within the linger time (up to a maximum
+# group size), appends the whole group in one transaction and only then wakes
+# every waiting request with its offset, so each acknowledged message is still
+# durable but the commit cost is shared by the group.
+import queue
+import threading
+from contextlib import nullcontext
+from time import monotonic
+from typing import Callable, List
+
+LINGER_MS = 2
+MAX_GROUP_SIZE = 500
+
+
+class PendingAppend:
+    def __init__(self, topic_name: str, partition_id: int, message: str) -> None:
+        self.topic_name = topic_name
+        self.partition_id = partition_id
+        self.message = message
+        self.offset = -1
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    def __init__(self, write_batch: Callable, linger_ms: float = LINGER_MS,
+                 max_group_size: int = MAX_GROUP_SIZE, context: Callable = None) -> None:
+        # write_batch: list of (topic, partition_id, message) -> [(topic, partition_id, base_offset, last_offset)] or -1
+        # context: returns a context manager the writes run in (e.g. app.app_context)
+        self.write_batch = write_batch
+        self.linger = linger_ms / 1000
+        self.max_group_size = max_group_size
+        self.context = context if context is not None else nullcontext
+        self.queue = queue.Queue()
+        self.groups = 0
+        self.messages = 0
+
+        writer = threading.Thread(target=self.run, daemon=True)
+        writer.start()
+
+    def submit(self, topic_name: str, partition_id: int, message: str) -> int:
+        # blocks until the group holding the message is committed, returns its offset or -1
+        pending = PendingAppend(topic_name, partition_id, message)
+        self.queue.put(pending)
+        pending.done.wait()
+        return pending.offset
+
+    def collect(self) -> List[PendingAppend]:
+        group = [self.queue.get()]
+        deadline = monotonic() + self.linger
+        while len(group) < self.max_group_size:
+            try:
+                remaining = deadline - monotonic()
+                if remaining > 0:
+                    group.append(self.queue.get(timeout=remaining))
+                else:
+                    # past the linger time, still take what is already queued
+                    group.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return group
+
+    def commit(self, group: List[PendingAppend]) -> None:
+        try:
+            with self.context():
+                ranges = self.write_batch([(p.topic_name, p.partition_id, p.message) for p in group])
+        except Exception as e:
+            print(e)
+            ranges = -1
+
+        if ranges != -1:
+            # offsets within a partition follow the order of the group
+            next_offsets = {(topic_name, int(partition_id)): base_offset
+                            for topic_name, partition_id, base_offset, _ in ranges}
+            for pending in group:
+                key = (pending.topic_name, int(pending.partition_id))
+                pending.offset = next_offsets[key]
+                next_offsets[key] += 1
+        self.groups += 1
+        self.messages += len(group)
+        for pending in group:
+            pending.done.set()
+
+    def run(self) -> None:
+        while True:
+            self.commit(self.collect())
+
+    def stats(self) -> dict:
+        return {
+            "groups": self.groups,
+            "messages": self.messages,
+            "average_group_size": self.messages / self.groups if self.groups else 0,
+            "queued": self.queue.qsize(),
+        }
@@ -0,0 +1,63 @@
+# Live tail subscriptions as server-sent events
+# A subscriber keeps one response open and every append to its partition is
+# pushed as a "messages" event. The event id is the next offset to read, so a
+# client reconnecting with Last-Event-ID resumes exactly where it stopped.
+# Flow control: a batch holds at most max_messages / max_bytes and the next one
+# is only read once the previous one was written, so a slow reader backs up its
+# TCP connection instead of broker memory.
+import json
+from time import monotonic
+from Codec import codec_of
+
+# idle streams get a comment this often, so dead subscribers are noticed
+KEEPALIVE_MS = 15000
+# defaults per pushed batch
+SUBSCRIBE_MAX_MESSAGES = 100
+SUBSCRIBE_MAX_BYTES = 1 << 18
+
+
+def sse_event(event: str, data: dict, event_id=None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def messages_event(partition_id: int, offset: int, messages, high_watermark: int) -> str:
+    data = {"partition_id": partition_id, "offset": offset, "next_offset": offset + len(messages),
+            "messages": messages, "high_watermark": high_watermark}
+    if any(codec_of(message) is not None for message in messages):
+        data["codecs"] = [codec_of(message) for message in messages]
+    return sse_event("messages", data, offset + len(messages))
+
+
+def tail(broker, topic_name: str, partition_id: int, offset: int, max_messages: int = SUBSCRIBE_MAX_MESSAGES,
+         max_bytes: int = SUBSCRIBE_MAX_BYTES, release=None):
+    # yields the events of a LoggingQueue partition from offset on, forever
+    # release: called after every read, returns the database connection while the stream waits
+    while True:
+        version = broker.notifier.version(topic_name, partition_id)
+        status = broker.fetch(topic_name=topic_name, partition_id=partition_id, offset=offset,
+                              max_messages=max_messages, max_bytes=max_bytes)
+        if status == -4:
+            # removed by retention, continue from the log start
+            offset = broker.start_offset(topic_name, partition_id)
+        if release is not None:
+            release()
+
+        if status == -1:
+            yield sse_event("error", {"partition_id": partition_id,
+                                      "message": f"Topic {topic_name} does not exist."})
+            return
+        if status == -4:
+            yield sse_event("reset", {"partition_id": partition_id, "offset": offset}, offset)
+            continue
+
+        messages, high_watermark = status
+        if messages:
+            yield messages_event(partition_id, offset, messages, high_watermark)
+            offset += len(messages)
+        elif not broker.notifier.wait(topic_name, partition_id, version, monotonic() + KEEPALIVE_MS / 1000):
+            yield ": keep-alive\n\n"
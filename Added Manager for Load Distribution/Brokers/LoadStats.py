@@ -0,0 +1,84 @@
+# Load statistics reported with every heartbeat
+# Counters are kept per process and reset by every snapshot, so a heartbeat
+# carries the rates since the previous one rather than running totals. Latencies
+# are service times of appends and reads; time spent parked by a long poll is
+# not counted.
+import math
+import os
+import threading
+from collections import deque
+from time import monotonic
+from typing import Dict, Tuple
+
+HEARTBEAT_MS = 1000
+# a heartbeat not answered within this long is dropped, the next one follows
+HEARTBEAT_TIMEOUT = 2
+# latency samples kept per heartbeat interval for the p99
+LATENCY_SAMPLES = 2048
+
+
+class LoadStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (topic, partition) -> [messages appended, bytes appended, messages fetched]
+        self.partitions: Dict[Tuple[str, int], list] = {}
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        # requests being served, including parked long polls and open streams
+        self.in_flight = 0
+        self.since = monotonic()
+
+    def _counters(self, topic_name: str, partition_id: int) -> list:
+        key = (topic_name, int(partition_id))
+        if key not in self.partitions:
+            self.partitions[key] = [0, 0, 0]
+        return self.partitions[key]
+
+    def appended(self, topic_name: str, partition_id: int, messages: int, size: int) -> None:
+        with self.lock:
+            counters = self._counters(topic_name, partition_id)
+            counters[0] += messages
+            counters[1] += size
+
+    def fetched(self, topic_name: str, partition_id: int, messages: int) -> None:
+        with self.lock:
+            self._counters(topic_name, partition_id)[2] += messages
+
+    def latency(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+
+    def request_started(self) -> None:
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def snapshot(self, usage=None, disk_bytes=None) -> dict:
+        # usage: {(topic, partition): (messages, bytes, high watermark)} from the storage engine
+        with self.lock:
+            partitions, self.partitions = self.partitions, {}
+            latencies, self.latencies = sorted(self.latencies), deque(maxlen=LATENCY_SAMPLES)
+            now, since, self.since = monotonic(), self.since, monotonic()
+            in_flight = self.in_flight
+        elapsed = max(now - since, 1e-3)
+
+        report = {
+            "worker": os.getpid(),
+            "interval_ms": round(elapsed * 1000),
+            "append_rate": sum(counters[0] for counters in partitions.values()) / elapsed,
+            "bytes_in_rate": sum(counters[1] for counters in partitions.values()) / elapsed,
+            "fetch_rate": sum(counters[2] for counters in partitions.values()) / elapsed,
+            "queue_depth": in_flight,
+            "p99_latency_ms": latencies[math.ceil(0.99 * len(latencies)) - 1] * 1000 if latencies else None,
+            "disk_bytes": disk_bytes,
+            "partitions": [],
+        }
+        for key in (usage or {}).keys() | partitions.keys():
+            messages, size, high_watermark = (usage or {}).get(key, (None, None, None))
+            appended, appended_bytes, fetched = partitions.get(key, (0, 0, 0))
+            report["partitions"].append({"topic_name": key[0], "partition_id": key[1],
+                                         "messages": messages, "bytes": size, "high_watermark": high_watermark,
+                                         "append_rate": appended / elapsed, "bytes_in_rate": appended_bytes / elapsed,
+                                         "fetch_rate": fetched / elapsed})
+        return report
@@ -0,0 +1,145 @@
+# Long-poll support for the consume path
+# A consume request that finds its partition empty can park until an append to
+# that partition wakes it (or its max_wait_ms runs out). Appends made by this
+# process wake waiters directly; with LISTEN/NOTIFY enabled, appends made by any
+# other broker process sharing the database are relayed through Postgres.
+import json
+import select
+import psycopg2
+import threading
+from time import monotonic, sleep
+from typing import Dict, Iterable, Tuple
+
+# upper bound for max_wait_ms, a parked request holds a server thread
+MAX_WAIT_MS = 30000
+NOTIFY_CHANNEL = "broker_append"
+# partitions per NOTIFY, keeps the payload below Postgres' 8000 byte limit
+NOTIFY_CHUNK = 50
+# marks a partition in a NOTIFY as cut back rather than appended to
+TRUNCATED = "truncated"
+
+
+class AppendNotifier:
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        # (topic, partition) -> number of appends seen, waiters compare against it
+        self.versions: Dict[Tuple[str, int], int] = {}
+        # appends seen across all partitions, for waiters interested in any of them
+        self.total = 0
+        # set by enable_notify, publishes appends to other processes
+        self.publish = None
+        # called with partitions another process cut back, drops what this process cached of them
+        self.on_truncate = None
+
+    def enable_notify(self, publish) -> None:
+        # publish: list of (topic, partition_id) -> None, run in the appending thread
+        self.publish = publish
+
+    def version(self, topic_name: str, partition_id: int) -> int:
+        # read before checking for data, so an append in between is not missed
+        with self.condition:
+            return self.versions.get((topic_name, int(partition_id)), 0)
+
+    def wake(self, partitions: Iterable[Tuple[str, int]]) -> None:
+        with self.condition:
+            for topic_name, partition_id in partitions:
+                key = (topic_name, int(partition_id))
+                self.versions[key] = self.versions.get(key, 0) + 1
+                self.total += 1
+            self.condition.notify_all()
+
+    def notify(self, partitions: Iterable[Tuple[str, int]]) -> None:
+        # called after an append to partitions has been committed
+        partitions = list(partitions)
+        self.wake(partitions)
+        if self.publish is not None:
+            try:
+                self.publish(partitions)
+            except Exception as e:
+                print("Notify Error:", e)
+
+    def truncated(self, partitions: Iterable[Tuple[str, int]]) -> None:
+        # called after partitions were cut back (see Replication.py) or trimmed by retention in this process
+        if self.publish is not None:
+            try:
+                self.publish([[topic_name, partition_id, TRUNCATED] for topic_name, partition_id in partitions])
+            except Exception as e:
+                print("Notify Error:", e)
+
+    def wait(self, topic_name: str, partition_id: int, version: int, deadline: float) -> bool:
+        # blocks until the partition moves past version or monotonic() reaches deadline,
+        # returns True if it was appended to
+        key = (topic_name, int(partition_id))
+        with self.condition:
+            while self.versions.get(key, 0) == version:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def wait_any(self, total: int, deadline: float) -> bool:
+        # like wait, for an append to any partition since total was read
+        with self.condition:
+            while self.total == total:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+
+class PostgresListener:
+    """Relays NOTIFYs on NOTIFY_CHANNEL from other broker processes to an AppendNotifier."""
+
+    def __init__(self, notifier: AppendNotifier, db_url: str, channel: str = NOTIFY_CHANNEL) -> None:
+        self.notifier = notifier
+        self.db_url = db_url
+        self.channel = channel
+
+        listener = threading.Thread(target=self.run, daemon=True)
+        listener.start()
+
+    def listen(self) -> None:
+        # LISTEN needs a dedicated connection outside the SQLAlchemy pool
+        connection = psycopg2.connect(self.db_url)
+        connection.set_session(autocommit=True)
+        try:
+            connection.cursor().execute(f'LISTEN "{self.channel}"')
+            while True:
+                if select.select([connection], [], [], 5) == ([], [], []):
+                    continue
+                connection.poll()
+                partitions, truncated = [], []
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    for partition in json.loads(notify.payload):
+                        if len(partition) > 2 and partition[2] == TRUNCATED:
+                            truncated.append((partition[0], partition[1]))
+                        else:
+                            partitions.append(tuple(partition))
+                if truncated and self.notifier.on_truncate is not None:
+                    self.notifier.on_truncate(truncated)
+                if partitions:
+                    self.notifier.wake(partitions)
+        finally:
+            connection.close()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                print("Listen Error:", e)
+                # appends missed while reconnecting only delay waiters until their timeout
+                sleep(1)
+
+
+def publish_notify(db, channel: str = NOTIFY_CHANNEL):
+    # returns a publish function for AppendNotifier.enable_notify that uses db's session
+    def publish(partitions) -> None:
+        for i in range(0, len(partitions), NOTIFY_CHUNK):
+            db.session.execute(db.text("SELECT pg_notify(:channel, :payload)"),
+                               {"channel": channel, "payload": json.dumps(partitions[i:i + NOTIFY_CHUNK])})
+        db.session.commit()
+    return publish
@@ -0,0 +1,55 @@
+# Multi-process serving of a Flask app
+# With one worker the app runs on the Flask development server as before. With
+# more, gunicorn's master binds the port (SO_REUSEPORT set) and pre-forks the
+# workers, which all accept on that listening socket and serve requests with a
+# thread pool. Anything started before serve() (threads, registration) stays in
+# the master, post_fork runs in every worker.
+from gunicorn.app.base import BaseApplication
+
+WORKERS = 1
+THREADS = 8
+# a worker is restarted if it does not check in for this long
+WORKER_TIMEOUT = 60
+
+
+class PreforkServer(BaseApplication):
+    def __init__(self, app, options: dict, post_fork=None) -> None:
+        self.application = app
+        self.options = options
+        self.post_fork = post_fork
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set("post_fork", lambda server, worker: self.post_fork())
+
+    def load(self):
+        return self.application
+
+
+def serve(app, db, port: int = None, workers: int = WORKERS, threads: int = THREADS, post_fork=None) -> None:
+    # db: the app's flask_sqlalchemy instance, every worker opens its own connection pool
+    # post_fork: called in every worker before it serves (once, in-process, with one worker)
+    if workers <= 1:
+        if post_fork is not None:
+            post_fork()
+        app.run(host='0.0.0.0', port=port)
+        return
+
+    def start_worker() -> None:
+        with app.app_context():
+            # connections inherited from the master stay open for the master
+            db.engine.dispose(close=False)
+        if post_fork is not None:
+            post_fork()
+
+    options = {
+        "bind": f"0.0.0.0:{port if port is not None else 5000}",
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "gthread",
+        "reuse_port": True,
+        "timeout": WORKER_TIMEOUT,
+    }
+    PreforkServer(app, options, start_worker).run()
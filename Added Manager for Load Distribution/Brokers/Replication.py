@@ -0,0 +1,186 @@
+# Partition replication between brokers
+# The write manager gives every partition of a replicated topic a leader, the
+# broker producers write to, and followers that keep copies at the same offsets.
+# The leader's Replicator pushes each follower what it is missing through
+# /replica/append. A follower whose log does not end where a push starts answers
+# with its high watermark and the leader continues from there, a follower ahead
+# of the leader (a former leader's unreplicated messages) cuts its log back first.
+# Progress goes back to the write manager with every sync, which keeps the
+# in-sync replica set and promotes a follower when a leader fails. Every change
+# of leader raises the partition's leader epoch, followers refuse pushes from
+# older epochs. Producers are acknowledged by the leader alone (acks=1), so
+# messages not yet copied when a leader fails are lost.
+import threading
+import requests
+from contextlib import nullcontext
+from time import monotonic, sleep
+from typing import Dict, Tuple
+from Codec import codec_of
+
+REPLICA_SYNC_MS = 1000
+# a follower that has not caught up with the leader for this long is out of sync
+REPLICA_LAG_MS = 10000
+# limits per push
+REPLICA_MAX_MESSAGES = 500
+REPLICA_MAX_BYTES = 1 << 20
+REPLICA_TIMEOUT = 5
+
+
+class EpochFence:
+    """Highest leader epoch seen per partition on a follower, per process."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.epochs: Dict[Tuple[str, int], int] = {}
+
+    def accept(self, topic_name: str, partition_id: int, leader_epoch: int) -> bool:
+        # False for pushes from a leader that has been replaced
+        key = (topic_name, int(partition_id))
+        with self.lock:
+            if leader_epoch < self.epochs.get(key, 0):
+                return False
+            self.epochs[key] = leader_epoch
+            return True
+
+
+class Replicator:
+    """Pushes the partitions led by this broker to their followers, one thread per follower."""
+
+    def __init__(self, broker, manager_ip: str, manager_port: int, broker_id, context=None,
+                 sync_ms: int = REPLICA_SYNC_MS, lag_ms: int = REPLICA_LAG_MS) -> None:
+        # broker: LoggingQueue, its notifier must see every append to the partitions led here
+        self.broker = broker
+        self.sync_url = f"http://{manager_ip}:{manager_port}/broker/replicas"
+        self.broker_id = int(broker_id)
+        self.context = context if context is not None else nullcontext
+        self.sync_interval = sync_ms / 1000
+        self.lag = lag_ms / 1000
+        self.lock = threading.Lock()
+        # (topic, partition) -> assignment from the write manager, for partitions led here
+        self.leading = {}
+        # (topic, partition, follower) -> [next offset to push or None if unknown, monotonic() when last caught up]
+        self.progress = {}
+        self.pushers = set()
+
+        replicator = threading.Thread(target=self.run, daemon=True)
+        replicator.start()
+
+    def report(self) -> list:
+        now = monotonic()
+        with self.lock:
+            partitions = []
+            for (topic_name, partition_id), assignment in self.leading.items():
+                followers = []
+                for follower in assignment["followers"]:
+                    next_offset, caught_up = self.progress.get((topic_name, partition_id, follower["broker_id"]),
+                                                               (None, None))
+                    followers.append({"broker_id": follower["broker_id"], "offset": next_offset,
+                                      "in_sync": caught_up is not None and now - caught_up <= self.lag})
+                partitions.append({"topic_name": topic_name, "partition_id": partition_id,
+                                   "leader_epoch": assignment["leader_epoch"], "followers": followers})
+            return partitions
+
+    def sync(self, session: requests.Session) -> None:
+        # reports follower progress and receives the partitions led here
+        r = session.post(self.sync_url, json={"broker_id": self.broker_id, "partitions": self.report()},
+                         timeout=REPLICA_TIMEOUT)
+        r.raise_for_status()
+        leading = {(assignment["topic_name"], assignment["partition_id"]): assignment
+                   for assignment in r.json()["partitions"]}
+        with self.lock:
+            for key, assignment in leading.items():
+                if key not in self.leading or self.leading[key]["leader_epoch"] != assignment["leader_epoch"]:
+                    # new leadership, followers are probed for their position again
+                    for follower in assignment["followers"]:
+                        self.progress.pop((key[0], key[1], follower["broker_id"]), None)
+            self.leading = leading
+            followers = {follower["broker_id"] for assignment in leading.values()
+                         for follower in assignment["followers"]}
+            started = followers - self.pushers
+            self.pushers |= started
+        for follower_id in started:
+            pusher = threading.Thread(target=self.push_loop, args=(follower_id,), daemon=True)
+            pusher.start()
+
+    def run(self) -> None:
+        session = requests.Session()
+        while True:
+            try:
+                self.sync(session)
+            except Exception as e:
+                print("Replication Error:", e)
+            sleep(self.sync_interval)
+
+    def assignments(self, follower_id: int) -> list:
+        with self.lock:
+            return [(key, assignment["leader_epoch"], follower["endpoint"])
+                    for key, assignment in self.leading.items()
+                    for follower in assignment["followers"] if follower["broker_id"] == follower_id]
+
+    def push_loop(self, follower_id: int) -> None:
+        # pushes to one follower for as long as it follows a partition led here
+        session = requests.Session()
+        while True:
+            total = self.broker.notifier.total
+            assignments = self.assignments(follower_id)
+            if not assignments:
+                with self.lock:
+                    self.pushers.discard(follower_id)
+                return
+            pushed = False
+            for (topic_name, partition_id), leader_epoch, endpoint in assignments:
+                try:
+                    with self.context():
+                        pushed |= self.push(session, follower_id, endpoint, topic_name, partition_id, leader_epoch)
+                except Exception as e:
+                    print("Replication Error:", e)
+                    with self.lock:
+                        self.progress.pop((topic_name, partition_id, follower_id), None)
+            if not pushed:
+                self.broker.notifier.wait_any(total, monotonic() + self.sync_interval)
+
+    def push(self, session: requests.Session, follower_id: int, endpoint: str, topic_name: str,
+             partition_id: int, leader_epoch: int) -> bool:
+        # one push of the messages the follower misses, returns True if there may be more to push
+        key = (topic_name, partition_id, follower_id)
+        with self.lock:
+            progress = self.progress.setdefault(key, [None, None])
+        if not self.broker.topic_exists(topic_name, partition_id):
+            return False
+        high_watermark = self.broker.high_watermark(topic_name, partition_id)
+        offset = progress[0]
+        if offset is None or offset > high_watermark:
+            # position unknown or ahead of this log: pushing at the high watermark
+            # makes the follower answer with its own or cut back to ours
+            offset = high_watermark
+        elif offset == high_watermark:
+            progress[1] = monotonic()
+            return False
+
+        messages, reset = [], False
+        if offset < high_watermark:
+            status = self.broker.fetch_once(topic_name, partition_id, offset, REPLICA_MAX_MESSAGES, REPLICA_MAX_BYTES)
+            if status == -4:
+                # removed by retention here, the follower starts over from the log start
+                offset, reset = self.broker.start_offset(topic_name, partition_id), True
+            elif status != -1:
+                messages = status[0]
+
+        data = {"topic_name": topic_name, "partition_id": partition_id, "leader_epoch": leader_epoch,
+                "offset": offset, "messages": messages, "reset": reset}
+        codecs = [codec_of(message) for message in messages]
+        if any(codec is not None for codec in codecs):
+            data["codecs"] = codecs
+        r = session.post(endpoint + "/replica/append", json=data, timeout=REPLICA_TIMEOUT)
+        r.raise_for_status()
+        response = r.json()
+        if "high_watermark" not in response:
+            # refused, e.g. a newer leader exists; the next sync updates the assignment
+            print(f"Replica {follower_id} refused {topic_name} partition {partition_id}: {response.get('message')}")
+            progress[0] = None
+            return False
+
+        progress[0] = response["high_watermark"]
+        if progress[0] >= high_watermark:
+            progress[1] = monotonic()
+        return response["status"] != "Success" or bool(messages)
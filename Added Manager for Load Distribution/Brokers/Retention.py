@@ -0,0 +1,52 @@
+# Background enforcement of per-topic retention policies
+# Every pass trims each partition down to its policy (RetentionPolicy row for
+# the topic, broker defaults otherwise). Offsets are never renumbered, the
+# partition's start offset just moves forward.
+import threading
+from contextlib import nullcontext
+from time import sleep
+from typing import Callable, Optional, Tuple
+from BrokerModels import RetentionPolicy
+
+RETENTION_CHECK_MS = 60000
+
+# (max_age_ms, max_bytes, max_messages)
+Policy = Tuple[Optional[int], Optional[int], Optional[int]]
+
+
+class RetentionEnforcer:
+    def __init__(self, storage, default_policy: Policy, interval_ms: int = RETENTION_CHECK_MS,
+                 context: Callable = None, on_trim: Callable = None) -> None:
+        self.storage = storage
+        self.default_policy = default_policy
+        self.interval = interval_ms / 1000
+        self.context = context if context is not None else nullcontext
+        # called with the [(topic, partition)] trimmed by a pass, cached copies of them are stale
+        self.on_trim = on_trim
+
+        enforcer = threading.Thread(target=self.run, daemon=True)
+        enforcer.start()
+
+    def enforce(self) -> None:
+        with self.context():
+            policies = RetentionPolicy.getPolicies()
+            trimmed = []
+            for topic_name, partition_id in self.storage.list_topics():
+                max_age_ms, max_bytes, max_messages = policies.get(topic_name, self.default_policy)
+                if max_age_ms is None and max_bytes is None and max_messages is None:
+                    continue
+                removed = self.storage.trim(topic_name, partition_id, max_age_ms=max_age_ms,
+                                            max_bytes=max_bytes, max_messages=max_messages)
+                if removed > 0:
+                    trimmed.append((topic_name, partition_id))
+                    print(f"Retention removed {removed} messages from topic {topic_name} with partition {partition_id}.")
+            if trimmed and self.on_trim is not None:
+                self.on_trim(trimmed)
+
+    def run(self) -> None:
+        while True:
+            sleep(self.interval)
+            try:
+                self.enforce()
+            except Exception as e:
+                print("Retention Error:", e)
@@ -0,0 +1,439 @@
+# Append-only segmented log storage engine
+# Each partition is a directory of segments, a segment is a set of files:
+#   <base_offset>.log        records   [offset u64][append time ms u64][length u32][crc32 u32][codec u8][payload]
+#   <base_offset>.index      sparse    [offset - base_offset u32][position u32]
+#   <base_offset>.timeindex  sparse    [append time ms u64][offset - base_offset u32]
+# Only the newest segment of a partition is appended to, it rolls over once it
+# grows past segment_bytes. Reads go through a read-only mmap of the segment.
+import os
+import mmap
+import struct
+import threading
+import zlib
+from time import time
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Tuple
+from urllib.parse import quote, unquote
+from Codec import codec_id, from_codec_id
+
+# codec ids as in Codec.codec_id
+RECORD_HEADER = struct.Struct(">QQIIB")
+INDEX_ENTRY = struct.Struct(">II")
+TIME_INDEX_ENTRY = struct.Struct(">QI")
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+INDEX_INTERVAL_BYTES = 4096
+# minimum time between two time index entries of a segment
+TIME_INDEX_INTERVAL_MS = 1000
+
+
+class Segment:
+    def __init__(self, directory: str, base_offset: int, index_interval_bytes: int,
+                 time_index_interval_ms: int = TIME_INDEX_INTERVAL_MS) -> None:
+        self.base_offset = base_offset
+        self.index_interval_bytes = index_interval_bytes
+        self.time_index_interval_ms = time_index_interval_ms
+        self.log_path = os.path.join(directory, f"{base_offset:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_offset:020d}.index")
+        self.time_index_path = os.path.join(directory, f"{base_offset:020d}.timeindex")
+        # a+b: appends always go to the end, the fd stays readable for mmap
+        self.log = open(self.log_path, "a+b")
+        self.index = open(self.index_path, "a+b")
+        self.time_index = open(self.time_index_path, "a+b")
+        self.size = os.fstat(self.log.fileno()).st_size
+        self.next_offset = base_offset
+        self.bytes_since_index = 0
+        self.relative_offsets: List[int] = []
+        self.positions: List[int] = []
+        self.timestamps: List[int] = []
+        self.time_offsets: List[int] = []
+        # newest append time, append times never go backwards within a segment
+        self.max_timestamp = 0
+        self._map = None
+
+        self.index.seek(0)
+        data = self.index.read()
+        for i in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size):
+            relative_offset, position = INDEX_ENTRY.unpack_from(data, i)
+            self.relative_offsets.append(relative_offset)
+            self.positions.append(position)
+
+        self.time_index.seek(0)
+        data = self.time_index.read()
+        for i in range(0, len(data) - len(data) % TIME_INDEX_ENTRY.size, TIME_INDEX_ENTRY.size):
+            timestamp, relative_offset = TIME_INDEX_ENTRY.unpack_from(data, i)
+            self.timestamps.append(timestamp)
+            self.time_offsets.append(relative_offset)
+        if self.timestamps:
+            self.max_timestamp = self.timestamps[-1]
+
+    def recover(self) -> None:
+        # rebuild next_offset by scanning from the last index entry, a torn or
+        # corrupt tail left behind by a crash is truncated away
+        entries = len(self.positions)
+        while self.positions and self.positions[-1] > self.size:
+            self.relative_offsets.pop()
+            self.positions.pop()
+        if os.fstat(self.index.fileno()).st_size != len(self.positions) * INDEX_ENTRY.size:
+            print(f"Dropping {entries - len(self.positions)} entries past the end of {self.index_path}.")
+            self.index.truncate(len(self.positions) * INDEX_ENTRY.size)
+
+        position = self.positions[-1] if self.positions else 0
+        self.log.seek(position)
+        data = self.log.read()
+        valid = 0
+        next_offset = self.base_offset + (self.relative_offsets[-1] if self.relative_offsets else 0)
+        while valid + RECORD_HEADER.size <= len(data):
+            offset, timestamp, length, crc, _ = RECORD_HEADER.unpack_from(data, valid)
+            payload = data[valid + RECORD_HEADER.size:valid + RECORD_HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            valid += RECORD_HEADER.size + length
+            next_offset = offset + 1
+            self.max_timestamp = max(self.max_timestamp, timestamp)
+        self.next_offset = next_offset
+        self.bytes_since_index = valid
+
+        entries = len(self.time_offsets)
+        while self.time_offsets and self.base_offset + self.time_offsets[-1] >= next_offset:
+            self.timestamps.pop()
+            self.time_offsets.pop()
+        if os.fstat(self.time_index.fileno()).st_size != len(self.time_offsets) * TIME_INDEX_ENTRY.size:
+            print(f"Dropping {entries - len(self.time_offsets)} entries past the end of {self.time_index_path}.")
+            self.time_index.truncate(len(self.time_offsets) * TIME_INDEX_ENTRY.size)
+
+        if position + valid < self.size:
+            print(f"Truncating {self.log_path} from {self.size} to {position + valid} bytes.")
+            self.log.truncate(position + valid)
+            self.size = position + valid
+
+    def append(self, messages: List[str], fsync: bool) -> None:
+        timestamp = max(int(time() * 1000), self.max_timestamp)
+        if not self.timestamps or timestamp - self.timestamps[-1] >= self.time_index_interval_ms:
+            self.time_index.write(TIME_INDEX_ENTRY.pack(timestamp, self.next_offset - self.base_offset))
+            self.timestamps.append(timestamp)
+            self.time_offsets.append(self.next_offset - self.base_offset)
+        self.max_timestamp = timestamp
+        buffer = bytearray()
+        for message in messages:
+            payload = message.encode()
+            if self.bytes_since_index >= self.index_interval_bytes:
+                self._add_index_entry(self.next_offset, self.size + len(buffer))
+            record = RECORD_HEADER.pack(self.next_offset, timestamp, len(payload), zlib.crc32(payload),
+                                        codec_id(message)) + payload
+            buffer += record
+            self.bytes_since_index += len(record)
+            self.next_offset += 1
+        self.log.write(buffer)
+        self.log.flush()
+        self.index.flush()
+        self.time_index.flush()
+        if fsync:
+            os.fsync(self.log.fileno())
+        # publish the new size only once the records are readable
+        self.size += len(buffer)
+
+    def _add_index_entry(self, offset: int, position: int) -> None:
+        self.index.write(INDEX_ENTRY.pack(offset - self.base_offset, position))
+        self.relative_offsets.append(offset - self.base_offset)
+        self.positions.append(position)
+        self.bytes_since_index = 0
+
+    def _view(self, size: int):
+        view = self._map
+        if view is None or len(view) < size:
+            # the active segment grows, remap to cover the published size
+            view = mmap.mmap(self.log.fileno(), size, access=mmap.ACCESS_READ)
+            self._map = view
+        return view
+
+    def read(self, offset: int, max_messages: int, max_bytes: int, first: bool) -> Tuple[List[str], int]:
+        # returns (messages, bytes read) starting at offset within this segment
+        # the first message of a fetch is returned even if it exceeds max_bytes
+        size = self.size
+        messages = []
+        total_bytes = 0
+        if size == 0:
+            return messages, total_bytes
+        view = self._view(size)
+        i = bisect_right(self.relative_offsets, offset - self.base_offset) - 1
+        position = self.positions[i] if i >= 0 else 0
+        while position < size and len(messages) < max_messages:
+            record_offset, _, length, _, codec = RECORD_HEADER.unpack_from(view, position)
+            start = position + RECORD_HEADER.size
+            position = start + length
+            if record_offset < offset:
+                continue
+            if (messages or not first) and total_bytes + length > max_bytes:
+                break
+            total_bytes += length
+            messages.append(from_codec_id(view[start:position].decode(), codec))
+        return messages, total_bytes
+
+    def offset_for_time(self, timestamp: int):
+        # first offset in this segment appended at or after timestamp, None if there is none
+        size = self.size
+        if size == 0:
+            return None
+        view = self._view(size)
+        i = bisect_left(self.timestamps, timestamp) - 1
+        offset = self.base_offset + (self.time_offsets[i] if i >= 0 else 0)
+        i = bisect_right(self.relative_offsets, offset - self.base_offset) - 1
+        position = self.positions[i] if i >= 0 else 0
+        while position < size:
+            record_offset, record_timestamp, length, _, _ = RECORD_HEADER.unpack_from(view, position)
+            if record_offset >= offset and record_timestamp >= timestamp:
+                return record_offset
+            position += RECORD_HEADER.size + length
+        return None
+
+    def seal(self, fsync: bool) -> None:
+        self.log.flush()
+        self.index.flush()
+        self.time_index.flush()
+        if fsync:
+            os.fsync(self.log.fileno())
+            os.fsync(self.index.fileno())
+            os.fsync(self.time_index.fileno())
+
+    def last_modified(self) -> float:
+        return os.fstat(self.log.fileno()).st_mtime
+
+    def delete(self) -> None:
+        # readers still holding the mmap keep it valid, the file goes away with the last reference
+        self.log.close()
+        self.index.close()
+        self.time_index.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+        os.remove(self.time_index_path)
+
+
+class PartitionLog:
+    def __init__(self, directory: str, segment_bytes: int, index_interval_bytes: int, fsync: bool) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval_bytes = index_interval_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()   # serialises appends and segment rolls
+
+        os.makedirs(directory, exist_ok=True)
+        base_offsets = sorted(int(name[:-len(".log")]) for name in os.listdir(directory) if name.endswith(".log"))
+        if not base_offsets:
+            base_offsets = [0]
+        segments = [Segment(directory, base_offset, index_interval_bytes) for base_offset in base_offsets]
+        for segment, next_base in zip(segments, base_offsets[1:]):
+            segment.next_offset = next_base
+        segments[-1].recover()
+        # (base_offsets, segments), replaced as a whole on roll and trim so
+        # readers always see a consistent pair without taking the lock
+        self.layout = (base_offsets, segments)
+
+    @property
+    def start_offset(self) -> int:
+        return self.layout[0][0]
+
+    @property
+    def high_watermark(self) -> int:
+        return self.layout[1][-1].next_offset
+
+    @property
+    def size(self) -> int:
+        # bytes in the partition's segment files
+        return sum(segment.size for segment in self.layout[1])
+
+    def append(self, messages: List[str]) -> int:
+        # returns the offset of the first message
+        with self.lock:
+            base_offsets, segments = self.layout
+            active = segments[-1]
+            if active.size >= self.segment_bytes:
+                active.seal(self.fsync)
+                active = Segment(self.directory, active.next_offset, self.index_interval_bytes)
+                self.layout = (base_offsets + [active.base_offset], segments + [active])
+            base_offset = active.next_offset
+            active.append(messages, self.fsync)
+            return base_offset
+
+    def offset_for_time(self, timestamp: int) -> int:
+        # first offset appended at or after timestamp, the high watermark if there is none
+        base_offsets, segments = self.layout
+        try:
+            # the first time index entry of a segment is its first record
+            for i in range(len(segments) - 1, -1, -1):
+                if segments[i].timestamps and segments[i].timestamps[0] < timestamp:
+                    offset = segments[i].offset_for_time(timestamp)
+                    if offset is not None:
+                        return offset
+                    return segments[i + 1].base_offset if i + 1 < len(segments) else segments[-1].next_offset
+        except ValueError:
+            # deleted by retention while we were reading it
+            pass
+        return base_offsets[0]
+
+    def read(self, offset: int, max_messages: int, max_bytes: int) -> List[str]:
+        messages = []
+        base_offsets, segments = self.layout
+        if offset < base_offsets[0] or offset >= segments[-1].next_offset:
+            return messages
+        i = bisect_right(base_offsets, offset) - 1
+        try:
+            while i < len(segments) and len(messages) < max_messages:
+                batch, read_bytes = segments[i].read(offset + len(messages), max_messages - len(messages),
+                                                     max_bytes, first=not messages)
+                if not batch:
+                    break
+                messages.extend(batch)
+                max_bytes -= read_bytes
+                i += 1
+        except ValueError:
+            # the segment was deleted by retention while we were reading it
+            pass
+        return messages
+
+    def trim(self, max_age_ms=None, max_bytes=None, max_messages=None) -> int:
+        # deletes whole segments that fall outside the retention limits, the active
+        # segment is never deleted, returns the number of messages removed
+        with self.lock:
+            base_offsets, segments = self.layout
+            high_watermark = segments[-1].next_offset
+            total_bytes = sum(segment.size for segment in segments)
+            now = time()
+            drop = 0
+            for segment, next_base in zip(segments, base_offsets[1:]):
+                expired = ((max_messages is not None and next_base <= high_watermark - max_messages) or
+                           (max_age_ms is not None and segment.last_modified() < now - max_age_ms / 1000) or
+                           (max_bytes is not None and total_bytes - segment.size >= max_bytes))
+                if not expired:
+                    break
+                total_bytes -= segment.size
+                drop += 1
+            if drop == 0:
+                return 0
+            self.layout = (base_offsets[drop:], segments[drop:])
+        for segment in segments[:drop]:
+            segment.delete()
+        return base_offsets[drop] - base_offsets[0]
+
+    def truncate(self, offset: int) -> int:
+        # drops offset and everything after it, whole segments at a time: the log
+        # continues from the base of the segment that held offset, or from offset
+        # if it is outside the log; returns the new high watermark
+        with self.lock:
+            base_offsets, segments = self.layout
+            if offset == segments[-1].next_offset:
+                return offset
+            if base_offsets[0] <= offset < segments[-1].next_offset:
+                keep = bisect_right(base_offsets, offset) - 1
+                new_base = base_offsets[keep]
+            else:
+                keep, new_base = 0, offset
+            # removed before the new segment reuses the file names
+            for segment in segments[keep:]:
+                segment.delete()
+            active = Segment(self.directory, new_base, self.index_interval_bytes)
+            self.layout = (base_offsets[:keep] + [new_base], segments[:keep] + [active])
+            return new_base
+
+
+class SegmentStorage:
+    """Stores every partition as rolling append-only segment files under log_dir."""
+
+    def __init__(self, log_dir: str, segment_bytes: int = SEGMENT_BYTES,
+                 index_interval_bytes: int = INDEX_INTERVAL_BYTES, fsync: bool = False) -> None:
+        self.log_dir = log_dir
+        self.segment_bytes = segment_bytes
+        self.index_interval_bytes = index_interval_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()   # guards the partitions dict
+        self.partitions: Dict[Tuple[str, int], PartitionLog] = {}
+
+        os.makedirs(log_dir, exist_ok=True)
+        for name in os.listdir(log_dir):
+            topic_name, _, partition_id = name.rpartition("-")
+            self.partitions[(unquote(topic_name), int(partition_id))] = self._open(name)
+        print(f"Loaded {len(self.partitions)} partitions from {log_dir}.")
+
+    def prepare(self) -> None:
+        pass
+
+    def _open(self, name: str) -> PartitionLog:
+        return PartitionLog(os.path.join(self.log_dir, name), self.segment_bytes,
+                            self.index_interval_bytes, self.fsync)
+
+    def _partition(self, topic_name: str, partition_id: int) -> PartitionLog:
+        return self.partitions.get((topic_name, int(partition_id)))
+
+    def check_topic(self, topic_name: str, partition_id: int) -> bool:
+        return self._partition(topic_name, partition_id) is not None
+
+    def create_topic(self, topic_name: str, partition_id: int):
+        with self.lock:
+            key = (topic_name, int(partition_id))
+            if key in self.partitions:
+                return -1
+            try:
+                self.partitions[key] = self._open(f"{quote(topic_name, safe='')}-{int(partition_id)}")
+            except OSError as e:
+                print(e)
+                return -1
+
+    def list_topics(self) -> List[Tuple[str, int]]:
+        return list(self.partitions.keys())
+
+    def append(self, topic_name: str, partition_id: int, message: str) -> int:
+        try:
+            return self._partition(topic_name, partition_id).append([message])
+        except OSError as e:
+            print(e)
+            return -1
+
+    def append_batch(self, messages: List[Tuple[str, int, str]]):
+        partitions = {}
+        for topic_name, partition_id, message in messages:
+            partitions.setdefault((topic_name, int(partition_id)), []).append(message)
+        ranges = []
+        try:
+            for (topic_name, partition_id), batch in partitions.items():
+                base_offset = self._partition(topic_name, partition_id).append(batch)
+                ranges.append((topic_name, partition_id, base_offset, base_offset + len(batch) - 1))
+        except OSError as e:
+            # partitions appended before the error keep their messages
+            print(e)
+            return -1
+        return ranges
+
+    def read(self, topic_name: str, partition_id: int, offset: int):
+        messages = self._partition(topic_name, partition_id).read(offset, 1, 1)
+        return messages[0] if messages else -1
+
+    def read_range(self, topic_name: str, partition_id: int, offset: int, max_messages: int, max_bytes: int) -> List[str]:
+        return self._partition(topic_name, partition_id).read(offset, max_messages, max_bytes)
+
+    def high_watermark(self, topic_name: str, partition_id: int) -> int:
+        return self._partition(topic_name, partition_id).high_watermark
+
+    def start_offset(self, topic_name: str, partition_id: int) -> int:
+        return self._partition(topic_name, partition_id).start_offset
+
+    def size(self, topic_name: str, partition_id: int, offset: int) -> int:
+        return self.high_watermark(topic_name, partition_id) - offset
+
+    def usage(self):
+        # same contract as DatabaseStorage.usage, bytes are the log files' sizes
+        usage = {key: (log.high_watermark - log.start_offset, log.size, log.high_watermark)
+                 for key, log in list(self.partitions.items())}
+        return usage, sum(size for _, size, _ in usage.values())
+
+    def offset_for_time(self, topic_name: str, partition_id: int, timestamp_ms: int) -> int:
+        return self._partition(topic_name, partition_id).offset_for_time(timestamp_ms)
+
+    def trim(self, topic_name: str, partition_id: int, max_age_ms=None, max_bytes=None, max_messages=None) -> int:
+        return self._partition(topic_name, partition_id).trim(max_age_ms, max_bytes, max_messages)
+
+    def truncate(self, topic_name: str, partition_id: int, offset: int) -> int:
+        try:
+            return self._partition(topic_name, partition_id).truncate(offset)
+        except OSError as e:
+            print(e)
+            return -1
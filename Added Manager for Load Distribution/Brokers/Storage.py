@@ -0,0 +1,207 @@
+# Storage engines behind LoggingQueue
+# postgres: every message is a TopicMessage row in the broker database
+# postgres-partitioned: like postgres, but every topic partition is its own
+#           child table of a partitioned "TopicMessage"
+# postgres-compact: every message is a narrow PartitionMessage row keyed by the
+#           partition's integer key, existing TopicMessage rows are moved over
+# segment:  every partition is a set of append-only segment files (SegmentLog.py)
+from time import monotonic
+from typing import List, Tuple
+from BrokerModels import db, TopicName, TopicMessage, PartitionMessage, TimeIndex
+
+STORAGE_ENGINES = ["postgres", "postgres-partitioned", "postgres-compact", "segment"]
+
+# minimum time between two time index entries of a partition (per process)
+TIME_INDEX_INTERVAL_MS = 1000
+
+
+class DatabaseStorage:
+    """Stores topics and messages in the broker's Postgres database."""
+
+    def __init__(self, time_index_interval_ms: int = TIME_INDEX_INTERVAL_MS) -> None:
+        self.time_index_interval = time_index_interval_ms / 1000
+        # (topic, partition) -> monotonic() of the last time index entry written here
+        self.indexed_at = {}
+
+    def prepare(self) -> None:
+        # runs at startup inside the app context, before db.create_all()
+        TopicMessage.addOffset()
+        TopicName.addHighWatermark()
+        TopicName.addStartOffset()
+        TopicMessage.addCodec()
+        TopicMessage.addTimestamp()
+        TopicName.addPartitionKey()
+
+    def check_topic(self, topic_name: str, partition_id: int) -> bool:
+        return TopicName.CheckTopic(topic_name=topic_name, partition_id=partition_id)
+
+    def create_topic(self, topic_name: str, partition_id: int):
+        return TopicName.CreateTopic(topic_name=topic_name, partition_id=partition_id)
+
+    def list_topics(self) -> List[Tuple[str, int]]:
+        return TopicName.ListTopics()
+
+    def append(self, topic_name: str, partition_id: int, message: str) -> int:
+        offset = TopicMessage.addMessage(message=message, topic_name=topic_name, partition_id=partition_id)
+        if offset >= 0:
+            self.index_time(topic_name, partition_id, offset)
+        return offset
+
+    def append_batch(self, messages: List[Tuple[str, int, str]]):
+        ranges = TopicMessage.addMessages(messages)
+        if ranges != -1:
+            for topic_name, partition_id, _, last_offset in ranges:
+                self.index_time(topic_name, partition_id, last_offset)
+        return ranges
+
+    def index_time(self, topic_name: str, partition_id: int, offset: int) -> None:
+        # called once offset is committed, indexes it unless the partition got an entry recently
+        key = (topic_name, int(partition_id))
+        now = monotonic()
+        if key in self.indexed_at and now - self.indexed_at[key] < self.time_index_interval:
+            return
+        self.indexed_at[key] = now
+        TimeIndex.addEntry(topic_name, partition_id, offset)
+
+    def offset_for_time(self, topic_name: str, partition_id: int, timestamp_ms: int) -> int:
+        # first offset appended at or after timestamp_ms, the high watermark if there is none
+        start_offset = TopicName.getStartOffset(topic_name, partition_id)
+        floor = TimeIndex.floorOffset(topic_name, partition_id, timestamp_ms)
+        from_offset = start_offset if floor is None else max(floor, start_offset)
+        offset = self.first_offset_at_time(topic_name, partition_id, from_offset, timestamp_ms)
+        return TopicName.getHighWatermark(topic_name, partition_id) if offset is None else offset
+
+    def first_offset_at_time(self, topic_name: str, partition_id: int, from_offset: int, timestamp_ms: int):
+        return TopicMessage.firstOffsetAtTime(topic_name, partition_id, from_offset, timestamp_ms)
+
+    def read(self, topic_name: str, partition_id: int, offset: int):
+        return TopicMessage.retrieveMessage(topic_name=topic_name, partition_id=partition_id, offset=offset)
+
+    def read_range(self, topic_name: str, partition_id: int, offset: int, max_messages: int, max_bytes: int) -> List[str]:
+        return TopicMessage.retrieveMessages(topic_name=topic_name, partition_id=partition_id, offset=offset,
+                                             max_messages=max_messages, max_bytes=max_bytes)
+
+    def high_watermark(self, topic_name: str, partition_id: int) -> int:
+        return TopicName.getHighWatermark(topic_name, partition_id)
+
+    def start_offset(self, topic_name: str, partition_id: int) -> int:
+        return TopicName.getStartOffset(topic_name, partition_id)
+
+    def size(self, topic_name: str, partition_id: int, offset: int) -> int:
+        return TopicMessage.getSizeforTopic(topic_name=topic_name, partition_id=partition_id, offset=offset)
+
+    def trim(self, topic_name: str, partition_id: int, max_age_ms=None, max_bytes=None, max_messages=None) -> int:
+        keep_from = TopicMessage.retentionOffset(topic_name, partition_id, max_age_ms=max_age_ms,
+                                                 max_bytes=max_bytes, max_messages=max_messages)
+        if keep_from <= TopicName.getStartOffset(topic_name, partition_id):
+            return 0
+        return TopicMessage.trimPartition(topic_name, partition_id, keep_from)
+
+    def truncate(self, topic_name: str, partition_id: int, offset: int) -> int:
+        # drops offset and everything after it, returns the new high watermark
+        if TopicMessage.removeFrom(topic_name, partition_id, offset) == -1:
+            return -1
+        self.indexed_at.pop((topic_name, int(partition_id)), None)
+        return offset
+
+    def usage(self):
+        # ({(topic, partition): (messages, bytes, high watermark)}, bytes used by the database),
+        # a partition's bytes are its share of the message table by message count
+        counts = TopicName.messageCounts()
+        total = sum(messages for _, _, messages, _ in counts)
+        table_bytes = self.table_bytes()
+        usage = {(topic_name, partition_id): (messages, table_bytes * messages // total if total else 0, high_watermark)
+                 for topic_name, partition_id, messages, high_watermark in counts}
+        return usage, TopicName.databaseBytes()
+
+    def table_bytes(self) -> int:
+        return TopicMessage.tableBytes()
+
+
+class PartitionedDatabaseStorage(DatabaseStorage):
+    """Like DatabaseStorage, with one child table of "TopicMessage" per topic partition."""
+
+    def prepare(self) -> None:
+        super().prepare()
+        TopicMessage.createPartitionedTable()
+        db.create_all()
+        for topic_name, partition_id in TopicName.ListTopics():
+            TopicMessage.createPartition(topic_name, partition_id)
+
+    def create_topic(self, topic_name: str, partition_id: int):
+        # the child table first, so appends never see a partition without one
+        if TopicMessage.createPartition(topic_name, partition_id) == -1:
+            return -1
+        return TopicName.CreateTopic(topic_name=topic_name, partition_id=partition_id)
+
+    def trim(self, topic_name: str, partition_id: int, max_age_ms=None, max_bytes=None, max_messages=None) -> int:
+        keep_from = TopicMessage.retentionOffset(topic_name, partition_id, max_age_ms=max_age_ms,
+                                                 max_bytes=max_bytes, max_messages=max_messages)
+        if keep_from <= TopicName.getStartOffset(topic_name, partition_id):
+            return 0
+        if keep_from >= TopicName.getHighWatermark(topic_name, partition_id):
+            # everything expired, truncating the child table is instant
+            return TopicMessage.truncatePartition(topic_name, partition_id, keep_from)
+        return TopicMessage.trimPartition(topic_name, partition_id, keep_from)
+
+
+class CompactDatabaseStorage(DatabaseStorage):
+    """Like DatabaseStorage, with messages in the compact PartitionMessage table."""
+
+    def prepare(self) -> None:
+        super().prepare()
+        PartitionMessage.createCompactTable()
+        db.create_all()
+        moved = PartitionMessage.migrateRows()
+        if moved != 0:
+            print(f"Moved {moved} messages from TopicMessage to PartitionMessage.")
+
+    def append(self, topic_name: str, partition_id: int, message: str) -> int:
+        offset = PartitionMessage.addMessage(message=message, topic_name=topic_name, partition_id=partition_id)
+        if offset >= 0:
+            self.index_time(topic_name, partition_id, offset)
+        return offset
+
+    def append_batch(self, messages: List[Tuple[str, int, str]]):
+        ranges = PartitionMessage.addMessages(messages)
+        if ranges != -1:
+            for topic_name, partition_id, _, last_offset in ranges:
+                self.index_time(topic_name, partition_id, last_offset)
+        return ranges
+
+    def first_offset_at_time(self, topic_name: str, partition_id: int, from_offset: int, timestamp_ms: int):
+        return PartitionMessage.firstOffsetAtTime(topic_name, partition_id, from_offset, timestamp_ms)
+
+    def table_bytes(self) -> int:
+        return PartitionMessage.tableBytes()
+
+    def read(self, topic_name: str, partition_id: int, offset: int):
+        return PartitionMessage.retrieveMessage(topic_name=topic_name, partition_id=partition_id, offset=offset)
+
+    def read_range(self, topic_name: str, partition_id: int, offset: int, max_messages: int, max_bytes: int) -> List[str]:
+        return PartitionMessage.retrieveMessages(topic_name=topic_name, partition_id=partition_id, offset=offset,
+                                                 max_messages=max_messages, max_bytes=max_bytes)
+
+    def trim(self, topic_name: str, partition_id: int, max_age_ms=None, max_bytes=None, max_messages=None) -> int:
+        keep_from = PartitionMessage.retentionOffset(topic_name, partition_id, max_age_ms=max_age_ms,
+                                                     max_bytes=max_bytes, max_messages=max_messages)
+        if keep_from <= TopicName.getStartOffset(topic_name, partition_id):
+            return 0
+        return PartitionMessage.trimPartition(topic_name, partition_id, keep_from)
+
+    def truncate(self, topic_name: str, partition_id: int, offset: int) -> int:
+        if PartitionMessage.removeFrom(topic_name, partition_id, offset) == -1:
+            return -1
+        self.indexed_at.pop((topic_name, int(partition_id)), None)
+        return offset
+
+
+def get_storage(engine: str, **kwargs):
+    if engine == "postgres-partitioned":
+        return PartitionedDatabaseStorage()
+    if engine == "postgres-compact":
+        return CompactDatabaseStorage()
+    if engine == "segment":
+        from SegmentLog import SegmentStorage
+        return SegmentStorage(**kwargs)
+    return DatabaseStorage()
@@ -0,0 +1,114 @@
+# In-memory cache of the newest messages of every partition
+# Filled at enqueue time so that consumers reading close to the head of a
+# partition are served without touching the storage engine.
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+PARTITION_MAX_MESSAGES = 10000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class PartitionTail:
+    def __init__(self, base_offset: int) -> None:
+        self.base_offset = base_offset    # offset of messages[0]
+        self.messages: List[str] = []
+        self.bytes = 0
+
+    @property
+    def end_offset(self) -> int:
+        return self.base_offset + len(self.messages)
+
+    def drop(self, count: int) -> int:
+        # drops the oldest count messages, returns the bytes freed
+        freed = sum(len(message) for message in self.messages[:count])
+        del self.messages[:count]
+        self.base_offset += count
+        self.bytes -= freed
+        return freed
+
+
+class TailCache:
+    """Bounded ring of the most recent messages per (topic, partition)."""
+
+    def __init__(self, max_messages: int = PARTITION_MAX_MESSAGES, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # least recently appended partition first, evicted first when over max_bytes
+        self.partitions: Dict[Tuple[str, int], PartitionTail] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, topic_name: str, partition_id: int, offset: int, messages: List[str]) -> None:
+        # messages were appended at offset, offset + 1, ...
+        key = (topic_name, int(partition_id))
+        with self.lock:
+            tail = self.partitions.get(key)
+            if tail is None or offset != tail.end_offset:
+                # first append seen or a gap (another process appended in between),
+                # only a contiguous run can be served so start over
+                if tail is not None:
+                    self.bytes -= tail.bytes
+                tail = PartitionTail(offset)
+                self.partitions[key] = tail
+            self.partitions.move_to_end(key)
+
+            tail.messages.extend(messages)
+            added = sum(len(message) for message in messages)
+            tail.bytes += added
+            self.bytes += added
+
+            # trim in chunks of a quarter so the list shift is amortised
+            if len(tail.messages) > self.max_messages:
+                count = len(tail.messages) - self.max_messages + self.max_messages // 4
+                self.bytes -= tail.drop(count)
+                self.evictions += count
+
+            while self.bytes > self.max_bytes and self.partitions:
+                victim_key, victim = next(iter(self.partitions.items()))
+                count = max(1, len(victim.messages) // 4)
+                self.bytes -= victim.drop(count)
+                self.evictions += count
+                if not victim.messages:
+                    del self.partitions[victim_key]
+
+    def get(self, topic_name: str, partition_id: int, offset: int, max_messages: int = 1, max_bytes: int = 1):
+        # returns the cached run starting at offset, None if offset is outside the cached window
+        # the first message is returned even if it exceeds max_bytes
+        with self.lock:
+            tail = self.partitions.get((topic_name, int(partition_id)))
+            if tail is None or not tail.base_offset <= offset < tail.end_offset:
+                self.misses += 1
+                return None
+            self.hits += 1
+            start = offset - tail.base_offset
+            messages = []
+            total_bytes = 0
+            for message in tail.messages[start:start + max_messages]:
+                if messages and total_bytes + len(message) > max_bytes:
+                    break
+                total_bytes += len(message)
+                messages.append(message)
+            return messages
+
+    def evict(self, topic_name: str, partition_id: int) -> None:
+        # forgets a partition whose log was cut back
+        with self.lock:
+            tail = self.partitions.pop((topic_name, int(partition_id)), None)
+            if tail is not None:
+                self.bytes -= tail.bytes
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "partitions": len(self.partitions),
+                "messages": sum(len(tail.messages) for tail in self.partitions.values()),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,23 @@
+import base64
+import bz2
+import json
+import lzma
+import zlib
+
+# codec name -> (compress, decompress), names match what brokers accept
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+}
+
+
+def encode_batch(messages, codec):
+    # list of messages -> base64 text of the compressed JSON list
+    compress, _ = CODECS[codec]
+    return base64.b64encode(compress(json.dumps(messages).encode())).decode()
+
+
+def decode_batch(payload, codec):
+    _, decompress = CODECS[codec]
+    return json.loads(decompress(base64.b64decode(payload)).decode())
@@ -1,12 +1,28 @@
+import json
 import requests
+from time import sleep, monotonic
+from .Compression import decode_batch
+from .Metadata import ClusterMetadata
 # When broker is down: block hoke baith jao
 
+# direct mode commits offsets to the write manager at most this often
+COMMIT_MS = 5000
+
 class MyConsumer:
-    def __init__(self, topics, broker, partition_ids):
+    def __init__(self, topics, broker, partition_ids, direct=False):
+        # direct: read from the partitions' leaders and keep the offsets here,
+        # committing them to the write manager every COMMIT_MS
         self.topics = topics
         self.base_url = broker
         self.partition_ids = partition_ids
         self.topics_to_consumer_ids = {}
+        self.metadata = ClusterMetadata(broker) if direct else None
+        # topic -> {partition_id: next offset}, and the offsets last committed
+        self.offsets = {}
+        self.committed = {}
+        self.committed_at = monotonic()
+        # topic -> index of the partition to try first
+        self.next_partition = {}
 
         for i, topic_name in enumerate(topics):
             self.subscribe_to_topic(topic_name, partition_ids[i])
@@ -53,11 +69,14 @@ class MyConsumer:
             print("Error Connecting:", errc)
             return {"status": "Failed", "message": "Error Connecting"}
 
-    def get_next(self, topic_name):
+    def get_next(self, topic_name, max_wait_ms=None):
+        # max_wait_ms: wait up to this long for a message when none is available
 
         if topic_name not in self.topics_to_consumer_ids:
             print(f"Please register to {topic_name}")
             return
+        if self.metadata is not None:
+            return self.get_next_direct(topic_name, max_wait_ms)
 
         send_url = self.base_url + "/consumer/consume"
         data = {
@@ -66,6 +85,8 @@ class MyConsumer:
         }
         if self.partition_ids[self.topics.index(topic_name)] is not None:
             data["partition_id"] = self.partition_ids[self.topics.index(topic_name)]
+        if max_wait_ms is not None:
+            data["max_wait_ms"] = max_wait_ms
 
         try:
             r = requests.get(send_url, json=data)
@@ -74,6 +95,7 @@ class MyConsumer:
 
             if response["status"] == "Success":
                 print("Received successfully")
+                self.decompress(response)
             else:
                 print(f"Failed, {response['message']}")
 
@@ -85,6 +107,171 @@ class MyConsumer:
             print("Error Connecting:", errc)
             return {"status": "Failed", "message": "Error Connecting"}
 
+    def get_next_direct(self, topic_name, max_wait_ms=None):
+        # one hop: tries the partitions in turn on their leaders, see Metadata.py
+        consumer_id = self.topics_to_consumer_ids[topic_name]
+        if topic_name not in self.offsets:
+            partitions = self.metadata.refresh(topic_name, consumer_id)
+            self.offsets[topic_name] = {partition_id: partition["offset"] for partition_id, partition in partitions.items()}
+            self.committed[topic_name] = dict(self.offsets[topic_name])
+        offsets = self.offsets[topic_name]
+        partition_id = self.partition_ids[self.topics.index(topic_name)]
+        if partition_id is not None:
+            partition_ids = [partition_id]
+        else:
+            # partitions created since are read from offset 0, like a new registration
+            partition_ids = sorted(self.metadata.partitions(topic_name).keys())
+        if not partition_ids:
+            return {"status": "Failed", "message": "No partitions found"}
+
+        start = self.next_partition.get(topic_name, 0)
+        for i in range(len(partition_ids)):
+            partition_id = partition_ids[(start + i) % len(partition_ids)]
+            data = {
+                "topic_name": topic_name,
+                "consumer_id": consumer_id,
+                "partition_id": partition_id,
+                "offset": offsets.setdefault(partition_id, 0),
+            }
+            if max_wait_ms is not None and i == len(partition_ids) - 1:
+                # only the last partition is waited on
+                data["max_wait_ms"] = max_wait_ms
+            response = self.metadata.request("GET", topic_name, partition_id, "/consumer/consume", data)
+            if response.get("log_start_offset", -1) > offsets[partition_id]:
+                # removed by retention, continue from the log start next time
+                offsets[partition_id] = response["log_start_offset"]
+            if response["status"] == "Success":
+                offsets[partition_id] += 1
+                self.next_partition[topic_name] = (start + i + 1) % len(partition_ids)
+                print("Received successfully")
+                self.decompress(response)
+                if monotonic() - self.committed_at > COMMIT_MS / 1000:
+                    self.commit()
+                return response
+
+        print(f"Failed, {response['message']}")
+        return response
+
+    def commit(self):
+        # stores the direct mode offsets that moved since the last commit with the write manager
+        self.committed_at = monotonic()
+        send_url = self.base_url + "/consumer/offset"
+        for topic_name, offsets in self.offsets.items():
+            for partition_id, offset in offsets.items():
+                if self.committed[topic_name].get(partition_id) == offset:
+                    continue
+                data = {
+                    "topic_name": topic_name,
+                    "consumer_id": self.topics_to_consumer_ids[topic_name],
+                    "partition_id": partition_id,
+                    "offset": offset,
+                }
+                try:
+                    r = requests.post(send_url, json=data)
+                    r.raise_for_status()
+                    self.committed[topic_name][partition_id] = offset
+                except requests.exceptions.RequestException as e:
+                    print("Error Connecting:", e)
+
+    @staticmethod
+    def decompress(response):
+        # compressed batches are expanded into response["messages"]
+        if "codec" in response:
+            response["messages"] = decode_batch(response["message"], response["codec"])
+        elif "codecs" in response:
+            messages = []
+            for message, codec in zip(response["messages"], response["codecs"]):
+                if codec is None:
+                    messages.append(message)
+                else:
+                    messages.extend(decode_batch(message, codec))
+            response["messages"] = messages
+
+    def subscribe(self, topic_name, max_messages=None):
+        # live tail: yields a response like get_next's for every batch pushed by the
+        # server, reconnecting after the last batch received if the stream breaks
+
+        if topic_name not in self.topics_to_consumer_ids:
+            print(f"Please register to {topic_name}")
+            return
+
+        send_url = self.base_url + "/consumer/subscribe"
+        params = {
+            "topic_name": topic_name,
+            "consumer_id": self.topics_to_consumer_ids[topic_name],
+        }
+        if self.partition_ids[self.topics.index(topic_name)] is not None:
+            params["partition_id"] = self.partition_ids[self.topics.index(topic_name)]
+        if max_messages is not None:
+            params["max_messages"] = max_messages
+        last_event_id = None
+
+        while True:
+            headers = {} if last_event_id is None else {"Last-Event-ID": last_event_id}
+            try:
+                with requests.get(send_url, params=params, headers=headers, stream=True) as r:
+                    r.raise_for_status()
+                    if not r.headers.get("Content-Type", "").startswith("text/event-stream"):
+                        print(f"Failed, {r.json()['message']}")
+                        return
+                    event, event_id, data = None, None, None
+                    for line in r.iter_lines(decode_unicode=True):
+                        if line.startswith("event:"):
+                            event = line[len("event:"):].strip()
+                        elif line.startswith("id:"):
+                            event_id = line[len("id:"):].strip()
+                        elif line.startswith("data:"):
+                            data = json.loads(line[len("data:"):])
+                        elif not line and data is not None:
+                            if event_id is not None:
+                                last_event_id = event_id
+                            if event == "messages":
+                                data["status"] = "Success"
+                                self.decompress(data)
+                                yield data
+                            elif event == "error":
+                                print(f"Failed, {data['message']}")
+                            event, event_id, data = None, None, None
+            except requests.exceptions.HTTPError as errh:
+                print("Http Error:", errh)
+                return
+            except requests.exceptions.ConnectionError as errc:
+                print("Error Connecting:", errc)
+            sleep(1)
+
+    def seek_to_time(self, topic_name, timestamp_ms):
+        # the next get_next returns the first message appended at or after timestamp_ms
+
+        if topic_name not in self.topics_to_consumer_ids:
+            print(f"Please register to {topic_name}")
+            return
+
+        send_url = self.base_url + "/consumer/seek"
+        data = {
+            "topic_name": topic_name,
+            "consumer_id": self.topics_to_consumer_ids[topic_name],
+            "timestamp": timestamp_ms,
+        }
+        if self.partition_ids[self.topics.index(topic_name)] is not None:
+            data["partition_id"] = self.partition_ids[self.topics.index(topic_name)]
+
+        try:
+            r = requests.post(send_url, json=data)
+            r.raise_for_status()
+            response = r.json()
+            if response["status"] != "Success":
+                print(f"Failed, {response['message']}")
+            else:
+                # direct mode picks up the new offsets from the write manager
+                self.offsets.pop(topic_name, None)
+            return response
+        except requests.exceptions.HTTPError as errh:
+            print("Http Error:", errh)
+            return {"status": "Failed", "message": "Http Error"}
+        except requests.exceptions.ConnectionError as errc:
+            print("Error Connecting:", errc)
+            return {"status": "Failed", "message": "Error Connecting"}
+
     def subscribe_to_topic(self, topic_name, partition_id=None):
         if topic_name in self.topics_to_consumer_ids.keys():
             print(f"Consumer already registered to {topic_name}")
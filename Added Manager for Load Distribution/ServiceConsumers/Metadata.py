@@ -0,0 +1,70 @@
+import random
+import requests
+from time import monotonic
+
+# cached partitions of a topic are fetched again after this long
+METADATA_MAX_AGE_MS = 30000
+
+
+class ClusterMetadata:
+    # partitions, leaders and leader epochs from the write manager's /cluster/metadata,
+    # for clients that send produce and consume requests to the brokers directly
+    def __init__(self, base_url, max_age_ms=METADATA_MAX_AGE_MS):
+        self.url = base_url + "/cluster/metadata"
+        self.max_age = max_age_ms / 1000
+        # topic -> (monotonic() when fetched, {partition_id: partition})
+        self.topics = {}
+
+    def refresh(self, topic_name, consumer_id=None):
+        # with consumer_id every partition also carries the consumer's committed offset
+        data = {"topic_name": topic_name}
+        if consumer_id is not None:
+            data["consumer_id"] = consumer_id
+        try:
+            r = requests.get(self.url, json=data)
+            r.raise_for_status()
+            response = r.json()
+        except requests.exceptions.RequestException as e:
+            print("Error Connecting:", e)
+            return {}
+        if response["status"] != "Success":
+            print(f"Failed, {response['message']}")
+            return {}
+        partitions = {partition["partition_id"]: partition for partition in response["partitions"]}
+        self.topics[topic_name] = (monotonic(), partitions)
+        return partitions
+
+    def partitions(self, topic_name):
+        entry = self.topics.get(topic_name)
+        if entry is None or monotonic() - entry[0] > self.max_age:
+            return self.refresh(topic_name)
+        return entry[1]
+
+    def pick_partition(self, topic_name):
+        # a random partition, preferring those whose leader was active; None if there is none
+        partitions = self.partitions(topic_name)
+        active = [partition_id for partition_id, partition in partitions.items() if partition["active"]]
+        candidates = active or list(partitions.keys())
+        return random.choice(candidates) if candidates else None
+
+    def request(self, method, topic_name, partition_id, path, data):
+        # sends data with the leader epoch to the partition's leader; if the broker says
+        # the epoch is stale or cannot be reached, the metadata is fetched again and the
+        # request repeated once
+        response = {"status": "Failed", "message": f"Partition {partition_id} of topic {topic_name} not found"}
+        for attempt in range(2):
+            partition = self.partitions(topic_name).get(partition_id)
+            if partition is None:
+                return response
+            data["leader_epoch"] = partition["leader_epoch"]
+            try:
+                r = requests.request(method, partition["endpoint"] + path, json=data)
+                r.raise_for_status()
+                response = r.json()
+            except requests.exceptions.RequestException as e:
+                print("Error Connecting:", e)
+                response = {"status": "Failed", "message": "Error Connecting", "stale_epoch": True}
+            if not response.get("stale_epoch"):
+                return response
+            self.topics.pop(topic_name, None)
+        return response
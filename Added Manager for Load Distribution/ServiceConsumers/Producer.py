@@ -1,12 +1,16 @@
 import requests
+from .Compression import CODECS, encode_batch
+from .Metadata import ClusterMetadata
 
 
 class MyProducer:
-    def __init__(self, topics, broker):
+    def __init__(self, topics, broker, direct=False):
+        # direct: send messages to the partitions' leaders instead of through the write manager
         self.base_url = broker
 
         self.topics = topics
         self.topics_producer_id_map = {}
+        self.metadata = ClusterMetadata(broker) if direct else None
 
         for topic_name in self.topics:
             self.add_topic(topic_name)
@@ -57,6 +61,8 @@ class MyProducer:
         if topic_name not in self.topics_producer_id_map.keys():
             print(f"Please register to {topic_name}")
             return
+        if self.metadata is not None:
+            return self.send_direct(topic_name, message, partition_id)
         send_url = self.base_url + "/producer/produce"
         data = {
             "topic_name": topic_name,
@@ -82,6 +88,91 @@ class MyProducer:
             print("Error Connecting:", errc)
             return {"status": "Failed", "message": "Error Connecting"}
 
+    def send_batch(self, topic_name, messages, partition_id = None, compression = "zlib"):
+        # the whole batch travels and is stored as one compressed message
+        if compression not in CODECS:
+            print(f"Unknown compression {compression}")
+            return
+        if topic_name not in self.topics_producer_id_map.keys():
+            print(f"Please register to {topic_name}")
+            return
+        if self.metadata is not None:
+            return self.send_direct(topic_name, encode_batch(messages, compression), partition_id, codec=compression)
+        send_url = self.base_url + "/producer/produce"
+        data = {
+            "topic_name": topic_name,
+            "producer_id": self.topics_producer_id_map[topic_name],
+            "message": encode_batch(messages, compression),
+            "codec": compression
+        }
+        if partition_id is not None:
+            data["partition_id"] = partition_id
+        try:
+            r = requests.post(send_url, json=data)
+            r.raise_for_status()
+            response = r.json()
+            if response["status"] == "Success":
+                print(f"Sent batch of {len(messages)} successfully")
+            else:
+                print(f"Failed, {response['message']}")
+            return response
+        except requests.exceptions.HTTPError as errh:
+            print("Http Error:", errh)
+            return {"status": "Failed", "message": "Http Error"}
+        except requests.exceptions.ConnectionError as errc:
+            print("Error Connecting:", errc)
+            return {"status": "Failed", "message": "Error Connecting"}
+
+    def send_many(self, topic_name, messages, partition_id = None):
+        # many messages in one request, spread over the partitions and stored one by one;
+        # the write manager sends every broker its share at the same time
+        if topic_name not in self.topics_producer_id_map.keys():
+            print(f"Please register to {topic_name}")
+            return
+        send_url = self.base_url + "/producer/produce_batch"
+        data = {
+            "producer_id": self.topics_producer_id_map[topic_name],
+            "messages": messages
+        }
+        if partition_id is not None:
+            data["partition_id"] = partition_id
+        try:
+            r = requests.post(send_url, json=data)
+            r.raise_for_status()
+            response = r.json()
+            if response["status"] == "Success":
+                print(f"Sent {len(messages)} messages successfully")
+            else:
+                print(f"Failed, {response['message']}")
+            return response
+        except requests.exceptions.HTTPError as errh:
+            print("Http Error:", errh)
+            return {"status": "Failed", "message": "Http Error"}
+        except requests.exceptions.ConnectionError as errc:
+            print("Error Connecting:", errc)
+            return {"status": "Failed", "message": "Error Connecting"}
+
+    def send_direct(self, topic_name, message, partition_id=None, codec=None):
+        # one hop: straight to the leader of the partition, see Metadata.py
+        if partition_id is None:
+            partition_id = self.metadata.pick_partition(topic_name)
+            if partition_id is None:
+                print(f"Failed, no partitions for {topic_name}")
+                return {"status": "Failed", "message": "No partitions found"}
+        data = {
+            "topic_name": topic_name,
+            "partition_id": partition_id,
+            "message": message
+        }
+        if codec is not None:
+            data["codec"] = codec
+        response = self.metadata.request("POST", topic_name, partition_id, "/producer/produce", data)
+        if response["status"] == "Success":
+            print("Sent successfully")
+        else:
+            print(f"Failed, {response['message']}")
+        return response
+
     def add_topic(self, topic_name):
         if topic_name in self.topics_producer_id_map.keys():
             return
@@ -0,0 +1,82 @@
+# In-memory view of broker load, fed by heartbeats
+# Every process serving requests on a broker sends its own report (see
+# Brokers/LoadStats.py) once a second. A broker's load is the sum over its
+# recent reports; partition sizes come from the newest one. With several write
+# manager workers each keeps its own view from the heartbeats it receives.
+import threading
+from time import monotonic
+
+# reports older than this are ignored
+LOAD_TTL_MS = 5000
+
+
+def load_score(load) -> tuple:
+    # lower is less loaded: requests queued first, then messages moved per second;
+    # brokers without a report (just started) count as idle
+    if load is None:
+        return (0, 0)
+    return (load["queue_depth"], load["append_rate"] + load["fetch_rate"])
+
+
+class BrokerLoad:
+    def __init__(self, ttl_ms: int = LOAD_TTL_MS) -> None:
+        self.ttl = ttl_ms / 1000
+        self.lock = threading.Lock()
+        # broker_id -> worker -> (monotonic() when received, report)
+        self.reports = {}
+
+    def update(self, broker_id, report: dict) -> None:
+        now = monotonic()
+        with self.lock:
+            workers = self.reports.setdefault(int(broker_id), {})
+            workers[report.get("worker")] = (now, report)
+            for worker, (received, _) in list(workers.items()):
+                if now - received > self.ttl:
+                    del workers[worker]
+
+    def get(self, broker_id):
+        # aggregated load of a broker, None if it sent no recent report
+        now = monotonic()
+        with self.lock:
+            fresh = sorted(((received, report) for received, report in self.reports.get(int(broker_id), {}).values()
+                            if now - received <= self.ttl), key=lambda entry: entry[0])
+        if not fresh:
+            return None
+        latest = fresh[-1][1]
+        reports = [report for _, report in fresh]
+        latencies = [report["p99_latency_ms"] for report in reports if report["p99_latency_ms"] is not None]
+
+        partitions = {}
+        for report in reports:
+            for partition in report["partitions"]:
+                key = (partition["topic_name"], partition["partition_id"])
+                entry = partitions.setdefault(key, {"topic_name": key[0], "partition_id": key[1],
+                                                    "messages": None, "bytes": None, "high_watermark": None,
+                                                    "append_rate": 0, "bytes_in_rate": 0, "fetch_rate": 0})
+                for rate in ("append_rate", "bytes_in_rate", "fetch_rate"):
+                    entry[rate] += partition[rate]
+        for partition in latest["partitions"]:
+            entry = partitions[(partition["topic_name"], partition["partition_id"])]
+            entry["messages"], entry["bytes"] = partition["messages"], partition["bytes"]
+            entry["high_watermark"] = partition.get("high_watermark")
+
+        return {
+            "workers": len(reports),
+            "append_rate": sum(report["append_rate"] for report in reports),
+            "bytes_in_rate": sum(report["bytes_in_rate"] for report in reports),
+            "fetch_rate": sum(report["fetch_rate"] for report in reports),
+            "queue_depth": sum(report["queue_depth"] for report in reports),
+            # the slowest worker's, percentiles cannot be added up
+            "p99_latency_ms": max(latencies) if latencies else None,
+            "disk_bytes": latest["disk_bytes"],
+            "partitions": list(partitions.values()),
+        }
+
+    def all(self) -> dict:
+        with self.lock:
+            broker_ids = list(self.reports.keys())
+        loads = {broker_id: self.get(broker_id) for broker_id in broker_ids}
+        return {broker_id: load for broker_id, load in loads.items() if load is not None}
+
+    def score(self, broker_id) -> tuple:
+        return load_score(self.get(broker_id))
@@ -0,0 +1,62 @@
+# Consumer reads from follower replicas
+# A follower's position in PartitionReplica is the offset the leader last saw it
+# acknowledge, so every message below it is stored on the follower and is never
+# cut back by a change of leader. A read at offset O may therefore go to any
+# live, in-sync follower whose position is past O and at most max_lag messages
+# behind the leader (the staleness bound: a follower read returns at most what
+# the follower has). The leader and those followers compete on the load the
+# write manager sees in the heartbeats; catch-up reads spread over the replicas,
+# reads at the head of a partition stay on the leader.
+import threading
+from random import random
+from time import monotonic
+from ManagerModel import BrokerMetadata, PartitionMetadata, PartitionReplica
+from BrokerLoad import load_score
+from HttpPool import http_pool
+
+FOLLOWER_MAX_LAG = 1000
+# the write manager's load view is fetched at most this often
+LOAD_REFRESH_MS = 1000
+LOAD_TIMEOUT = 1
+
+
+class ReplicaChooser:
+    def __init__(self, load_url: str, max_lag: int = FOLLOWER_MAX_LAG, refresh_ms: int = LOAD_REFRESH_MS) -> None:
+        self.load_url = load_url
+        self.max_lag = max_lag
+        self.refresh = refresh_ms / 1000
+        self.lock = threading.Lock()
+        # broker_id -> aggregated load, from the write manager's /stats/brokers
+        self.loads = {}
+        self.fetched_at = None
+
+    def score(self, broker_id) -> tuple:
+        with self.lock:
+            stale = self.fetched_at is None or monotonic() - self.fetched_at > self.refresh
+            if stale:
+                # one thread refreshes, the others use the previous view meanwhile
+                self.fetched_at = monotonic()
+        if stale:
+            try:
+                brokers = http_pool.get(self.load_url, timeout=LOAD_TIMEOUT).json()["brokers"]
+                with self.lock:
+                    self.loads = {int(broker): load for broker, load in brokers.items()}
+            except Exception as e:
+                print("Load Error:", e)
+        with self.lock:
+            return load_score(self.loads.get(int(broker_id)))
+
+    def followers(self, topic_name, partition_id, offset) -> list:
+        # followers that can serve a read at offset
+        partition = PartitionMetadata.query.filter_by(topic_name=topic_name, partition_id=partition_id).first()
+        return [entry.broker_id for entry in PartitionReplica.getFollowers(partition.id)
+                if entry.in_sync and entry.offset is not None and entry.offset > offset
+                and partition.size - entry.offset <= self.max_lag and BrokerMetadata.checkBroker(entry.broker_id)]
+
+    def choose(self, topic_name, partition_id, leader_id, offset) -> int:
+        # the broker to read offset from, the leader unless a follower is less loaded
+        candidates = [leader_id] + self.followers(topic_name, partition_id, offset)
+        if len(candidates) == 1:
+            return leader_id
+        # ties are broken at random so that idle replicas share the reads
+        return min(candidates, key=lambda broker_id: (self.score(broker_id), random()))
@@ -0,0 +1,108 @@
+# Kept-alive HTTP connections of the managers
+# Requests forwarded to brokers and to the write manager go through one
+# requests.Session per process, whose adapter keeps up to HTTP_POOL_SIZE idle
+# connections per host (one pool per broker). Bursts above that open extra
+# connections that are closed after use. Every request gets a connect and a
+# read timeout; long polls add their max_wait_ms to the read timeout. The
+# session is created on first use in each process, worker processes forked by
+# Prefork.serve never share sockets with the master.
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_SIZE = 16
+# hosts whose pools are kept, more brokers than this evict the least recently used
+HTTP_POOL_HOSTS = 64
+HTTP_CONNECT_TIMEOUT = 2
+HTTP_READ_TIMEOUT = 10
+
+
+class HttpPool:
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = HTTP_READ_TIMEOUT) -> None:
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.session = None
+        self.adapter = None
+        self.pid = None
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.in_flight = 0
+
+    def configure(self, pool_size: int = None, connect_timeout: float = None, read_timeout: float = None) -> None:
+        # before the first request, e.g. from command line arguments
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+
+    def get_session(self) -> requests.Session:
+        with self.lock:
+            if self.session is None or self.pid != os.getpid():
+                self.adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount("http://", self.adapter)
+                session.mount("https://", self.adapter)
+                self.session, self.pid = session, os.getpid()
+                self.requests = self.errors = self.timeouts = self.in_flight = 0
+            return self.session
+
+    def request(self, method: str, url: str, wait_ms: int = 0, **kwargs) -> requests.Response:
+        # wait_ms: how long the other side may hold the request before answering (long polls)
+        session = self.get_session()
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout + (wait_ms or 0) / 1000))
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+        try:
+            return session.request(method, url, **kwargs)
+        except requests.exceptions.Timeout:
+            with self.lock:
+                self.timeouts += 1
+            raise
+        except requests.exceptions.RequestException:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def metrics(self) -> dict:
+        # this process' counters, and per host the connections opened and idle;
+        # connections opened much lower than requests means they are reused
+        hosts = {}
+        with self.lock:
+            adapter = self.adapter if self.pid == os.getpid() else None
+            metrics = {"pool_size": self.pool_size, "requests": self.requests, "errors": self.errors,
+                       "timeouts": self.timeouts, "in_flight": self.in_flight}
+        if adapter is not None:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                    "connections_opened": pool.num_connections,
+                    "requests": pool.num_requests,
+                    # the pool's queue holds None for slots without a connection
+                    "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                }
+        metrics["hosts"] = hosts
+        return metrics
+
+
+# shared by every request thread of the process
+http_pool = HttpPool()
@@ -0,0 +1,97 @@
+# Live tail subscriptions through the read manager
+# The read manager opens one server-sent event stream per partition on the
+# brokers (Brokers/LiveTail.py) and merges them into the consumer's stream. The
+# queue between them is bounded, so a slow consumer stops the relays from
+# reading and the brokers stop pushing. Consumer offsets are checkpointed to the
+# write manager every checkpoint_ms; the consumer's event id holds the exact
+# offsets ("partition:offset,...") for resuming with Last-Event-ID.
+import json
+import queue
+import requests
+from threading import Event, Thread
+
+# idle streams get a comment this often, brokers use the same interval
+KEEPALIVE_MS = 15000
+CHECKPOINT_MS = 5000
+# batches waiting to be written to the consumer, across all partitions
+RELAY_QUEUE = 16
+
+
+def sse_event(event: str, data: dict, event_id=None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def read_events(lines):
+    # parses a server-sent event stream into (event, data) pairs, comments are skipped
+    event, data = "message", []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
+
+def format_offsets(offsets: dict) -> str:
+    return ",".join(f"{partition_id}:{offset}" for partition_id, offset in sorted(offsets.items()))
+
+
+def parse_offsets(event_id: str) -> dict:
+    offsets = {}
+    for entry in event_id.split(","):
+        if entry:
+            partition_id, offset = entry.split(":")
+            offsets[int(partition_id)] = int(offset)
+    return offsets
+
+
+class PartitionRelay:
+    """Reads one partition's stream from its broker into the shared queue until stopped."""
+
+    def __init__(self, broker_endpoint: str, topic_name: str, partition_id: int, offset: int,
+                 events: queue.Queue, stop: Event, max_messages=None) -> None:
+        self.params = {"topic_name": topic_name, "partition_id": partition_id, "offset": offset}
+        if max_messages is not None:
+            self.params["max_messages"] = max_messages
+        self.url = broker_endpoint + "/consumer/subscribe"
+        self.partition_id = partition_id
+        self.events = events
+        self.stop = stop
+
+        relay = Thread(target=self.run, daemon=True)
+        relay.start()
+
+    def put(self, event: str, data: dict) -> bool:
+        # blocks while the queue is full, False once the subscription ended
+        while not self.stop.is_set():
+            try:
+                self.events.put((self.partition_id, event, data), timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self) -> None:
+        try:
+            # the read timeout is larger than the broker's keep-alive interval
+            with requests.get(self.url, params=self.params, stream=True, timeout=(2, 2 * KEEPALIVE_MS / 1000)) as r:
+                r.raise_for_status()
+                if not r.headers.get("Content-Type", "").startswith("text/event-stream"):
+                    self.put("error", {"partition_id": self.partition_id, "message": r.json()["message"]})
+                    return
+                for event, data in read_events(r.iter_lines(decode_unicode=True)):
+                    if not self.put(event, data) or event == "error":
+                        return
+        except requests.exceptions.RequestException as e:
+            print("Relay Error:", e)
+        # the broker went away, the consumer reconnects and is routed again
+        self.put("error", {"partition_id": self.partition_id,
+                           "message": f"Stream of partition {self.partition_id} ended."})
@@ -64,6 +64,13 @@ class BrokerMetadata(db.Model):
     def isActiveBroker(broker) -> bool:
         return (datetime.utcnow() - broker.last_beat_timestamp).total_seconds() < 0.3
 
+    @staticmethod
+    def getLiveBrokers(timeout_ms) -> list:
+        # brokers with a heartbeat in the last timeout_ms, more tolerant than isActiveBroker
+        # so that a late beat does not move partition leaders
+        return [broker.broker_id for broker in BrokerMetadata.query.all()
+                if (datetime.utcnow() - broker.last_beat_timestamp).total_seconds() * 1000 <= timeout_ms]
+
     @staticmethod
     def getBrokerEndpoint(broker_id: int) -> str:
         broker = BrokerMetadata.query.filter_by(broker_id=broker_id).first()
@@ -94,8 +101,14 @@ class PartitionMetadata(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     topic_name = db.Column(db.String())
     partition_id = db.Column(db.Integer())
-    broker_id = db.Column(db.Integer(), db.ForeignKey('BrokerMetadata.broker_id'))
+    broker_id = db.Column(db.Integer(), db.ForeignKey('BrokerMetadata.broker_id'))     # the leader with replication
     size = db.Column(db.Integer(), default=0)     # number of messages in that particular partition
+    leader_epoch = db.Column(db.Integer(), default=0)     # raised every time the leader changes
+
+    # tables created before replication get the column on startup
+    LEADER_EPOCH_DDL = '''
+        ALTER TABLE IF EXISTS "PartitionMetadata"
+        ADD COLUMN IF NOT EXISTS leader_epoch INTEGER DEFAULT 0'''
 
     __table_args__ = (
         # this can be db.PrimaryKeyConstraint if you want it to be a primary key
@@ -151,11 +164,31 @@ class PartitionMetadata(db.Model):
         return PartitionMetadata.query.filter_by(topic_name=topic_name, partition_id=partition_id).first().id
     
     @staticmethod
-    def increaseSize(topic_name, partition_id):
-        #increases the size when new message is received
-        partition = PartitionMetadata.query.filter_by(topic_name=topic_name, partition_id=partition_id).first()
-        partition.size += 1
-        db.session.commit()
+    def setSizes(sizes):
+        # sizes: {(topic_name, partition_id): (leader epoch, high watermark)}, written in one statement;
+        # within an epoch sizes never go down, a report from before a newer one may arrive late,
+        # a newer epoch replaces the size (the new leader's log may end below the old one's)
+        # and reports of older epochs are ignored
+        if not sizes:
+            return 0
+        values, params = [], {}
+        for i, ((topic_name, partition_id), (leader_epoch, size)) in enumerate(sizes.items()):
+            values.append(f"(:topic_{i}, :partition_{i}, :epoch_{i}, :size_{i})")
+            params.update({f"topic_{i}": topic_name, f"partition_{i}": int(partition_id),
+                           f"epoch_{i}": int(leader_epoch), f"size_{i}": int(size)})
+        try:
+            db.session.execute(db.text(f'''
+                UPDATE "PartitionMetadata" AS p SET size = CASE
+                    WHEN v.leader_epoch > COALESCE(p.leader_epoch, 0) THEN v.size
+                    ELSE GREATEST(COALESCE(p.size, 0), v.size) END
+                FROM (VALUES {", ".join(values)}) AS v(topic_name, partition_id, leader_epoch, size)
+                WHERE p.topic_name = v.topic_name AND p.partition_id = v.partition_id
+                AND v.leader_epoch >= COALESCE(p.leader_epoch, 0)'''), params)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            return -1
+        return len(sizes)
 
     @staticmethod
     def getSize(topic_name, partition_id):
@@ -170,6 +203,78 @@ class PartitionMetadata(db.Model):
         # check if the partition exists or not
         return PartitionMetadata.query.filter_by(topic_name=topic_name, partition_id=partition_id).count() > 0
 
+    @staticmethod
+    def addLeaderEpoch():
+        db.session.execute(db.text(PartitionMetadata.LEADER_EPOCH_DDL))
+        db.session.commit()
+
+
+# Table : Replicas (brokers following a partition's leader)
+# [partition_metadata, broker_id, offset, in_sync]
+class PartitionReplica(db.Model):
+    __tablename__ = 'PartitionReplica'
+    partition_metadata = db.Column(db.Integer(), db.ForeignKey('PartitionMetadata.id'), primary_key=True)
+    broker_id = db.Column(db.Integer(), db.ForeignKey('BrokerMetadata.broker_id'), primary_key=True)
+    offset = db.Column(db.BigInteger())     # next offset the follower needs, as last reported by the leader
+    in_sync = db.Column(db.Boolean, default=False)
+
+    def __init__(self, partition_metadata, broker_id):
+        self.partition_metadata = partition_metadata
+        self.broker_id = broker_id
+
+    @staticmethod
+    def getFollowers(partition_metadata):
+        return PartitionReplica.query.filter_by(partition_metadata=partition_metadata).all()
+
+    @staticmethod
+    def addFollowers(partition_metadata, broker_ids):
+        try:
+            for broker_id in broker_ids:
+                db.session.add(PartitionReplica(partition_metadata, broker_id))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            return -1
+        return len(broker_ids)
+
+    @staticmethod
+    def updateProgress(topic_name, partition_id, leader_epoch, followers):
+        # followers: [{broker_id, offset, in_sync}] from the leader, ignored if it is no longer the leader
+        partition = PartitionMetadata.query.filter_by(topic_name=topic_name, partition_id=partition_id).first()
+        if partition is None or partition.leader_epoch != leader_epoch:
+            return -1
+        for follower in followers:
+            entry = PartitionReplica.query.filter_by(partition_metadata=partition.id,
+                                                     broker_id=follower["broker_id"]).first()
+            if entry is not None:
+                entry.offset = follower["offset"]
+                entry.in_sync = follower["in_sync"]
+        db.session.commit()
+        return 0
+
+    @staticmethod
+    def promote(partition_metadata, broker_id):
+        # makes the follower broker_id the leader, the old leader follows and has to catch up first
+        partition = PartitionMetadata.query.filter_by(id=partition_metadata).first()
+        leader = PartitionReplica.query.filter_by(partition_metadata=partition_metadata, broker_id=broker_id).first()
+        try:
+            # followers ahead of the new leader may get cut back, so their positions
+            # (read by follower reads) only count up to the new leader's
+            PartitionReplica.query.filter(PartitionReplica.partition_metadata == partition_metadata,
+                                          PartitionReplica.offset > (leader.offset or 0)).update(
+                {"offset": leader.offset or 0}, synchronize_session=False)
+            db.session.delete(leader)
+            db.session.add(PartitionReplica(partition_metadata, partition.broker_id))
+            partition.broker_id = broker_id
+            partition.leader_epoch = (partition.leader_epoch or 0) + 1
+            # messages the new leader never got are lost, heartbeats of its epoch take it from here
+            partition.size = leader.offset or 0
+            db.session.commit()
+        except:
+            db.session.rollback()
+            return -1
+        return partition.leader_epoch
+
 
 # Table : Offsets(self explanatory)
 # [Consumer_id, topic_name, partition_id(null if subscribed to entire topic), offset]
@@ -199,16 +304,27 @@ class ConsumerMetadata(db.Model):
         return obj.offset
 
     @staticmethod
-    def incrementOffset(consumer_id, topic_name, partition_id):
+    def incrementOffset(consumer_id, topic_name, partition_id, count=1):
         import sys
-        print(f" Increment Offset: {consumer_id} {topic_name} {partition_id}", file=sys.stderr)
+        print(f" Increment Offset: {consumer_id} {topic_name} {partition_id} by {count}", file=sys.stderr)
         part_metadata = PartitionMetadata.getPartition_Metadata(topic_name, partition_id)
         
         if not ConsumerMetadata.checkConsumer(consumer_id, topic_name, partition_id):
             ConsumerMetadata.registerConsumer(consumer_id, topic_name, partition_id)
             
         entry = ConsumerMetadata.query.filter_by(consumer_id=consumer_id, partition_metadata=part_metadata).first()
-        entry.offset += 1
+        entry.offset += count
+        db.session.commit()
+
+    @staticmethod
+    def setOffset(consumer_id, topic_name, partition_id, offset):
+        part_metadata = PartitionMetadata.getPartition_Metadata(topic_name, partition_id)
+
+        if not ConsumerMetadata.checkConsumer(consumer_id, topic_name, partition_id):
+            ConsumerMetadata.registerConsumer(consumer_id, topic_name, partition_id)
+
+        entry = ConsumerMetadata.query.filter_by(consumer_id=consumer_id, partition_metadata=part_metadata).first()
+        entry.offset = offset
         db.session.commit()
 
     @staticmethod
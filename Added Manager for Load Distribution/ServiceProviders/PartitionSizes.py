@@ -0,0 +1,75 @@
+# Partition sizes of the write manager
+# A partition's size in PartitionMetadata is the high watermark of its leader's
+# log, the offset the next message will get. Brokers report it for every
+# partition they store with each heartbeat (see Brokers/LoadStats.py); reports
+# for partitions a broker leads are kept in memory and written every
+# SIZE_FLUSH_MS in one statement, instead of one update per produced message.
+# Sizes, and the lag /size returns, are behind the brokers by at most a
+# heartbeat interval plus SIZE_FLUSH_MS. Messages produced straight to a broker
+# are counted the same way. Reports carry the leader epoch they were accepted
+# under: a new leader's log may end below its predecessor's, so a newer epoch
+# replaces the size instead of only raising it.
+import threading
+from time import sleep
+from contextlib import nullcontext
+from ManagerModel import PartitionMetadata
+
+SIZE_FLUSH_MS = 1000
+
+
+class PartitionSizes:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (topic, partition_id) -> (leader epoch, high watermark) not written yet
+        self.pending = {}
+
+    def keep(self, key, leader_epoch: int, high_watermark: int) -> None:
+        # the newest epoch wins, within an epoch the highest watermark
+        pending = self.pending.get(key)
+        if pending is None or (leader_epoch, high_watermark) > pending:
+            self.pending[key] = (leader_epoch, high_watermark)
+
+    def update(self, partitions: list, led: dict) -> None:
+        # partitions: the "partitions" of a heartbeat's load report,
+        # led: (topic, partition_id) -> leader epoch of the partitions led by its broker
+        with self.lock:
+            for partition in partitions:
+                key = (partition["topic_name"], partition["partition_id"])
+                high_watermark = partition.get("high_watermark")
+                if key not in led or high_watermark is None:
+                    continue
+                self.keep(key, led[key], high_watermark)
+
+    def flush(self) -> int:
+        # writes the pending sizes, returns how many or -1
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        status = PartitionMetadata.setSizes(pending)
+        if status == -1:
+            # written with the next flush, unless newer sizes arrived meanwhile
+            with self.lock:
+                for key, (leader_epoch, high_watermark) in pending.items():
+                    self.keep(key, leader_epoch, high_watermark)
+        return status
+
+
+class SizeFlusher:
+    """Flushes a PartitionSizes every interval_ms, in every process receiving heartbeats."""
+
+    def __init__(self, sizes: PartitionSizes, interval_ms: int = SIZE_FLUSH_MS, context=None) -> None:
+        self.sizes = sizes
+        self.interval = interval_ms / 1000
+        self.context = context if context is not None else nullcontext
+
+        flusher = threading.Thread(target=self.run, daemon=True)
+        flusher.start()
+
+    def run(self) -> None:
+        while True:
+            sleep(self.interval)
+            try:
+                with self.context():
+                    if self.sizes.flush() == -1:
+                        print("Size Flush Error")
+            except Exception as e:
+                print("Size Flush Error:", e)
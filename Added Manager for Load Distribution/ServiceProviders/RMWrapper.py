@@ -1,11 +1,15 @@
 # TODO: Implement Flask Interface \
-from flask import Flask, request
+from flask import Flask, request, Response
 from ReadManager import ReadManager
+from LiveTail import parse_offsets, CHECKPOINT_MS
+from FollowerReads import ReplicaChooser, FOLLOWER_MAX_LAG
+from HttpPool import http_pool, HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
 from flask_migrate import Migrate
 from ManagerModel import db
 
 import uuid
 import argparse
+from Prefork import serve, WORKERS, THREADS
 import os
 
 app = Flask(__name__)
@@ -76,11 +80,76 @@ def dequeue():
 	topic = (dict['topic_name'])
 	consumer_id = str(dict['consumer_id'])
 	partition_id = dict.get('partition_id', None)		
+	fetch_args = {key: dict[key] for key in ('max_messages', 'max_bytes', 'max_wait_ms') if key in dict}
     # if topic exists send consumer id
-	response = ReadManager.dequeue(topic_name=topic, consumer_id=consumer_id, partition_id=partition_id)
+	response = ReadManager.dequeue(topic_name=topic, consumer_id=consumer_id, partition_id=partition_id, **fetch_args)
 	
 	return response
 
+@app.route("/consumer/subscribe", methods=["GET"])
+def subscribe():
+	# live tail as server-sent events, see LiveTail.py
+	# arguments come from the query string so browsers' EventSource can subscribe
+	topic = request.args['topic_name']
+	consumer_id = str(request.args['consumer_id'])
+	partition_id = request.args.get('partition_id', None, type=int)
+	max_messages = request.args.get('max_messages', None, type=int)
+	checkpoint_ms = request.args.get('checkpoint_ms', CHECKPOINT_MS, type=int)
+	# a reconnecting client resumes from the offsets of the last event it received
+	offsets = parse_offsets(request.headers.get('Last-Event-ID', ''))
+	if partition_id is not None and 'offset' in request.args:
+		offsets[partition_id] = request.args.get('offset', type=int)
+
+	events = ReadManager.subscribe(consumer_id=consumer_id, topic_name=topic, partition_id=partition_id,
+								   offsets=offsets, max_messages=max_messages, checkpoint_ms=checkpoint_ms)
+	if events == -1:
+		return {"status": "Failure", "message": f"Topic {topic} does not exist."}
+	return Response(events, mimetype="text/event-stream",
+					headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/offsets/time", methods=["GET"])
+def offsets_for_time():
+	dict = request.get_json()
+	topic = (dict['topic_name'])
+	timestamp = dict['timestamp']
+	partition_id = dict.get('partition_id', None)
+
+	status = ReadManager.offsets_for_time(topic_name=topic, timestamp=timestamp, partition_id=partition_id)
+	response = {}
+	if status == -1:
+		response["status"] = "Failure"
+		response["message"] = f"Topic {topic} does not exist."
+	else:
+		response["status"] = "Success"
+		response["offsets"] = status
+	return response
+
+@app.route("/consumer/seek", methods=["POST"])
+def seek():
+	dict = request.get_json()
+	topic = (dict['topic_name'])
+	consumer_id = str(dict['consumer_id'])
+	timestamp = dict['timestamp']
+	partition_id = dict.get('partition_id', None)
+
+	status = ReadManager.seek(consumer_id=consumer_id, topic_name=topic, timestamp=timestamp, partition_id=partition_id)
+	response = {}
+	if isinstance(status, dict):
+		response["status"] = "Success"
+		response["offsets"] = status
+	else:
+		response["status"] = "Failure"
+		if status == -1:
+			response["message"] = f"Topic {topic} does not exist."
+		elif status == -2:
+			response["message"] = f"Offsets of consumer {consumer_id} for topic {topic} could not be updated."
+	return response
+
+@app.route("/stats/http", methods=["GET"])
+def http_stats():
+	# connection pool of this process
+	return {"status": "Success", "http": http_pool.metrics()}
+
 @app.route("/size", methods=["GET"])
 def size():
 	dict = request.get_json()
@@ -114,6 +183,20 @@ def cmdline_args():
 	parser.add_argument("-mi", "--manager_ip", help="manager ip address", type=str)
 	parser.add_argument("-mp", "--manager_port", help="manager port number", type=int)
 
+	parser.add_argument("--workers", help="worker processes sharing the port, 1 runs the development server",
+						type=int, default=int(os.getenv('WORKERS', WORKERS)))
+	parser.add_argument("--threads", help="request threads per worker process",
+						type=int, default=int(os.getenv('THREADS', THREADS)))
+	parser.add_argument("--follower-reads", help="serve consumers from in-sync follower replicas too",
+						action="store_true")
+	parser.add_argument("--follower-max-lag", help="messages a follower may be behind its leader to be read from",
+						type=int, default=int(os.getenv('FOLLOWER_MAX_LAG', FOLLOWER_MAX_LAG)))
+	parser.add_argument("--http-pool-size", help="kept-alive connections per broker or manager",
+						type=int, default=int(os.getenv('HTTP_POOL_SIZE', HTTP_POOL_SIZE)))
+	parser.add_argument("--http-connect-timeout", help="seconds to connect to a broker or manager",
+						type=float, default=float(os.getenv('HTTP_CONNECT_TIMEOUT', HTTP_CONNECT_TIMEOUT)))
+	parser.add_argument("--http-read-timeout", help="seconds to wait for a broker or manager to answer, long polls add their wait",
+						type=float, default=float(os.getenv('HTTP_READ_TIMEOUT', HTTP_READ_TIMEOUT)))
 	return parser.parse_args()
 
 if __name__ == '__main__':
@@ -122,6 +205,9 @@ if __name__ == '__main__':
 	with app.app_context():
 		db.create_all() # <--- create db object.
 	
+	http_pool.configure(args.http_pool_size, args.http_connect_timeout, args.http_read_timeout)
+	if args.follower_reads:
+		ReadManager.replicas = ReplicaChooser("http://write_manager:5000/stats/brokers", max_lag=args.follower_max_lag)
 	# app.run(debug=True, port = args.port)
-	app.run(host='0.0.0.0')
+	serve(app, db, workers=args.workers, threads=args.threads)
 	# TODO: create a thread that periodically sends heartbeat to manager
\ No newline at end of file
@@ -3,10 +3,18 @@ import uuid
 import random
 import requests
 from concurrent.futures import ThreadPoolExecutor
+import queue
+from threading import Event
+from time import monotonic
+from HttpPool import http_pool
+from LiveTail import (PartitionRelay, sse_event, format_offsets, KEEPALIVE_MS, CHECKPOINT_MS, RELAY_QUEUE)
 
 class ReadManager:
+    # ReplicaChooser with --follower-reads, None reads every partition from its leader
+    replicas = None
+
     @staticmethod
-    def getHealthyPartition( topic_name, consumer_id):
+    def getHealthyPartition( topic_name, consumer_id, require_messages=True):
 
         # active_brokers = BrokerMetadata.get_active_brokers()
 
@@ -18,7 +26,7 @@ class ReadManager:
         idx = random.randint(0, n)
         for i in range(n):
             partition_id = partition_ids[(i+idx) %n]
-            if(BrokerMetadata.checkBroker(PartitionMetadata.getBrokerID(topic_name, partition_id)) and (ReadManager.size(consumer_id, topic_name, partition_id)>0)):
+            if(BrokerMetadata.checkBroker(PartitionMetadata.getBrokerID(topic_name, partition_id)) and (not require_messages or ReadManager.size(consumer_id, topic_name, partition_id)>0)):
                 return partition_id
         return -1
     
@@ -34,24 +42,45 @@ class ReadManager:
         return PartitionMetadata.getSize(topic_name, partition_id) - ConsumerMetadata.getOffset(topic_name, consumer_id, partition_id)
 
     @staticmethod
-    def send_request(broker_endpoint, topic_name, partition_id, consumer_id, offset):
+    def send_request(broker_endpoint, topic_name, partition_id, consumer_id, offset, **fetch_args):
         data = {
             "topic_name": topic_name,
             "consumer_id": consumer_id,
             "partition_id": partition_id,
             "offset": offset
         }
-        response = requests.get(broker_endpoint, json=data)
+        # max_messages / max_bytes switch the broker to batch fetch, max_wait_ms long polls
+        data.update(fetch_args)
+        response = http_pool.get(broker_endpoint, json=data, wait_ms=fetch_args.get('max_wait_ms', 0))
         return response.json()
     
     @staticmethod
-    def inc_offset(wm_endpoint, topic_name, consumer_id,partition_id):
+    def inc_offset(wm_endpoint, topic_name, consumer_id,partition_id, count=1):
         data = {
             "topic_name": topic_name,
             "consumer_id": consumer_id,
-            "partition_id":partition_id
+            "partition_id":partition_id,
+            "count": count
         }
-        response = requests.post(wm_endpoint, json=data)
+        response = http_pool.post(wm_endpoint, json=data)
+        return response.json()
+
+    @staticmethod
+    def set_offset(wm_endpoint, topic_name, consumer_id, partition_id, offset):
+        data = {
+            "topic_name": topic_name,
+            "consumer_id": consumer_id,
+            "partition_id": partition_id,
+            "offset": offset
+        }
+        # -2 if the write manager could not be reached or did not take the offset
+        try:
+            response = http_pool.post(wm_endpoint, json=data)
+        except requests.exceptions.RequestException as e:
+            print("Error Connecting:", e)
+            return -2
+        if not response.ok:
+            return -2
         return response.json()
 
     # @staticmethod
@@ -65,9 +94,12 @@ class ReadManager:
 
     @staticmethod
     # TODO: is partition_id necessary isnt partition fixed when registering 
-    def dequeue(consumer_id, topic_name, partition_id=None):
+    def dequeue(consumer_id, topic_name, partition_id=None, **fetch_args):
         if partition_id is None:
             partition_id = ReadManager.getHealthyPartition(topic_name, consumer_id)
+            if partition_id == -1 and fetch_args.get('max_wait_ms', 0) > 0:
+                # nothing to read anywhere yet, wait on any healthy partition
+                partition_id = ReadManager.getHealthyPartition(topic_name, consumer_id, require_messages=False)
             if partition_id == -1:
                 response_dict = {'status': 'Failure',
                                 'message': 'No healthy partitions found'}
@@ -77,17 +109,133 @@ class ReadManager:
 
         offset = ConsumerMetadata.getOffset(topic_name, consumer_id, partition_id)
         broker_id = PartitionMetadata.getBrokerID(topic_name, partition_id)
-        
+
+        if ReadManager.replicas is not None:
+            replica_id = ReadManager.replicas.choose(topic_name, partition_id, broker_id, offset)
+            if replica_id != broker_id:
+                # the follower has messages at offset, no need to long poll it
+                follower_args = {key: value for key, value in fetch_args.items() if key != 'max_wait_ms'}
+                follower_endpoint = BrokerMetadata.getBrokerEndpoint(replica_id) + "/consumer/consume"
+                try:
+                    res = ReadManager.send_request(follower_endpoint, topic_name, partition_id, consumer_id, offset,
+                                                   **follower_args)
+                except requests.exceptions.RequestException as e:
+                    print("Follower Error:", e)
+                    res = {'status': 'Failure'}
+                if res['status'] == 'Success':
+                    count = len(res['messages']) if 'messages' in res else 1
+                    ReadManager.inc_offset("http://write_manager:5000/consumer/offset", topic_name, consumer_id, partition_id, count=count)
+                    return res
+                # e.g. removed by the follower's retention, the leader decides
+
         broker_endpoint = BrokerMetadata.getBrokerEndpoint(broker_id)
         broker_endpoint = broker_endpoint + "/consumer/consume"
 
-        res= ReadManager.send_request( broker_endpoint, topic_name, partition_id,consumer_id, offset)
+        res= ReadManager.send_request( broker_endpoint, topic_name, partition_id,consumer_id, offset, **fetch_args)
+        if res['status']!='Success' and res.get('log_start_offset', -1) > offset:
+            # the broker removed this offset by retention, continue from its log start
+            offset = res['log_start_offset']
+            ReadManager.set_offset("http://write_manager:5000/consumer/offset", topic_name, consumer_id, partition_id, offset)
+            res= ReadManager.send_request( broker_endpoint, topic_name, partition_id,consumer_id, offset, **fetch_args)
             # ConsumerMetadata.incrementOffset(topic_name,consumer_id) # send request to WM instead
         if res['status']=='Success':
-            ReadManager.inc_offset("http://write_manager:5000/consumer/offset", topic_name, consumer_id,partition_id)
+            count = len(res['messages']) if 'messages' in res else 1
+            ReadManager.inc_offset("http://write_manager:5000/consumer/offset", topic_name, consumer_id,partition_id, count=count)
         return res
         # return output of async req
   
+    @staticmethod
+    def offsets_for_time(topic_name, timestamp, partition_id=None):
+        # first offset appended at or after timestamp (ms) in each partition,
+        # returns {partition_id: offset} or -1 if the topic does not exist
+        partition_ids = ReadManager.list_partitions(topic_name) if partition_id is None else [partition_id]
+        if not partition_ids:
+            return -1
+        offsets = {}
+        for part_id in partition_ids:
+            broker_id = PartitionMetadata.getBrokerID(topic_name, part_id)
+            if not BrokerMetadata.checkBroker(broker_id):
+                continue
+            broker_endpoint = BrokerMetadata.getBrokerEndpoint(broker_id) + "/offsets/time"
+            data = {
+                "topic_name": topic_name,
+                "partition_id": part_id,
+                "timestamp": timestamp
+            }
+            res = http_pool.get(broker_endpoint, json=data).json()
+            if res['status'] == 'Success':
+                offsets[part_id] = res['offset']
+        return offsets
+
+    @staticmethod
+    def seek(consumer_id, topic_name, timestamp, partition_id=None):
+        # moves the consumer to the first message appended at or after timestamp (ms)
+        offsets = ReadManager.offsets_for_time(topic_name, timestamp, partition_id)
+        if offsets == -1:
+            return -1
+        for part_id, offset in offsets.items():
+            # the write manager registers the consumer for the partition if needed
+            if ReadManager.set_offset("http://write_manager:5000/consumer/offset", topic_name, consumer_id, part_id, offset) == -2:
+                return -2
+        return offsets
+
+    @staticmethod
+    def subscribe(consumer_id, topic_name, partition_id=None, offsets=None, max_messages=None,
+                  checkpoint_ms=CHECKPOINT_MS):
+        # live tail of the consumer's partitions, returns a generator of server-sent
+        # events or -1 if the topic does not exist
+        # offsets: {partition_id: offset} to resume from, the consumer's offsets otherwise
+        partition_ids = ReadManager.list_partitions(topic_name) if partition_id is None else [partition_id]
+        if not partition_ids:
+            return -1
+        offsets = offsets or {}
+        offsets = {part_id: offsets.get(part_id, ConsumerMetadata.getOffset(topic_name, consumer_id, part_id))
+                   for part_id in partition_ids}
+        # resolved here, the stream itself runs outside the request's database session
+        endpoints = {part_id: BrokerMetadata.getBrokerEndpoint(PartitionMetadata.getBrokerID(topic_name, part_id))
+                     for part_id in partition_ids}
+        return ReadManager.stream(consumer_id, topic_name, offsets, endpoints, max_messages, checkpoint_ms)
+
+    @staticmethod
+    def stream(consumer_id, topic_name, offsets, endpoints, max_messages, checkpoint_ms):
+        events = queue.Queue(maxsize=RELAY_QUEUE)
+        stop = Event()
+        for part_id, endpoint in endpoints.items():
+            PartitionRelay(endpoint, topic_name, part_id, offsets[part_id], events, stop, max_messages)
+
+        checkpointed = dict(offsets)
+        next_checkpoint = monotonic() + checkpoint_ms / 1000
+        try:
+            while True:
+                try:
+                    part_id, event, data = events.get(timeout=KEEPALIVE_MS / 1000)
+                except queue.Empty:
+                    part_id, event, data = None, None, None
+                    yield ": keep-alive\n\n"
+
+                if event == "error":
+                    yield sse_event("error", data)
+                    return
+                if event == "messages":
+                    offsets[part_id] = data["next_offset"]
+                    yield sse_event("messages", data, format_offsets(offsets))
+                elif event == "reset":
+                    offsets[part_id] = data["offset"]
+                    yield sse_event("reset", data, format_offsets(offsets))
+
+                if monotonic() >= next_checkpoint:
+                    # everything up to offsets was written to the consumer's connection
+                    next_checkpoint = monotonic() + checkpoint_ms / 1000
+                    moved = {part_id: offset for part_id, offset in offsets.items() if offset != checkpointed[part_id]}
+                    for part_id, offset in moved.items():
+                        ReadManager.set_offset("http://write_manager:5000/consumer/offset",
+                                               topic_name, consumer_id, part_id, offset)
+                    if moved:
+                        checkpointed.update(moved)
+                        yield sse_event("checkpoint", {"offsets": offsets}, format_offsets(offsets))
+        finally:
+            stop.set()
+
     # list_topics()
     @staticmethod
     def list_topics():
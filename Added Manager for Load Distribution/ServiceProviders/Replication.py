@@ -0,0 +1,36 @@
+# Partition replication, manager side
+# With a replication factor of N every partition is kept by its leader (the
+# broker in PartitionMetadata, which producers and consumers are routed to) and
+# N - 1 followers (PartitionReplica). Leaders push their appends to the followers
+# themselves (Brokers/Replication.py) and report each follower's position and
+# whether it is in sync through /broker/replicas. The LeaderElector promotes the
+# most advanced in-sync follower of a partition whose leader stopped sending
+# heartbeats; a partition without one waits for its leader to come back.
+import threading
+from contextlib import nullcontext
+from time import sleep
+
+REPLICATION_FACTOR = 1
+# a leader without a heartbeat for this long is replaced
+BROKER_FAILURE_MS = 3000
+ELECTION_INTERVAL_MS = 1000
+
+
+class LeaderElector:
+    def __init__(self, elect, interval_ms: int = ELECTION_INTERVAL_MS, context=None) -> None:
+        # elect: one pass over all partitions, run inside context
+        self.elect = elect
+        self.interval = interval_ms / 1000
+        self.context = context if context is not None else nullcontext
+
+        elector = threading.Thread(target=self.run, daemon=True)
+        elector.start()
+
+    def run(self) -> None:
+        while True:
+            sleep(self.interval)
+            try:
+                with self.context():
+                    self.elect()
+            except Exception as e:
+                print("Election Error:", e)
@@ -0,0 +1,188 @@
+# In-memory routing table of the write manager
+# Produce requests are routed from memory: producer -> topic, topic -> partitions
+# and their leaders, broker -> endpoint and last heartbeat. Every change to that
+# metadata (registrations, topic creation, a broker coming back or moving, a new
+# leader) bumps the table's version and the next request reloads it. With
+# several worker processes the change is published with Postgres NOTIFY so the
+# other workers bump theirs, and heartbeat times, which every worker only sees
+# part of, are re-read from the database at most every BEAT_REFRESH_MS.
+import json
+import select
+import threading
+import psycopg2
+from datetime import datetime
+from time import monotonic, sleep
+from ManagerModel import BrokerMetadata, PartitionMetadata, ProducerMetadata
+
+METADATA_CHANNEL = "metadata_changed"
+BEAT_REFRESH_MS = 100
+
+
+class RoutingTable:
+    def __init__(self, beat_refresh_ms: int = BEAT_REFRESH_MS) -> None:
+        self.lock = threading.Lock()
+        # bumped by every metadata change, the table is reloaded when it differs from loaded
+        self.version = 0
+        self.loaded = -1
+        # producer_id -> topic, producers never change topic so entries are kept across versions
+        self.producers = {}
+        # topic -> [(partition_id, leader broker_id)] sorted by partition_id
+        self.partitions = {}
+        # (topic, partition_id) -> leader epoch
+        self.epochs = {}
+        # broker_id -> endpoint
+        self.endpoints = {}
+        # broker_id -> last heartbeat (utc)
+        self.beats = {}
+        self.beat_refresh = beat_refresh_ms / 1000
+        self.beats_read = None
+        # set by enable_notify, tells the other workers about changes
+        self.publish = None
+
+    def enable_notify(self, publish) -> None:
+        # publish: version -> None, heartbeats then come from the database too
+        self.publish = publish
+
+    def invalidate(self, publish: bool = True) -> None:
+        # called after metadata was committed, publish=False for changes relayed from other workers
+        with self.lock:
+            self.version += 1
+            version = self.version
+        if publish and self.publish is not None:
+            try:
+                self.publish(version)
+            except Exception as e:
+                print("Notify Error:", e)
+
+    def load(self) -> None:
+        # runs inside the app context, once per version
+        with self.lock:
+            version = self.version
+        partitions, epochs = {}, {}
+        for entry in PartitionMetadata.query.order_by(PartitionMetadata.partition_id).all():
+            partitions.setdefault(entry.topic_name, []).append((entry.partition_id, entry.broker_id))
+            epochs[(entry.topic_name, entry.partition_id)] = entry.leader_epoch or 0
+        brokers = BrokerMetadata.query.all()
+        with self.lock:
+            self.partitions = partitions
+            self.epochs = epochs
+            self.endpoints = {broker.broker_id: broker.endpoint for broker in brokers}
+            for broker in brokers:
+                if broker.broker_id not in self.beats or broker.last_beat_timestamp > self.beats[broker.broker_id]:
+                    self.beats[broker.broker_id] = broker.last_beat_timestamp
+            self.loaded = version
+
+    def refresh(self) -> None:
+        if self.loaded != self.version:
+            self.load()
+        if self.publish is not None and (self.beats_read is None or monotonic() - self.beats_read > self.beat_refresh):
+            self.beats_read = monotonic()
+            beats = BrokerMetadata.query.with_entities(BrokerMetadata.broker_id, BrokerMetadata.last_beat_timestamp).all()
+            with self.lock:
+                for broker_id, last_beat in beats:
+                    if broker_id not in self.beats or last_beat > self.beats[broker_id]:
+                        self.beats[broker_id] = last_beat
+
+    def beat(self, broker_id, endpoint: str) -> None:
+        # a heartbeat received by this process, after it was committed
+        broker_id = int(broker_id)
+        with self.lock:
+            self.beats[broker_id] = datetime.utcnow()
+            moved = broker_id in self.endpoints and self.endpoints[broker_id] != endpoint
+        if moved:
+            self.invalidate()
+
+    def topic(self, producer_id):
+        # the producer's topic, None if it is not registered
+        if producer_id not in self.producers:
+            if not ProducerMetadata.query.filter_by(producer_id=producer_id).count():
+                return None
+            self.producers[producer_id] = ProducerMetadata.getTopic(producer_id)
+        return self.producers[producer_id]
+
+    def is_active(self, broker_id) -> bool:
+        # same rule as BrokerMetadata.isActiveBroker
+        last_beat = self.beats.get(broker_id)
+        return last_beat is not None and (datetime.utcnow() - last_beat).total_seconds() < 0.3
+
+    def healthy_partitions(self, topic_name) -> list:
+        # [(partition_id, broker_id)] of the topic's partitions whose leader is active
+        self.refresh()
+        return [(partition_id, broker_id) for partition_id, broker_id in self.partitions.get(topic_name, [])
+                if self.is_active(broker_id)]
+
+    def leader(self, topic_name, partition_id):
+        # (broker_id, endpoint) of the partition's leader, None if the partition does not exist;
+        # partition_id may come from JSON as a string
+        try:
+            partition_id = int(partition_id)
+        except (TypeError, ValueError):
+            return None
+        self.refresh()
+        for entry_id, broker_id in self.partitions.get(topic_name, []):
+            if entry_id == partition_id:
+                return broker_id, self.endpoints[broker_id]
+        return None
+
+    def metadata(self, topic_name=None) -> list:
+        # every partition (of topic_name) with its leader, the leader's endpoint and the leader epoch
+        self.refresh()
+        topics = [topic_name] if topic_name is not None else list(self.partitions.keys())
+        return [{"topic_name": topic, "partition_id": partition_id, "broker_id": broker_id,
+                 "endpoint": self.endpoints[broker_id], "leader_epoch": self.epochs[(topic, partition_id)],
+                 "active": self.is_active(broker_id)}
+                for topic in topics for partition_id, broker_id in self.partitions.get(topic, [])]
+
+    def leading(self, broker_id) -> list:
+        # [topic, partition_id, leader epoch] of the partitions led by broker_id
+        self.refresh()
+        broker_id = int(broker_id)
+        return [[topic, partition_id, self.epochs[(topic, partition_id)]]
+                for topic, partitions in self.partitions.items()
+                for partition_id, leader_id in partitions if leader_id == broker_id]
+
+
+class MetadataListener:
+    """Relays metadata changes published by the other write manager processes to a RoutingTable."""
+
+    def __init__(self, table: RoutingTable, db_url: str, channel: str = METADATA_CHANNEL) -> None:
+        self.table = table
+        self.db_url = db_url
+        self.channel = channel
+
+        listener = threading.Thread(target=self.run, daemon=True)
+        listener.start()
+
+    def listen(self) -> None:
+        connection = psycopg2.connect(self.db_url)
+        connection.set_session(autocommit=True)
+        try:
+            connection.cursor().execute(f'LISTEN "{self.channel}"')
+            # changes made before LISTEN took effect
+            self.table.invalidate(publish=False)
+            while True:
+                if select.select([connection], [], [], 5) == ([], [], []):
+                    continue
+                connection.poll()
+                if connection.notifies:
+                    connection.notifies.clear()
+                    self.table.invalidate(publish=False)
+        finally:
+            connection.close()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                print("Listen Error:", e)
+                sleep(1)
+
+
+def publish_notify(db, channel: str = METADATA_CHANNEL):
+    # returns a publish function for RoutingTable.enable_notify that uses db's session
+    def publish(version) -> None:
+        db.session.execute(db.text("SELECT pg_notify(:channel, :payload)"),
+                           {"channel": channel, "payload": json.dumps(version)})
+        db.session.commit()
+    return publish
@@ -1,12 +1,18 @@
 # TODO: Implement Flask Interface \
 from flask import Flask, request
-from WriteManager import WriteManager
+from WriteManager import WriteManager, broker_load, routing, partition_sizes
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from ManagerModel import db
 import os
 import uuid
 import argparse
+from Prefork import serve, WORKERS, THREADS
+from Replication import LeaderElector, REPLICATION_FACTOR
+from ManagerModel import PartitionMetadata
+from Routing import MetadataListener, publish_notify
+from PartitionSizes import SizeFlusher
+from HttpPool import http_pool, HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
 
 app = Flask(__name__)
 DATABASE_CONFIG = {
@@ -113,8 +119,35 @@ def receive_beat():
 	# print("Heartbeat from : ", end=" ")
 	# print(req)
 	broker_id = req["broker_id"]
-	WriteManager.receive_heartbeat(broker_id,ip,port)
-	return {}
+	WriteManager.receive_heartbeat(broker_id,ip,port, load=dict.get('load'))
+	return {"leading": WriteManager.leadership(broker_id)}
+
+@app.route("/cluster/metadata", methods=["GET"])
+def cluster_metadata():
+	# partitions with their leader, endpoint and leader epoch, for clients producing and consuming directly
+	dict = request.get_json(silent=True) or {}
+	topic_name = dict.get('topic_name', None)
+	if topic_name is not None and topic_name not in WriteManager.list_topics():
+		return {"status": "Failure", "message": f"Topic {topic_name} does not exist."}
+	partitions = WriteManager.cluster_metadata(topic_name, consumer_id=dict.get('consumer_id', None))
+	return {"status": "Success", "partitions": partitions}
+
+@app.route("/broker/replicas", methods=["POST"])
+def replicas():
+	# a leader's replication progress, answered with the partitions it leads and their followers
+	dict = request.get_json()
+	partitions = WriteManager.replica_sync(dict["broker_id"], dict.get("partitions", []))
+	return {"status": "Success", "partitions": partitions}
+
+@app.route("/stats/brokers", methods=["GET"])
+def broker_stats():
+	# load of every broker that sent a recent heartbeat, as seen by this process
+	return {"status": "Success", "brokers": broker_load.all()}
+
+@app.route("/stats/http", methods=["GET"])
+def http_stats():
+	# connection pool of this process
+	return {"status": "Success", "http": http_pool.metrics()}
 
 @app.route("/broker/register", methods=["POST"])
 def register_broker():
@@ -144,11 +177,23 @@ def enqueue():
 	
 	partition_id = dict.get('partition_id', None)
 	message = dict['message']
+	codec = dict.get('codec', None)
 
-	response = WriteManager.enqueue(producer_id=producer_id, partition_id=partition_id, message=message)
+	response = WriteManager.enqueue(producer_id=producer_id, partition_id=partition_id, message=message, codec=codec)
 	
 	return response
 
+@app.route("/producer/produce_batch", methods=["POST"])
+def enqueue_batch():
+	dict = request.get_json()
+	producer_id = str(dict['producer_id'])
+	partition_id = dict.get('partition_id', None)
+	messages = dict['messages']
+
+	response = WriteManager.enqueue_batch(producer_id=producer_id, messages=messages, partition_id=partition_id)
+
+	return response
+
 # @app.route("/consumer/update_partition_metadata",methods=["POST"])
 # def update_metadata_consumer():
 # 	dict = request.get_json()
@@ -166,8 +211,13 @@ def increment_offset():
 	topic_name = dict["topic_name"]
 	consumer_id = dict["consumer_id"]
 	partition_id = dict.get('partition_id', None)
+	count = dict.get('count', 1)
 	# message = dict['message']
-	WriteManager.inc_offset(topic_name, consumer_id,partition_id=partition_id)
+	if 'offset' in dict:
+		# absolute offset, e.g. to skip messages removed by broker retention
+		WriteManager.set_offset(topic_name, consumer_id, partition_id=partition_id, offset=dict['offset'])
+	else:
+		WriteManager.inc_offset(topic_name, consumer_id,partition_id=partition_id, count=count)
 	# response = WriteManager.enqueue(producer_id=producer_id, partition_id=partition_id, message=message)
 	response = {"message" :  "Success"}
 	return response
@@ -177,15 +227,42 @@ def cmdline_args():
 	# create parser
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-p", "--port", help="port number", type=int, default=8080)
+	parser.add_argument("--workers", help="worker processes sharing the port, 1 runs the development server",
+						type=int, default=int(os.getenv('WORKERS', WORKERS)))
+	parser.add_argument("--threads", help="request threads per worker process",
+						type=int, default=int(os.getenv('THREADS', THREADS)))
+	parser.add_argument("--replication-factor", help="brokers keeping a copy of every partition, leader included",
+						type=int, default=int(os.getenv('REPLICATION_FACTOR', REPLICATION_FACTOR)))
+	parser.add_argument("--http-pool-size", help="kept-alive connections per broker or manager",
+						type=int, default=int(os.getenv('HTTP_POOL_SIZE', HTTP_POOL_SIZE)))
+	parser.add_argument("--http-connect-timeout", help="seconds to connect to a broker or manager",
+						type=float, default=float(os.getenv('HTTP_CONNECT_TIMEOUT', HTTP_CONNECT_TIMEOUT)))
+	parser.add_argument("--http-read-timeout", help="seconds to wait for a broker or manager to answer, long polls add their wait",
+						type=float, default=float(os.getenv('HTTP_READ_TIMEOUT', HTTP_READ_TIMEOUT)))
 	return parser.parse_args()
 
+def start_worker():
+	# runs in every worker process, other workers' metadata changes have to reach its routing table
+	if args.workers > 1:
+		MetadataListener(routing, db_url)
+	# sizes from the heartbeats this process receives
+	SizeFlusher(partition_sizes, context=app.app_context)
+
 if __name__ == '__main__':
 	args = cmdline_args()
 
 	# global broker
 	with app.app_context():
+		PartitionMetadata.addLeaderEpoch()
 		db.create_all() # <--- create db object.
 	
+	WriteManager.replication_factor = args.replication_factor
+	http_pool.configure(args.http_pool_size, args.http_connect_timeout, args.http_read_timeout)
+	if args.workers > 1:
+		# every process changing metadata, the master's leader election included, tells the others
+		routing.enable_notify(publish_notify(db))
+	# leader election runs once, in the master process with several workers
+	LeaderElector(WriteManager.elect_leaders, context=app.app_context)
 	# app.run(debug=True, port = args.port)
-	app.run(host='0.0.0.0')
+	serve(app, db, workers=args.workers, threads=args.threads, post_fork=start_worker)
 	# TODO: create a thread that periodically sends heartbeat to manager
\ No newline at end of file
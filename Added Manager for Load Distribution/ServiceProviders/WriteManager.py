@@ -1,12 +1,30 @@
 # import tea, coffee whatever
-from ManagerModel import BrokerMetadata, ProducerMetadata, PartitionMetadata, ConsumerMetadata
+from ManagerModel import BrokerMetadata, ProducerMetadata, PartitionMetadata, ConsumerMetadata, PartitionReplica
 import uuid
-import requests
 from typing import List
 from concurrent.futures import ThreadPoolExecutor
-from random import randint
+from random import sample
+from BrokerLoad import BrokerLoad
+from Replication import REPLICATION_FACTOR, BROKER_FAILURE_MS
+from Routing import RoutingTable
+from PartitionSizes import PartitionSizes
+from HttpPool import http_pool
+
+# load reported by the brokers' heartbeats
+broker_load = BrokerLoad()
+# metadata the produce path is routed with
+routing = RoutingTable()
+# partition sizes reported by the leaders, written to PartitionMetadata in batches
+partition_sizes = PartitionSizes()
+# sub-batches of a batched produce request are sent to their brokers in parallel,
+# threads are started on first use, i.e. in the worker process
+PRODUCE_FANOUT = 16
+produce_pool = ThreadPoolExecutor(max_workers=PRODUCE_FANOUT)
 
 class WriteManager:
+    # copies of every partition including the leader's, set from --replication-factor
+    replication_factor = REPLICATION_FACTOR
+
     def __init__(self) -> None:
         pass
     
@@ -17,8 +35,9 @@ class WriteManager:
         
 
     @staticmethod
-    def receive_heartbeat(broker_id, ip, port):
+    def receive_heartbeat(broker_id, ip, port, load=None):
         # check if that broker was inactive
+        created = False
         if not BrokerMetadata.checkBroker(broker_id):
             # update the partition metadata for that broker
             topics = PartitionMetadata.listTopics()
@@ -26,10 +45,18 @@ class WriteManager:
                 # check if partition exists for that broker 
                 if not PartitionMetadata.checkPartition(topic, broker_id):
                     # create a new partition
-                    PartitionMetadata.createPartition(topic, broker_id)
+                    created |= PartitionMetadata.createPartition(topic, broker_id) != -1
         endpoint = "http://{}:{}".format(ip,port)
         BrokerMetadata.updateIP(broker_id,endpoint)
         BrokerMetadata.updateTimeStamp(broker_id)
+        routing.beat(broker_id, endpoint)
+        if created:
+            routing.invalidate()
+        if load is not None:
+            broker_load.update(broker_id, load)
+            # followers report their copies too, a partition's size is its leader's high watermark
+            led = {(topic, partition_id): leader_epoch for topic, partition_id, leader_epoch in routing.leading(broker_id)}
+            partition_sizes.update(load.get("partitions", []), led)
 
     @staticmethod
     def create_topic(topic_name: str) -> List[int]:
@@ -50,27 +77,86 @@ class WriteManager:
             partition_id = PartitionMetadata.createPartition(topic_name, broker_id)
             if (partition_id != -1):
                 partition_ids.append(partition_id)
+                WriteManager.assign_followers(topic_name, partition_id, broker_ids)
+        if partition_ids:
+            routing.invalidate()
         return partition_ids
 
     @staticmethod
-    def inc_offset(topic_name, consumer_id,partition_id):
-        ConsumerMetadata.incrementOffset(consumer_id,topic_name,partition_id)
+    def assign_followers(topic_name, partition_id, broker_ids):
+        # tops the partition up to replication_factor - 1 followers from broker_ids,
+        # taken in ring order after the leader so that every broker follows as many as it leads
+        if WriteManager.replication_factor <= 1:
+            return
+        partition = PartitionMetadata.query.filter_by(topic_name=topic_name, partition_id=partition_id).first()
+        followers = [entry.broker_id for entry in PartitionReplica.getFollowers(partition.id)]
+        missing = WriteManager.replication_factor - 1 - len(followers)
+        if missing <= 0:
+            return
+        ring = sorted(broker_ids)
+        start = sum(1 for broker_id in ring if broker_id <= partition.broker_id)
+        candidates = [ring[(start + i) % len(ring)] for i in range(len(ring))]
+        added = [broker_id for broker_id in candidates
+                 if broker_id != partition.broker_id and broker_id not in followers][:missing]
+        if added:
+            PartitionReplica.addFollowers(partition.id, added)
+
+    @staticmethod
+    def replica_sync(broker_id, partitions):
+        # progress reported by a leader's replicator, returns the partitions it leads that have followers
+        for report in partitions:
+            PartitionReplica.updateProgress(report["topic_name"], report["partition_id"],
+                                            report["leader_epoch"], report["followers"])
+        assignments = []
+        for partition in PartitionMetadata.query.filter_by(broker_id=broker_id).all():
+            followers = [{"broker_id": entry.broker_id, "endpoint": BrokerMetadata.getBrokerEndpoint(entry.broker_id)}
+                         for entry in PartitionReplica.getFollowers(partition.id)]
+            if followers:
+                assignments.append({"topic_name": partition.topic_name, "partition_id": partition.partition_id,
+                                    "leader_epoch": partition.leader_epoch or 0, "followers": followers})
+        return assignments
+
+    @staticmethod
+    def elect_leaders():
+        # one pass of the LeaderElector: partitions whose leader failed get the in-sync
+        # follower with the most messages as leader, the others are topped up with followers
+        live = BrokerMetadata.getLiveBrokers(BROKER_FAILURE_MS)
+        for partition in PartitionMetadata.query.all():
+            if partition.broker_id in live:
+                WriteManager.assign_followers(partition.topic_name, partition.partition_id, live)
+                continue
+            candidates = [entry for entry in PartitionReplica.getFollowers(partition.id)
+                          if entry.in_sync and entry.broker_id in live]
+            if len(candidates) == 0:
+                continue
+            previous = partition.broker_id
+            leader = max(candidates, key=lambda entry: entry.offset or 0).broker_id
+            leader_epoch = PartitionReplica.promote(partition.id, leader)
+            if leader_epoch != -1:
+                routing.invalidate()
+                print(f"Broker {leader} replaces broker {previous} as leader of topic {partition.topic_name}, "
+                      f"partition {partition.partition_id} (epoch {leader_epoch}).")
+
+    @staticmethod
+    def inc_offset(topic_name, consumer_id,partition_id, count=1):
+        ConsumerMetadata.incrementOffset(consumer_id,topic_name,partition_id, count=count)
+
+    @staticmethod
+    def set_offset(topic_name, consumer_id, partition_id, offset):
+        ConsumerMetadata.setOffset(consumer_id, topic_name, partition_id, offset)
 
     @staticmethod
     def getBalancedPartition(topic_name):
 
-        partition_ids = PartitionMetadata.listPartition_IDs(topic_name)
-        if(len(partition_ids)==0):
+        # (partition_id, broker_id) of the partitions on active brokers, from the routing table
+        healthy = routing.healthy_partitions(topic_name)
+        if len(healthy) == 0:
+            # No ok partitions available
             return -1
-        n = len(partition_ids)
-        # get the corresponding broker for each partition
-        idx = randint(0, n)
-        for i in range(0, n):
-            partition_id = partition_ids[(i+idx) %n]
-            if(BrokerMetadata.checkBroker(PartitionMetadata.getBrokerID(topic_name, partition_id))):
-                return partition_id
-        # No ok partitions available
-        return -1
+        # the less loaded of two random choices: follows the heartbeats' load without
+        # sending everyone to the same broker between two heartbeats
+        choices = sample(healthy, min(2, len(healthy)))
+        return min(choices, key=lambda entry: broker_load.score(entry[1]))[0]
     
     # register_producer(topic_name, parition_id = None) -> success ack
     @staticmethod
@@ -120,6 +206,7 @@ class WriteManager:
             topics = PartitionMetadata.listTopics()
             for topic in topics:
                 PartitionMetadata.createPartition(topic,broker_id)
+            routing.invalidate()
             print(f"Created Broker: {broker_id}")
             # import ipdb; ipdb.set_trace()
             return broker_id
@@ -131,37 +218,123 @@ class WriteManager:
     
 
     @staticmethod
-    def send_request(broker_endpoint, topic_name, partition_id, message):
+    def send_request(broker_endpoint, topic_name, partition_id, message, codec=None):
         data = {
             "topic_name": topic_name,
             "partition_id": partition_id,
             "message": message
         }
-        response = requests.post(broker_endpoint, json=data)
+        if codec is not None:
+            # compressed batch, the broker stores it as is
+            data["codec"] = codec
+        response = http_pool.post(broker_endpoint, json=data)
         return response.json()
 
     @staticmethod
-    def enqueue(producer_id, message, partition_id = None):
-        # TODO handle wrong partition id case
-        topic_name = ProducerMetadata.getTopic(producer_id)
-        if not ProducerMetadata.topic_registered(producer_id, topic_name):
+    def send_batch(broker_endpoint, entries):
+        # entries: [{"topic_name", "partition_id", "message"(, "codec")}] for one broker,
+        # appended by it in one transaction
+        response = http_pool.post(broker_endpoint, json={"messages": entries})
+        return response.json()
+
+    @staticmethod
+    def enqueue_batch(producer_id, messages, partition_id = None):
+        # messages: [message or {"message"(, "partition_id", "codec")}]; every message without
+        # a partition gets one like enqueue does, the messages are grouped by the leader of their
+        # partition and each broker's share is sent as one /producer/produce_batch request, all
+        # brokers at the same time. Returns one result per message, in order:
+        # {"status", "partition_id", "offset"} or {"status", "partition_id", "message"}
+        topic_name = routing.topic(producer_id)
+        if topic_name is None:
+            return {"status": "Failure", "message": "Producer not registered for this topic"}
+        if len(messages) == 0:
+            return {"status": "Failure", "message": "Empty batch."}
+
+        results = [None] * len(messages)
+        # broker_id -> (endpoint, entries, index in messages of every entry)
+        batches = {}
+        for i, entry in enumerate(messages):
+            if not isinstance(entry, dict):
+                entry = {"message": entry}
+            entry_partition = entry.get("partition_id", partition_id)
+            if entry_partition is None:
+                entry_partition = WriteManager.round_robin_partition(topic_name, producer_id)
+            leader = routing.leader(topic_name, entry_partition)
+            if leader is None:
+                results[i] = {"status": "Failure", "partition_id": entry_partition, "message": "Partition not found"}
+                continue
+            broker_id, broker_endpoint = leader
+            entry_partition = int(entry_partition)
+            data = {"topic_name": topic_name, "partition_id": entry_partition, "message": entry["message"]}
+            if entry.get("codec") is not None:
+                data["codec"] = entry["codec"]
+            batch = batches.setdefault(broker_id, (broker_endpoint + "/producer/produce_batch", [], []))
+            batch[1].append(data)
+            batch[2].append(i)
+
+        futures = {broker_id: produce_pool.submit(WriteManager.send_batch, endpoint, entries)
+                   for broker_id, (endpoint, entries, _) in batches.items()}
+        for broker_id, future in futures.items():
+            _, entries, indices = batches[broker_id]
+            try:
+                response = future.result()
+            except Exception as e:
+                print("Error Connecting:", e)
+                response = {"status": "Failure", "message": f"Broker {broker_id} could not be reached."}
+            if response["status"] != "Success":
+                for data, i in zip(entries, indices):
+                    results[i] = {"status": "Failure", "partition_id": data["partition_id"],
+                                  "message": response.get("message", "Batch could not be added.")}
+                continue
+            # a broker gives every partition consecutive offsets, in the order of its entries
+            next_offsets = {offsets["partition_id"]: offsets["base_offset"] for offsets in response["offsets"]}
+            for data, i in zip(entries, indices):
+                offset = next_offsets[data["partition_id"]]
+                next_offsets[data["partition_id"]] = offset + 1
+                results[i] = {"status": "Success", "partition_id": data["partition_id"], "offset": offset}
+
+        failed = sum(1 for result in results if result["status"] != "Success")
+        if failed:
+            return {"status": "Failure", "message": f"{failed} of {len(results)} messages could not be added.",
+                    "results": results}
+        return {"status": "Success", "results": results}
+
+    @staticmethod
+    def enqueue(producer_id, message, partition_id = None, codec = None):
+        # routed from memory, see Routing.py
+        topic_name = routing.topic(producer_id)
+        if topic_name is None:
             return {"status": "Failure", "message": "Producer not registered for this topic"}   
         
         if partition_id is None:
             partition_id = WriteManager.round_robin_partition(topic_name, producer_id)
         
-        try:
-            broker_id = PartitionMetadata.getBrokerID(topic_name, partition_id)
-        except:
+        leader = routing.leader(topic_name, partition_id)
+        if leader is None:
             return {"status": "Failure", "message": "Partition not found"}
-        broker_endpoint = BrokerMetadata.getBrokerEndpoint(broker_id)
+        broker_id, broker_endpoint = leader
+        partition_id = int(partition_id)
         broker_endpoint = broker_endpoint + "/producer/produce"
-        response = WriteManager.send_request( broker_endpoint, topic_name, partition_id, message)
-        if response['status']=='Success':
-            PartitionMetadata.increaseSize(topic_name=topic_name,partition_id=partition_id)
-        return response
+        # the partition's size follows from the leader's heartbeats, see PartitionSizes.py
+        return WriteManager.send_request( broker_endpoint, topic_name, partition_id, message, codec=codec)
     
   
+    @staticmethod
+    def cluster_metadata(topic_name=None, consumer_id=None):
+        # routing information for clients that talk to the brokers directly,
+        # with the consumer's committed offsets if consumer_id is given
+        partitions = routing.metadata(topic_name)
+        if consumer_id is not None:
+            for partition in partitions:
+                partition["offset"] = ConsumerMetadata.getOffset(partition["topic_name"], consumer_id,
+                                                                 partition["partition_id"])
+        return partitions
+
+    @staticmethod
+    def leadership(broker_id):
+        # returned with every heartbeat, brokers refuse direct requests routed with an older leader epoch
+        return routing.leading(broker_id)
+
     # list_topics()
     @staticmethod
     def list_topics():
@@ -0,0 +1,157 @@
+import os
+import sys
+import tempfile
+
+# SegmentLog is a flat module of the broker, import it from Brokers/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Brokers"))
+from SegmentLog import PartitionLog, SegmentStorage
+
+# small segments so a few messages roll over to a new segment
+SEGMENT_BYTES = 256
+INDEX_INTERVAL_BYTES = 64
+
+
+def messages(start, count):
+    return [f"message {i}" for i in range(start, start + count)]
+
+
+def open_log(directory):
+    return PartitionLog(directory, SEGMENT_BYTES, INDEX_INTERVAL_BYTES, False)
+
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def test_roll_over(directory):
+    print("Testing segment roll-over")
+    log = open_log(directory)
+    for i in range(0, 40, 4):
+        assert log.append(messages(i, 4)) == i
+    assert log.high_watermark == 40
+    assert len(segment_files(directory)) > 1, segment_files(directory)
+    # reads cross segment boundaries
+    assert log.read(0, 40, 1 << 20) == messages(0, 40)
+    assert log.read(17, 5, 1 << 20) == messages(17, 5)
+    print(f"{len(segment_files(directory))} segments, reads across them match")
+
+    # reopening finds every segment again
+    log = open_log(directory)
+    assert log.high_watermark == 40
+    assert log.read(0, 40, 1 << 20) == messages(0, 40)
+    print()
+
+
+def test_recovery(directory):
+    print("Testing crash recovery (torn write at the end of the active segment)")
+    log = open_log(directory)
+    log.append(messages(0, 10))
+    active = os.path.join(directory, segment_files(directory)[-1])
+    size = os.path.getsize(active)
+
+    # half a record header followed by garbage, as left by a crash mid-write
+    with open(active, "ab") as f:
+        f.write(b"\x00\x00\x00\x00\x00\x00\x00\x0a\xde\xad\xbe\xef")
+    log = open_log(directory)
+    assert log.high_watermark == 10, log.high_watermark
+    assert os.path.getsize(active) == size
+    assert log.read(0, 10, 1 << 20) == messages(0, 10)
+
+    # a complete header whose payload fails the crc is dropped as well
+    with open(active, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xff]))
+    log = open_log(directory)
+    assert log.high_watermark == 9, log.high_watermark
+    assert log.read(0, 10, 1 << 20) == messages(0, 9)
+
+    # appending continues from the recovered end
+    assert log.append(messages(9, 3)) == 9
+    assert open_log(directory).read(0, 20, 1 << 20) == messages(0, 12)
+    print("Torn tail truncated, appends continue from offset 9")
+    print()
+
+
+def test_trim(directory):
+    print("Testing trim (removes whole segments only)")
+    log = open_log(directory)
+    for i in range(0, 40, 4):
+        log.append(messages(i, 4))
+    base_offsets = [int(name[:-len(".log")]) for name in segment_files(directory)]
+    assert len(base_offsets) > 2, base_offsets
+
+    removed = log.trim(max_messages=15)
+    assert log.start_offset in base_offsets, log.start_offset
+    assert removed == log.start_offset
+    # at least 15 messages are kept, and no segment that could have gone is left
+    assert log.high_watermark - log.start_offset >= 15
+    assert base_offsets[base_offsets.index(log.start_offset) + 1] > 40 - 15
+    assert log.read(log.start_offset, 40, 1 << 20) == messages(log.start_offset, 40 - log.start_offset)
+    assert log.read(0, 1, 1 << 20) == []
+    assert int(segment_files(directory)[0][:-len(".log")]) == log.start_offset
+    print(f"Removed {removed} messages, log starts at {log.start_offset}")
+
+    # the active segment is never removed
+    log.trim(max_messages=0)
+    assert segment_files(directory) == [f"{base_offsets[-1]:020d}.log"]
+    assert log.high_watermark == 40
+    print()
+
+
+def test_truncate(directory):
+    print("Testing truncate (cuts back to the segment base)")
+    log = open_log(directory)
+    for i in range(0, 40, 4):
+        log.append(messages(i, 4))
+    base_offsets = [int(name[:-len(".log")]) for name in segment_files(directory)]
+    assert len(base_offsets) > 2, base_offsets
+
+    # an offset in the middle of the second segment
+    offset = (base_offsets[1] + base_offsets[2]) // 2
+    assert base_offsets[1] < offset < base_offsets[2]
+    assert log.truncate(offset) == base_offsets[1]
+    assert log.high_watermark == base_offsets[1]
+    assert segment_files(directory) == [f"{base_offset:020d}.log" for base_offset in base_offsets[:2]]
+    assert log.read(0, 40, 1 << 20) == messages(0, base_offsets[1])
+
+    # the log continues from the segment base, also after a reopen
+    assert log.append(messages(100, 3)) == base_offsets[1]
+    log = open_log(directory)
+    assert log.high_watermark == base_offsets[1] + 3
+    assert log.read(base_offsets[1], 10, 1 << 20) == messages(100, 3)
+
+    # truncating at the high watermark is a no-op
+    assert log.truncate(log.high_watermark) == base_offsets[1] + 3
+    print(f"Truncated to {offset}, log continues from {base_offsets[1]}")
+    print()
+
+
+def test_storage(directory):
+    print("Testing SegmentStorage reopen")
+    storage = SegmentStorage(directory, segment_bytes=SEGMENT_BYTES, index_interval_bytes=INDEX_INTERVAL_BYTES)
+    storage.create_topic("topic/1", 0)
+    storage.create_topic("topic/1", 1)
+    assert storage.create_topic("topic/1", 0) == -1
+    ranges = storage.append_batch([("topic/1", 0, "a"), ("topic/1", "1", "b"), ("topic/1", 0, "c")])
+    assert sorted(ranges) == [("topic/1", 0, 0, 1), ("topic/1", 1, 0, 0)], ranges
+
+    storage = SegmentStorage(directory, segment_bytes=SEGMENT_BYTES, index_interval_bytes=INDEX_INTERVAL_BYTES)
+    assert sorted(storage.list_topics()) == [("topic/1", 0), ("topic/1", 1)]
+    assert storage.read_range("topic/1", 0, 0, 10, 1 << 20) == ["a", "c"]
+    assert storage.read("topic/1", 1, 0) == "b"
+    assert storage.read("topic/1", 1, 1) == -1
+    print()
+
+
+def test():
+    for case in [test_roll_over, test_recovery, test_trim, test_truncate, test_storage]:
+        with tempfile.TemporaryDirectory() as directory:
+            case(directory)
+    print("All segment log tests passed")
+
+
+if __name__ == "__main__":
+    # needs no database or broker, every case runs against a temp directory
+    test()